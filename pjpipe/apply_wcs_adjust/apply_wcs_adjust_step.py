@@ -14,6 +14,8 @@ from stdatamodels.jwst import datamodels
 from tqdm import tqdm
 from tweakwcs.correctors import JWSTWCSCorrector
 
+from ..utils import BuildManifest
+
 log = logging.getLogger("stpipe")
 log.addHandler(logging.NullHandler())
 
@@ -26,6 +28,7 @@ class ApplyWCSAdjustStep:
         out_dir,
         step_ext,
         procs,
+        incremental=False,
         overwrite=False,
     ):
         """Apply WCS adjustments to images
@@ -37,6 +40,8 @@ class ApplyWCSAdjustStep:
             step_ext: .fits extension for the files going
                 into the step
             procs: Number of processes to run in parallel
+            incremental: Whether to only rerun files that are new or have changed since the last run, tracked
+                with a build manifest in the output directory. Defaults to False
             overwrite: Whether to overwrite or not. Defaults
                 to False
         """
@@ -46,8 +51,12 @@ class ApplyWCSAdjustStep:
         self.out_dir = out_dir
         self.step_ext = step_ext
         self.procs = procs
+        self.incremental = incremental
         self.overwrite = overwrite
 
+        # Whether an incremental run has changed any outputs, so later steps need rerunning
+        self.files_changed = False
+
     def do_step(self):
         """Run applying the WCS adjustments"""
 
@@ -62,7 +71,7 @@ class ApplyWCSAdjustStep:
             self.out_dir,
             "apply_wcs_adjust_step_complete.txt",
         )
-        if os.path.exists(step_complete_file):
+        if os.path.exists(step_complete_file) and not self.incremental:
             log.info("Step already run")
             return True
 
@@ -74,6 +83,26 @@ class ApplyWCSAdjustStep:
         )
         files.sort()
 
+        # Only rerun new or changed files, if requested
+        manifest = None
+        if self.incremental:
+            manifest = BuildManifest(
+                out_dir=self.out_dir,
+                step_name="apply_wcs_adjust",
+                parameters=vars(self),
+            )
+            all_files = copy.deepcopy(files)
+            removed_files = manifest.remove_missing_files(all_files)
+            files = manifest.get_stale_files(files)
+
+            self.files_changed = len(files) > 0 or len(removed_files) > 0
+
+            if len(files) == 0:
+                log.info("Step already run")
+                return True
+
+            log.info(f"Rerunning {len(files)} of {len(all_files)} files")
+
         # Ensure we're not wasting processes
         procs = np.nanmin([self.procs, len(files)])
 
@@ -86,6 +115,9 @@ class ApplyWCSAdjustStep:
             log.warning("Failures detected in applying WCS adjustments")
             return False
 
+        if manifest is not None:
+            manifest.update(files)
+
         with open(step_complete_file, "w+") as f:
             f.close()
 
@@ -140,87 +172,99 @@ class ApplyWCSAdjustStep:
 
         file_short = os.path.split(file)[-1]
 
-        output_file = os.path.join(
-            self.out_dir,
-            file_short,
-        )
-
-        # Set up the WCSCorrector per tweakreg
         with datamodels.open(file) as input_im:
+            for out_file_short, image_model in self.process_model(input_im, file_short):
+                output_file = os.path.join(
+                    self.out_dir,
+                    out_file_short,
+                )
+                image_model.save(output_file)
 
-            model_name = os.path.splitext(input_im.meta.filename)[0].strip('_- ')
+        del input_im
+        del image_model
+        gc.collect()
 
-            refang = input_im.meta.wcsinfo.instance
-            im = JWSTWCSCorrector(
-                wcs=input_im.meta.wcs,
-                wcsinfo={'roll_ref': refang['roll_ref'],
-                         'v2_ref': refang['v2_ref'],
-                         'v3_ref': refang['v3_ref']},
-                meta={'image_model': input_im,
-                      'name': model_name},
-            )
+        return True
 
-            # Pull out the info we need to shift. If we have both
-            # dithers ungrouped and grouped, prefer the ungrouped
-            # ones
-            visit_grouped = file_short.split("_")[0]
-            visit_ungrouped = "_".join(file_short.split("_")[:3])
+    def process_model(
+        self,
+        input_im,
+        file_short,
+    ):
+        """Apply WCS adjustments to an open datamodel
 
-            matrix = [[1, 0], [0, 1]]
-            shift = [0, 0]
+        Args:
+            input_im: Input datamodel
+            file_short: Filename (without directory) of the datamodel
 
-            visit_found = False
-            for visit in [visit_ungrouped, visit_grouped]:
-                if not visit_found:
-                    if visit in self.wcs_adjust["wcs_adjust"]:
-                        wcs_adjust_vals = self.wcs_adjust["wcs_adjust"][visit]
+        Returns:
+            List of (filename, datamodel) tuples to write out
+        """
 
-                        try:
-                            matrix = wcs_adjust_vals["matrix"]
-                        except KeyError:
-                            matrix = [[1, 0], [0, 1]]
+        # Set up the WCSCorrector per tweakreg
+        model_name = os.path.splitext(input_im.meta.filename)[0].strip('_- ')
+
+        refang = input_im.meta.wcsinfo.instance
+        im = JWSTWCSCorrector(
+            wcs=input_im.meta.wcs,
+            wcsinfo={'roll_ref': refang['roll_ref'],
+                     'v2_ref': refang['v2_ref'],
+                     'v3_ref': refang['v3_ref']},
+            meta={'image_model': input_im,
+                  'name': model_name},
+        )
 
-                        try:
-                            shift = wcs_adjust_vals["shift"]
-                        except KeyError:
-                            shift = [0, 0]
+        # Pull out the info we need to shift. If we have both
+        # dithers ungrouped and grouped, prefer the ungrouped
+        # ones
+        visit_grouped = file_short.split("_")[0]
+        visit_ungrouped = "_".join(file_short.split("_")[:3])
 
-                        visit_found = True
+        matrix = [[1, 0], [0, 1]]
+        shift = [0, 0]
 
+        visit_found = False
+        for visit in [visit_ungrouped, visit_grouped]:
             if not visit_found:
-                log.info(f"No shifts found for {file_short}. Will write out without shifting")
-
-            if visit_found:
-
-                im.set_correction(matrix=matrix, shift=shift)
+                if visit in self.wcs_adjust["wcs_adjust"]:
+                    wcs_adjust_vals = self.wcs_adjust["wcs_adjust"][visit]
 
-                image_model = im.meta["image_model"]
-                image_model.meta.wcs = im.wcs
-
-                with warnings.catch_warnings():
-                    warnings.simplefilter("ignore")
                     try:
-                        update_fits_wcsinfo(
-                            image_model,
-                            degree=6,
-                            max_pix_error=0.01,
-                            npoints=32,
-                        )
-                    except (ValueError, RuntimeError) as e:
-                        log.warning(
-                            "Failed to update 'meta.wcsinfo' with FITS SIP "
-                            f"approximation. Reported error is:\n'{e.args[0]}'"
-                        )
-
-            else:
+                        matrix = wcs_adjust_vals["matrix"]
+                    except KeyError:
+                        matrix = [[1, 0], [0, 1]]
 
-                image_model = copy.deepcopy(im.meta["image_model"])
-
-            image_model.save(output_file)
+                    try:
+                        shift = wcs_adjust_vals["shift"]
+                    except KeyError:
+                        shift = [0, 0]
+
+                    visit_found = True
+
+        if not visit_found:
+            log.info(f"No shifts found for {file_short}. Will write out without shifting")
+            return [(file_short, input_im)]
+
+        im.set_correction(matrix=matrix, shift=shift)
+
+        image_model = im.meta["image_model"]
+        image_model.meta.wcs = im.wcs
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            try:
+                update_fits_wcsinfo(
+                    image_model,
+                    degree=6,
+                    max_pix_error=0.01,
+                    npoints=32,
+                )
+            except (ValueError, RuntimeError) as e:
+                log.warning(
+                    "Failed to update 'meta.wcsinfo' with FITS SIP "
+                    f"approximation. Reported error is:\n'{e.args[0]}'"
+                )
 
-        del input_im
-        del image_model
         del im
-        gc.collect()
 
-        return True
+        return [(file_short, image_model)]
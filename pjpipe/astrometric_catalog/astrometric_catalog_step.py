@@ -12,7 +12,7 @@ from photutils.detection import DAOStarFinder, IRAFStarFinder
 
 from ..utils import parse_parameter_dict, fwhms_pix, sigma_clip, recursive_setattr
 
-from .constrained_diffusion import constrained_diffusion
+from .constrained_diffusion import constrained_diffusion_fast
 
 log = logging.getLogger("stpipe")
 log.addHandler(logging.NullHandler())
@@ -172,7 +172,7 @@ class AstrometricCatalogStep:
 
     
         if self.starfind_prefilter == "constrained_diffusion":
-            scales, _ = constrained_diffusion(data, n_scales=3)
+            scales, _ = constrained_diffusion_fast(data, n_scales=3)
             filter_data = scales.sum(axis=0)
             sources = starfind(filter_data, mask=mask)
         else:
@@ -1,6 +1,7 @@
 import numpy as np
 from astropy.convolution import convolve_fft, Gaussian2DKernel
-from scipy.ndimage import gaussian_filter as gf
+from scipy import fft
+from scipy.ndimage import gaussian_filter as gf, maximum_filter
 
 def constrained_diffusion(data, err_rel=3e-2, n_scales=None):
     ntot = min(int(np.log(min(data.shape)) / np.log(2) - 1), n_scales or float('inf'))
@@ -26,4 +27,107 @@ def constrained_diffusion(data, err_rel=3e-2, n_scales=None):
 
         scalecube[i] = channel_image
 
-    return scalecube, data
\ No newline at end of file
+    return scalecube, data
+
+def get_scale_params(i, err_rel=3e-2):
+    """Number of iterations and Gaussian kernel width for scale i"""
+    scale_end, scale_begin = 2**(i+1), 2**i
+    t_end, t_begin = scale_end**2 / 2, scale_begin**2 / 2
+    delta_t_max = t_begin * (0.1 if i == 0 else err_rel)
+    niter = int((t_end - t_begin) / delta_t_max + 0.5)
+    delta_t = (t_end - t_begin) / niter
+    return niter, np.sqrt(2 * delta_t)
+
+def get_transfer_function(kernel, fft_shape, dtype=np.float64):
+    """Real FFT of a normalised kernel, zero-padded and centred on the origin"""
+    kernel = kernel / kernel.sum()
+    big_kernel = np.zeros(fft_shape, dtype=dtype)
+    big_kernel[:kernel.shape[0], :kernel.shape[1]] = kernel
+    big_kernel = np.roll(big_kernel, (-(kernel.shape[0] // 2), -(kernel.shape[1] // 2)), axis=(0, 1))
+    return fft.rfft2(big_kernel)
+
+def get_nan_reach(nan_mask, kernel_size, truncate=4.0):
+    """Pixels whose Gaussian-filtered value would pick up a NaN, matching scipy's filter radius"""
+    radius = int(truncate * kernel_size + 0.5)
+    return maximum_filter(nan_mask, size=2 * radius + 1, mode='constant', cval=False)
+
+def constrained_diffusion_fast(data, err_rel=3e-2, n_scales=None, dtype=np.float64):
+    """Faster constrained diffusion, matching constrained_diffusion to within numerical tolerance
+
+    The Gaussian transfer function for each scale is computed once, the padded image buffer is
+    reused for real FFTs, and the clipping updates are done in place. Only n_scales scales are
+    computed, and dtype=np.float32 can be used to halve memory and speed things up further.
+    Unlike constrained_diffusion, the input data is not modified. NaNs are treated as in
+    constrained_diffusion: small kernels leave any pixel within reach of a NaN untouched, and large
+    kernels use NaN-interpolated (normalised) convolution. Falls back to constrained_diffusion for
+    data with infinite values
+    """
+    if np.any(np.isinf(data)):
+        return constrained_diffusion(np.array(data, dtype=float), err_rel=err_rel, n_scales=n_scales)
+
+    ntot = min(int(np.log(min(data.shape)) / np.log(2) - 1), n_scales or float('inf'))
+    data = np.array(data, dtype=dtype)
+    scalecube = np.zeros((ntot, *data.shape), dtype=dtype)
+
+    # NaNs are zeroed for the convolutions, and put back at the end
+    nan_mask = np.isnan(data)
+    has_nans = np.any(nan_mask)
+    data[nan_mask] = 0
+
+    smooth_image = np.empty_like(data)
+    diff_image = np.empty_like(data)
+    keep = np.empty(data.shape, dtype=bool)
+    keep_neg = np.empty(data.shape, dtype=bool)
+
+    for i in range(ntot):
+        channel_image = scalecube[i]
+        niter, kernel_size = get_scale_params(i, err_rel=err_rel)
+
+        if kernel_size > 5:
+            # Big kernels are done in Fourier space, with zero-padding so we don't wrap around
+            kernel = Gaussian2DKernel(kernel_size).array
+            fft_shape = tuple(fft.next_fast_len(n + k, real=True) for n, k in zip(data.shape, kernel.shape))
+            transfer = get_transfer_function(kernel, fft_shape, dtype=dtype)
+            pad_buffer = np.zeros(fft_shape, dtype=dtype)
+            image_view = pad_buffer[:data.shape[0], :data.shape[1]]
+
+            # NaNs are interpolated over by normalising by the convolved weights, where
+            # the padding counts as valid (zero) data
+            if has_nans:
+                weight_buffer = np.ones(fft_shape, dtype=dtype)
+                weight_buffer[:data.shape[0], :data.shape[1]] = ~nan_mask
+                weights = fft.irfft2(fft.rfft2(weight_buffer) * transfer, s=fft_shape)[:data.shape[0], :data.shape[1]]
+                no_weight = weights < 10 * np.finfo(dtype).eps
+                weights[no_weight] = 1
+            frozen = nan_mask
+        else:
+            # Anything within reach of a NaN stays NaN when smoothed, so is never updated
+            frozen = get_nan_reach(nan_mask, kernel_size) if has_nans else None
+
+        for _ in range(niter):
+            if kernel_size > 5:
+                image_view[...] = data
+                smooth_image[...] = fft.irfft2(fft.rfft2(pad_buffer) * transfer, s=fft_shape)[:data.shape[0], :data.shape[1]]
+                if has_nans:
+                    smooth_image /= weights
+                    smooth_image[no_weight] = 0
+            else:
+                gf(data, kernel_size, output=smooth_image, mode='constant', cval=0.0)
+
+            # Only keep positive data above the smoothed image, or negative data below it
+            np.subtract(data, smooth_image, out=diff_image)
+            np.greater(diff_image, 0, out=keep)
+            keep &= data > 0
+            np.less(diff_image, 0, out=keep_neg)
+            keep_neg &= data < 0
+            keep |= keep_neg
+            if has_nans:
+                keep &= ~frozen
+            diff_image[~keep] = 0
+
+            channel_image += diff_image
+            data -= diff_image
+
+    data[nan_mask] = np.nan
+
+    return scalecube, data
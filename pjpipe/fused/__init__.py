@@ -0,0 +1,5 @@
+from .fused_step import FusedStep
+
+__all__ = [
+    "FusedStep",
+]
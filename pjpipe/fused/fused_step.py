@@ -0,0 +1,205 @@
+import gc
+import glob
+import logging
+import multiprocessing as mp
+import os
+import shutil
+import warnings
+from functools import partial
+
+import numpy as np
+from stdatamodels.jwst import datamodels
+from tqdm import tqdm
+
+log = logging.getLogger("stpipe")
+log.addHandler(logging.NullHandler())
+
+# Steps that also clear out .json files from their input directory when overwriting
+OVERWRITE_CLEAN_JSON_STEPS = [
+    "lyot_separate",
+    "lyot_mask",
+]
+
+
+class FusedStep:
+    def __init__(
+        self,
+        steps,
+        step_names,
+        in_dir,
+        step_ext,
+        procs,
+        save_intermediate=False,
+    ):
+        """Run a chain of per-file steps in memory
+
+        Each file is opened once, passed through each step's process_model in turn, and only
+        the output of the final step is written out. This avoids writing and reading back full
+        FITS files between purely per-file steps
+
+        Args:
+            steps: List of step instances to run, in order. Each should have a process_model method
+            step_names: Names of the steps, used for the step complete files
+            in_dir: Input directory
+            step_ext: .fits extension for the files going into the first step
+            procs: Number of processes to run in parallel
+            save_intermediate: Whether to also write out the outputs of the intermediate
+                steps. Defaults to False
+        """
+
+        if len(steps) != len(step_names):
+            raise ValueError("steps and step_names should be the same length")
+
+        # Incremental runs rely on each step tracking its own inputs
+        for step, step_name in zip(steps, step_names):
+            if getattr(step, "incremental", False):
+                raise ValueError(f"Cannot fuse {step_name} with incremental=True")
+
+        self.steps = steps
+        self.step_names = step_names
+        self.in_dir = in_dir
+        self.step_ext = step_ext
+        self.procs = procs
+        self.save_intermediate = save_intermediate
+
+        self.out_dir = self.steps[-1].out_dir
+
+    def do_step(self):
+        """Run fused steps"""
+
+        # Tidy up in the same way the individual steps would
+        for step, step_name in zip(self.steps, self.step_names):
+            if step.overwrite:
+                shutil.rmtree(step.out_dir)
+                if step_name in OVERWRITE_CLEAN_JSON_STEPS:
+                    for json_file in glob.glob(os.path.join(step.in_dir, "*.json")):
+                        os.remove(json_file)
+
+            if not os.path.exists(step.out_dir):
+                os.makedirs(step.out_dir)
+
+            plot_dir = getattr(step, "plot_dir", None)
+            if plot_dir is not None and not os.path.exists(plot_dir):
+                os.makedirs(plot_dir)
+
+        # Check if we've already run the final step
+        step_complete_files = [
+            os.path.join(
+                step.out_dir,
+                f"{step_name}_step_complete.txt",
+            )
+            for step, step_name in zip(self.steps, self.step_names)
+        ]
+        if os.path.exists(step_complete_files[-1]):
+            log.info("Step already run")
+            return True
+
+        files = glob.glob(
+            os.path.join(
+                self.in_dir,
+                f"*_{self.step_ext}.fits",
+            )
+        )
+        files.sort()
+
+        for step in self.steps:
+            if hasattr(step, "prepare_files"):
+                step.prepare_files(files)
+
+        # Ensure we're not wasting processes
+        procs = np.nanmin([self.procs, len(files)])
+
+        successes = self.run_step(
+            files,
+            procs=procs,
+        )
+
+        if not np.all(successes):
+            log.warning("Failures detected in fused steps")
+            return False
+
+        # Only mark intermediate steps as complete if we've actually written them out
+        if self.save_intermediate:
+            step_complete_files_to_write = step_complete_files
+        else:
+            step_complete_files_to_write = step_complete_files[-1:]
+
+        for step_complete_file in step_complete_files_to_write:
+            with open(step_complete_file, "w+") as f:
+                f.close()
+
+        return True
+
+    def run_step(
+        self,
+        files,
+        procs=1,
+    ):
+        """Wrap paralellism around the fused steps
+
+        Args:
+            files: List of files to process
+            procs: Number of parallel processes to run.
+                Defaults to 1
+        """
+
+        log.info(f"Running fused steps {', '.join(self.step_names)}")
+
+        with mp.get_context("fork").Pool(procs) as pool:
+            successes = []
+
+            for success in tqdm(
+                pool.imap_unordered(
+                    partial(
+                        self.parallel_fused_step,
+                    ),
+                    files,
+                ),
+                ascii=True,
+                desc="Running fused steps",
+                total=len(files),
+            ):
+                successes.append(success)
+
+            pool.close()
+            pool.join()
+            gc.collect()
+
+        return successes
+
+    def parallel_fused_step(
+        self,
+        file,
+    ):
+        """Parallelise running the fused steps
+
+        Args:
+            file: File to process
+        """
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+
+            with datamodels.open(file) as im:
+                ims = [(os.path.split(file)[-1], im)]
+
+                for i, step in enumerate(self.steps):
+                    step_ims = []
+                    for short_file, step_im in ims:
+                        step_ims.extend(step.process_model(step_im, short_file))
+                    ims = step_ims
+
+                    if self.save_intermediate or i == len(self.steps) - 1:
+                        for short_file, step_im in ims:
+                            step_im.save(
+                                os.path.join(
+                                    step.out_dir,
+                                    short_file,
+                                )
+                            )
+
+                del ims, step_ims, im
+
+        gc.collect()
+
+        return True
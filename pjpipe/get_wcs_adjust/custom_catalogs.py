@@ -4,7 +4,7 @@ import os
 import numpy as np
 from photutils.detection import IRAFStarFinder
 
-from ..astrometric_catalog.constrained_diffusion import constrained_diffusion
+from ..astrometric_catalog.constrained_diffusion import constrained_diffusion_fast
 
 log = logging.getLogger("stpipe")
 log.addHandler(logging.NullHandler())
@@ -25,7 +25,7 @@ def constrained_diffusion_catalog(datamodel,
     noiseimg = datamodel.err
     noise = np.median(noiseimg[noiseimg > 0])
 
-    decomposition, _ = constrained_diffusion(img, n_scales=4)
+    decomposition, _ = constrained_diffusion_fast(img, n_scales=4)
     smallscale = decomposition[0:pivot_scale, :, :].sum(axis=0)
     starfinder = IRAFStarFinder(snr_threshold * noise, 2.0, roundhi=roundhi, roundlo=roundlo,
                                 sharplo=sharplo, sharphi=sharphi)
@@ -1,6 +1,7 @@
 import copy
 import gc
 import glob
+import heapq
 import logging
 import multiprocessing as mp
 import os
@@ -21,7 +22,7 @@ from stdatamodels.jwst import datamodels
 from tqdm import tqdm
 
 from ..utils import get_band_type, fwhms_pix, parse_parameter_dict, recursive_setattr, make_stacked_image, \
-    reproject_image, get_pixscale
+    reproject_image, get_pixscale, get_overlapping_pairs
 
 from .custom_catalogs import constrained_diffusion_catalog
 
@@ -42,6 +43,9 @@ ALLOWED_REPROJECT_FUNCS = [
     "exact",
 ]
 
+# Reprojected stacked images, shared with forked workers
+SHARED_REPROJ = {}
+
 
 def write_visit_transforms(
         visit_transforms,
@@ -475,44 +479,35 @@ class GetWCSAdjustStep:
             )
 
         # Save the reprojected arrays to a dictionary, so it's easy to pull them out
-        reproj_array_dict = {}
-        for i, dither in enumerate(dithers):
-            reproj_array = reproject_image(
-                stacked_images[i],
-                optimal_wcs=optimal_wcs,
-                optimal_shape=optimal_shape,
-                stacked_image=True,
-                reproject_func=self.reproject_func,
-            )
-
-            reproj_array_dict[dither] = copy.deepcopy(reproj_array)
-
-        # Now we'll start looping. Keep track of what we've matched or not
-        shift_dict = {}
+        reproj_array_dict = self.reproject_stacked_images(
+            stacked_images=stacked_images,
+            dithers=dithers,
+            optimal_wcs=optimal_wcs,
+            optimal_shape=optimal_shape,
+            procs=procs,
+        )
 
-        unmatched_dict = {}
-        for dither in dithers:
-            unmatched_dict[dither] = {}
-            unmatched_dict[dither]["max_overlap_pixels"] = 0
-            unmatched_dict[dither]["max_overlap_dither"] = None
+        # Get the number of overlapping pixels between each pair of dithers. This only needs
+        # doing once, and only for pairs where the bounding boxes overlap
+        log.info("Finding overlaps between dithers")
+        overlap_dict = {dither: {} for dither in dithers}
 
-        log.info("Finding maximum overlaps and tiles with no overlaps")
-        for i in range(len(dithers)):
-            for j in range(i + 1, len(dithers)):
-                diff = reproj_array_dict[dithers[j]] - reproj_array_dict[dithers[i]]
-                overlap_pix = diff.footprint[diff.footprint != 0]
+        overlapping_pairs = get_overlapping_pairs([reproj_array_dict[dither] for dither in dithers])
+        for i, j in overlapping_pairs:
+            diff = reproj_array_dict[dithers[j]] - reproj_array_dict[dithers[i]]
+            overlap_pix = diff.footprint[diff.footprint != 0]
 
-                n_overlap_pix = np.sum(overlap_pix)
+            n_overlap_pix = np.sum(overlap_pix)
 
-                # These things are symmetric, so we only need to check one way
-                if n_overlap_pix > unmatched_dict[dithers[i]]["max_overlap_pixels"]:
-                    unmatched_dict[dithers[i]]["max_overlap_pixels"] = n_overlap_pix
-                    unmatched_dict[dithers[j]]["max_overlap_pixels"] = n_overlap_pix
+            # These things are symmetric, so store both ways round
+            if n_overlap_pix > 0:
+                overlap_dict[dithers[i]][dithers[j]] = n_overlap_pix
+                overlap_dict[dithers[j]][dithers[i]] = n_overlap_pix
 
-                    unmatched_dict[dithers[i]]["max_overlap_dither"] = dithers[j]
-                    unmatched_dict[dithers[j]]["max_overlap_dither"] = dithers[i]
+        all_overlap_pixels = np.array([max(overlap_dict[dither].values(), default=0) for dither in dithers])
 
-        all_overlap_pixels = np.array([unmatched_dict[dither]["max_overlap_pixels"] for dither in dithers])
+        # Now we'll start looping. Keep track of what we've matched
+        shift_dict = {}
 
         # Step 0: Find any tiles that don't overlap, give these a shift of [0,0]
         no_overlap_idx = np.where(all_overlap_pixels == 0)[0]
@@ -522,8 +517,34 @@ class GetWCSAdjustStep:
             log.info(f"No overlaps found for {no_overlap_dither}. Defaulting to no shift")
             shift_dict[no_overlap_dither] = [0, 0]
 
-            # Remove this from the unmatched dictionary to avoid potential weirdness
-            del unmatched_dict[no_overlap_dither]
+        # Matching is done in order of maximum overlap with anything already matched (i.e. a
+        # maximum spanning tree). Keep a priority queue of edges from matched to unmatched
+        # dithers, sorted by overlap, then dither order, then the order things were matched
+        dither_idx = {dither: i for i, dither in enumerate(dithers)}
+        matched_order = {}
+        overlap_queue = []
+
+        # Also keep track of how far each dither is from its reference, since
+        # everything at the same level can be fit at the same time
+        dither_level = {}
+        match_edges = []
+
+        def add_matched_dither(matched_dither,
+                               level=0,
+                               ):
+            matched_order[matched_dither] = len(matched_order)
+            dither_level[matched_dither] = level
+            for neighbour, n_overlap_pix in overlap_dict[matched_dither].items():
+                if neighbour in matched_order:
+                    continue
+                heapq.heappush(overlap_queue,
+                               (-n_overlap_pix,
+                                dither_idx[neighbour],
+                                matched_order[matched_dither],
+                                neighbour,
+                                matched_dither,
+                                ),
+                               )
 
         # Step 1: Find an initial reference image, this is the first one with the largest overlap with another image
         ref_idx = np.where(all_overlap_pixels == np.nanmax(all_overlap_pixels))[0][0]
@@ -531,118 +552,72 @@ class GetWCSAdjustStep:
 
         log.info(f"Selected {ref_dither} as the reference dither")
         shift_dict[ref_dither] = [0, 0]
-
-        # Step 2: Iterate until everything has a shift
-        while len(shift_dict) < len(dithers):
-            unmatched_dict = {}
-            for dither in dithers:
-                if dither not in shift_dict:
-                    unmatched_dict[dither] = {}
-                    unmatched_dict[dither]["max_overlap_pixels"] = 0
-                    unmatched_dict[dither]["max_overlap_dither"] = None
-
-            for matched_dither in shift_dict:
-                for unmatched_dither in unmatched_dict:
-                    diff = reproj_array_dict[matched_dither] - reproj_array_dict[unmatched_dither]
-                    overlap_pix = diff.footprint[diff.footprint != 0]
-
-                    n_overlap_pix = np.sum(overlap_pix)
-
-                    # These things are symmetric, so we only need to check one way
-                    if n_overlap_pix > unmatched_dict[unmatched_dither]["max_overlap_pixels"]:
-                        unmatched_dict[unmatched_dither]["max_overlap_pixels"] = n_overlap_pix
-                        unmatched_dict[unmatched_dither]["max_overlap_dither"] = matched_dither
+        add_matched_dither(ref_dither)
+
+        # Step 2: Build up the matching order until everything is matched
+        while len(shift_dict) + len(match_edges) < len(dithers):
+
+            # If nothing left overlaps with what we've matched, we have disconnected groups. Start a new
+            # reference from the remaining dithers
+            if len(overlap_queue) == 0:
+                unmatched_idx = [i for i, dither in enumerate(dithers)
+                                 if dither not in shift_dict and dither not in matched_order]
+                ref_idx = unmatched_idx[np.argmax(all_overlap_pixels[unmatched_idx])]
+                ref_dither = dithers[ref_idx]
+
+                log.info(f"No overlaps with matched dithers. Selected {ref_dither} as a new reference dither")
+                shift_dict[ref_dither] = [0, 0]
+                add_matched_dither(ref_dither)
+                continue
 
             # Find the best match
-            all_overlap_pixels = np.array([unmatched_dict[dither]["max_overlap_pixels"]
-                                           for dither in unmatched_dict])
-            all_unmatched_dithers = list(unmatched_dict.keys())
-            next_idx = np.where(all_overlap_pixels == np.nanmax(all_overlap_pixels))[0][0]
-
-            unmatched_dither = all_unmatched_dithers[next_idx]
-            ref_dither = unmatched_dict[unmatched_dither]["max_overlap_dither"]
-
-            log.info(f"Cross-correlating {unmatched_dither} with {ref_dither}")
-
-            diff = reproj_array_dict[ref_dither] - reproj_array_dict[unmatched_dither]
-
-            # Pull out the median, since intensities need to be closely matched
-            diff_med = np.nanmedian(diff.array[diff.footprint != 0])
-
-            # Pull things out into matched arrays
-            ref_array = np.zeros(optimal_shape)
-            unmatched_array = np.zeros_like(ref_array)
-
-            ref_array[reproj_array_dict[ref_dither].view_in_original_array] += (
-                reproj_array_dict[ref_dither].array)
-            ref_array[ref_array == 0] = np.nan
-
-            # Keep track of where NaNs are
-            ref_nan_idx = ~np.isfinite(ref_array)
-            ref_nan_idx = np.array(ref_nan_idx, dtype=int)
-
-            # Shift the reference array if needed, keeping track roughly of where the NaNs are
-            ref_yoff, ref_xoff = shift_dict[ref_dither]
-            if ref_yoff != 0 or ref_xoff != 0:
-                ref_array = shift.shift2d(ref_array,
-                                          deltax=ref_xoff,
-                                          deltay=ref_yoff,
-                                          )
-                ref_nan_idx = shift.shift2d(ref_nan_idx,
-                                            deltax=ref_xoff,
-                                            deltay=ref_yoff,
-                                            )
-                ref_array[ref_nan_idx > 0.99] = np.nan
-
-            unmatched_array[reproj_array_dict[unmatched_dither].view_in_original_array] += (
-                reproj_array_dict[unmatched_dither].array)
-            unmatched_array[unmatched_array == 0] = np.nan
-
-            # Finally, cut down to just the overlap area
-            ref_array = ref_array[diff.imin:diff.imax, diff.jmin:diff.jmax]
-            unmatched_array = unmatched_array[diff.imin:diff.imax, diff.jmin:diff.jmax]
-
-            # And cut down the WCS to the overlap
-            hdr = optimal_wcs[diff.imin:diff.imax, diff.jmin:diff.jmax].to_header()
-            hdr["NAXIS1"] = ref_array.shape[1]
-            hdr["NAXIS2"] = ref_array.shape[0]
+            _, _, _, unmatched_dither, ref_dither = heapq.heappop(overlap_queue)
+            if unmatched_dither in matched_order:
+                continue
 
-            # Subtract off the median difference from the reference array
-            ref_array -= diff_med
+            match_edges.append((unmatched_dither, ref_dither))
+            add_matched_dither(unmatched_dither,
+                               level=dither_level[ref_dither] + 1,
+                               )
 
-            # Set a reasonable size for the matrix from the array shapes
-            num_per_dimension = np.max(unmatched_array.shape) // 2
+        # Step 3: Cross-correlate, level by level. Every dither at a level only depends on
+        # shifts from the level before, so these can be run in parallel. Shifts are
+        # propagated in the same order as matching, so results are deterministic
+        levels = sorted(set(dither_level[edge[0]] for edge in match_edges))
+        max_level_size = max([sum(dither_level[edge[0]] == level for edge in match_edges)
+                              for level in levels],
+                             default=1,
+                             )
+        procs = max(1, np.nanmin([self.procs, max_level_size]))
 
-            # Get a guess for initial shifts
-            gt = align.AlignTranslationPCC(ref_array,
-                                           unmatched_array,
-                                           header=hdr,
-                                           verbose=False,
-                                           )
-            init_shifts = gt.get_translation(split_image=3)
+        SHARED_REPROJ["reproj_array_dict"] = reproj_array_dict
 
-            log.info(f"Found initial shifts of [{init_shifts[1]:.3f}, {init_shifts[0]:.3f}] (pixels)")
+        try:
+            with mp.get_context("fork").Pool(procs) as pool:
 
-            # Run the full optical flow
-            op = align.AlignOpticalFlow(ref_array,
-                                        unmatched_array,
-                                        guess_translation=init_shifts,
-                                        header=hdr,
-                                        verbose=False,
-                                        )
-            op.get_iterate_translation_rotation(nruns_opticalflow=5,
-                                                homography_method=TranslationTransform,
-                                                num_per_dimension=num_per_dimension,
-                                                oflow_test=False,
-                                                )
+                for level in levels:
+                    level_edges = [edge for edge in match_edges if dither_level[edge[0]] == level]
 
-            y_off, x_off = op.translation
+                    log.info(f"Cross-correlating {len(level_edges)} dither(s) at level {level}")
 
-            log.info(f"Found final shifts of [{x_off:.3f}, {y_off:.3f}] (pixels)")
+                    level_shifts = pool.map(
+                        partial(
+                            self.parallel_cross_corr,
+                            optimal_wcs=optimal_wcs,
+                            optimal_shape=optimal_shape,
+                        ),
+                        [(unmatched_dither, ref_dither, shift_dict[ref_dither])
+                         for unmatched_dither, ref_dither in level_edges],
+                    )
 
-            shift_dict[unmatched_dither] = [y_off, x_off]
+                    for (unmatched_dither, _), level_shift in zip(level_edges, level_shifts):
+                        shift_dict[unmatched_dither] = level_shift
 
-            del unmatched_dict[unmatched_dither]
+                pool.close()
+                pool.join()
+                gc.collect()
+        finally:
+            SHARED_REPROJ.clear()
 
         # We have shifts! Now write them into the files
         for dither in dithers:
@@ -666,6 +641,104 @@ class GetWCSAdjustStep:
 
         return True
 
+    def parallel_cross_corr(
+            self,
+            match_edge,
+            optimal_wcs,
+            optimal_shape,
+    ):
+        """Parallel-wrapped function to cross-correlate a dither against its reference
+
+        Args:
+            match_edge: Tuple of (unmatched dither, reference dither, reference shift)
+            optimal_wcs: WCS the stacked images are reprojected to
+            optimal_shape: Shape the stacked images are reprojected to
+        """
+
+        unmatched_dither, ref_dither, ref_shift = match_edge
+
+        reproj_array_dict = SHARED_REPROJ["reproj_array_dict"]
+
+        log.info(f"Cross-correlating {unmatched_dither} with {ref_dither}")
+
+        diff = reproj_array_dict[ref_dither] - reproj_array_dict[unmatched_dither]
+
+        # Pull out the median, since intensities need to be closely matched
+        diff_med = np.nanmedian(diff.array[diff.footprint != 0])
+
+        # Pull things out into matched arrays
+        ref_array = np.zeros(optimal_shape)
+        unmatched_array = np.zeros_like(ref_array)
+
+        ref_array[reproj_array_dict[ref_dither].view_in_original_array] += (
+            reproj_array_dict[ref_dither].array)
+        ref_array[ref_array == 0] = np.nan
+
+        # Keep track of where NaNs are
+        ref_nan_idx = ~np.isfinite(ref_array)
+        ref_nan_idx = np.array(ref_nan_idx, dtype=int)
+
+        # Shift the reference array if needed, keeping track roughly of where the NaNs are
+        ref_yoff, ref_xoff = ref_shift
+        if ref_yoff != 0 or ref_xoff != 0:
+            ref_array = shift.shift2d(ref_array,
+                                      deltax=ref_xoff,
+                                      deltay=ref_yoff,
+                                      )
+            ref_nan_idx = shift.shift2d(ref_nan_idx,
+                                        deltax=ref_xoff,
+                                        deltay=ref_yoff,
+                                        )
+            ref_array[ref_nan_idx > 0.99] = np.nan
+
+        unmatched_array[reproj_array_dict[unmatched_dither].view_in_original_array] += (
+            reproj_array_dict[unmatched_dither].array)
+        unmatched_array[unmatched_array == 0] = np.nan
+
+        # Finally, cut down to just the overlap area
+        ref_array = ref_array[diff.imin:diff.imax, diff.jmin:diff.jmax]
+        unmatched_array = unmatched_array[diff.imin:diff.imax, diff.jmin:diff.jmax]
+
+        # And cut down the WCS to the overlap
+        hdr = optimal_wcs[diff.imin:diff.imax, diff.jmin:diff.jmax].to_header()
+        hdr["NAXIS1"] = ref_array.shape[1]
+        hdr["NAXIS2"] = ref_array.shape[0]
+
+        # Subtract off the median difference from the reference array
+        ref_array -= diff_med
+
+        # Set a reasonable size for the matrix from the array shapes
+        num_per_dimension = np.max(unmatched_array.shape) // 2
+
+        # Get a guess for initial shifts
+        gt = align.AlignTranslationPCC(ref_array,
+                                       unmatched_array,
+                                       header=hdr,
+                                       verbose=False,
+                                       )
+        init_shifts = gt.get_translation(split_image=3)
+
+        log.info(f"Found initial shifts of [{init_shifts[1]:.3f}, {init_shifts[0]:.3f}] (pixels)")
+
+        # Run the full optical flow
+        op = align.AlignOpticalFlow(ref_array,
+                                    unmatched_array,
+                                    guess_translation=init_shifts,
+                                    header=hdr,
+                                    verbose=False,
+                                    )
+        op.get_iterate_translation_rotation(nruns_opticalflow=5,
+                                            homography_method=TranslationTransform,
+                                            num_per_dimension=num_per_dimension,
+                                            oflow_test=False,
+                                            )
+
+        y_off, x_off = op.translation
+
+        log.info(f"Found final shifts of [{x_off:.3f}, {y_off:.3f}] (pixels)")
+
+        return [y_off, x_off]
+
     def make_stacked_images(
             self,
             dithers,
@@ -709,6 +782,76 @@ class GetWCSAdjustStep:
 
         return successes
 
+    def reproject_stacked_images(
+            self,
+            stacked_images,
+            dithers,
+            optimal_wcs,
+            optimal_shape,
+            procs=1,
+    ):
+        """Function to parallelise up reprojecting stacked dither images
+
+        Args:
+            stacked_images: List of stacked images, one per dither
+            dithers: List of dithers, matching the stacked images
+            optimal_wcs: WCS to reproject to
+            optimal_shape: Shape to reproject to
+            procs: Number of simultaneous processes to run.
+                Defaults to 1
+        """
+
+        reproj_array_dict = {}
+
+        with mp.get_context("fork").Pool(procs) as pool:
+
+            for dither, reproj_array in tqdm(
+                    pool.imap_unordered(
+                        partial(
+                            self.parallel_reproject_stacked_image,
+                            optimal_wcs=optimal_wcs,
+                            optimal_shape=optimal_shape,
+                        ),
+                        zip(stacked_images, dithers),
+                    ),
+                    total=len(dithers),
+                    desc="Reprojecting stacked images",
+                    ascii=True,
+            ):
+                reproj_array_dict[dither] = reproj_array
+
+            pool.close()
+            pool.join()
+            gc.collect()
+
+        return reproj_array_dict
+
+    def parallel_reproject_stacked_image(
+            self,
+            stacked_image_dither,
+            optimal_wcs,
+            optimal_shape,
+    ):
+        """Light wrapper around parallelising reprojecting the stacked image
+
+        Args:
+            stacked_image_dither: Tuple of (stacked image, dither)
+            optimal_wcs: WCS to reproject to
+            optimal_shape: Shape to reproject to
+        """
+
+        stacked_image, dither = stacked_image_dither
+
+        reproj_array = reproject_image(
+            stacked_image,
+            optimal_wcs=optimal_wcs,
+            optimal_shape=optimal_shape,
+            stacked_image=True,
+            reproject_func=self.reproject_func,
+        )
+
+        return dither, reproj_array
+
     def parallel_make_stacked_image(
             self,
             dither,
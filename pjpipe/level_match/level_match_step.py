@@ -5,7 +5,6 @@ import itertools
 import logging
 import multiprocessing as mp
 import os
-import random
 import shutil
 import warnings
 from functools import partial
@@ -13,13 +12,16 @@ from functools import partial
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
-from astropy.stats import sigma_clipped_stats
 from reproject.mosaicking import find_optimal_celestial_wcs
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import lsqr
 from stdatamodels.jwst import datamodels
 from threadpoolctl import threadpool_limits
 from tqdm import tqdm
 
-from ..utils import get_dq_bit_mask, reproject_image, make_source_mask, make_stacked_image, get_band_type
+from ..utils import get_dq_bit_mask, reproject_image, make_source_mask, make_stacked_image, get_band_type, \
+    get_overlapping_pairs, sigma_clipped_stats
 
 # Rough lyot outline
 LYOT_I = slice(735, None)
@@ -31,11 +33,19 @@ ALLOWED_REPROJECT_FUNCS = [
     "exact",
 ]
 
+ALLOWED_SOLVERS = [
+    "dense",
+    "sparse",
+]
+
 matplotlib.use("agg")
 matplotlib.rcParams['mathtext.fontset'] = 'stix'
 matplotlib.rcParams['font.family'] = 'STIXGeneral'
 matplotlib.rcParams['font.size'] = 14
 
+# Reprojected arrays to be inherited by forked worker processes
+SHARED_REPROJ = {}
+
 log = logging.getLogger("stpipe")
 log.addHandler(logging.NullHandler())
 
@@ -70,6 +80,43 @@ def apply_subtraction(im,
     return im
 
 
+def get_valid_extent(arr):
+    """Get the extent of non-NaN data along each axis of an array
+
+    Args:
+        arr: Input array
+
+    Returns:
+        (i_extent, j_extent) tuple, or None if everything is NaN
+    """
+
+    valid = ~np.isnan(arr)
+
+    i_valid = np.flatnonzero(np.any(valid, axis=1))
+    if len(i_valid) == 0:
+        return None
+    j_valid = np.flatnonzero(np.any(valid, axis=0))
+
+    return i_valid[-1] - i_valid[0], j_valid[-1] - j_valid[0]
+
+
+def subsample_evenly(arr, max_points=None):
+    """Deterministically subsample a 1D array to at most max_points values
+
+    Args:
+        arr: Input 1D array
+        max_points: Maximum number of points to keep. Defaults to None,
+            which will keep everything
+    """
+
+    if max_points is None or len(arr) <= max_points:
+        return arr
+
+    idx = np.linspace(0, len(arr) - 1, max_points).astype(int)
+
+    return arr[idx]
+
+
 class LevelMatchStep:
     def __init__(
             self,
@@ -85,12 +132,17 @@ class LevelMatchStep:
             dilate_size=7,
             max_iters=20,
             max_points=10000,
+            max_diff_points=None,
             do_sigma_clip=False,
             weight_method="equal",
             min_area_percent=0.002,
             min_linear_frac=0.25,
             rms_sig_limit=2,
             reproject_func="interp",
+            solver="dense",
+            use_fast_stats=False,
+            mask_cache_dir=None,
+            persist_sip_headers=False,
             overwrite=False,
     ):
         """Perform background matching between tiles
@@ -123,6 +175,9 @@ class LevelMatchStep:
             max_iters: Maximum sigma-clipping iterations. Defaults to 20
             max_points: Maximum points to include in histogram plots. This step can
                 be slow so this speeds it up. Defaults to 10000
+            max_diff_points: Maximum number of difference values to use per overlap when
+                calculating the delta. Larger overlaps will be evenly subsampled down to this.
+                Defaults to None, which will use every pixel
             do_sigma_clip: Whether to do sigma-clipping on data when reprojecting.
                 Defaults to False
             weight_method: How to weight in least-squares minimization. Options are
@@ -135,12 +190,24 @@ class LevelMatchStep:
             rms_sig_limit: Sigma limit for cutting off noisy fits. Defaults to 2
             reproject_func: Which reproject function to use. Defaults to 'interp',
                 but can also be 'exact' or 'adaptive'
+            solver: How to solve for the optimum deltas. Options are 'dense' (pseudo-inverse
+                of the full coefficient matrix) and 'sparse' (iterative least-squares, which
+                scales to much larger mosaics). Defaults to 'dense'
+            use_fast_stats: Whether to use the fast sigma-clipped statistics (see
+                pjpipe.utils.fast_sigma_clipped_stats) rather than astropy's. Defaults to False
+            mask_cache_dir: Directory to cache source masks in. Masks are keyed on the data and masking
+                parameters, so can be shared between steps and re-runs. Defaults to None, which will not
+                cache masks
+            persist_sip_headers: Whether to save FITS SIP approximations to the WCS as .sip.hdr sidecar files,
+                so they can be reused between processes and runs. Defaults to False
             overwrite: Whether to overwrite or not. Defaults
                 to False
         """
 
         if reproject_func not in ALLOWED_REPROJECT_FUNCS:
             raise ValueError(f"reproject_func should be one of {ALLOWED_REPROJECT_FUNCS}")
+        if solver not in ALLOWED_SOLVERS:
+            raise ValueError(f"solver should be one of {ALLOWED_SOLVERS}")
 
         self.in_dir = in_dir
         self.out_dir = out_dir
@@ -154,12 +221,17 @@ class LevelMatchStep:
         self.dilate_size = dilate_size
         self.max_iters = max_iters
         self.max_points = max_points
+        self.max_diff_points = max_diff_points
         self.do_sigma_clip = do_sigma_clip
         self.weight_method = weight_method
         self.min_area_percent = min_area_percent
         self.min_linear_frac = min_linear_frac
         self.rms_sig_limit = rms_sig_limit
         self.reproject_func = reproject_func
+        self.solver = solver
+        self.use_fast_stats = use_fast_stats
+        self.persist_sip_headers = persist_sip_headers
+        self.mask_cache_dir = mask_cache_dir
         self.overwrite = overwrite
 
         self.plot_dir = os.path.join(
@@ -272,6 +344,7 @@ class LevelMatchStep:
                             nsigma=self.sigma,
                             dilate_size=self.dilate_size,
                             sigclip_iters=self.max_iters,
+                            cache_dir=self.mask_cache_dir,
                         )
 
                         # Calculate sigma-clipped median
@@ -280,6 +353,7 @@ class LevelMatchStep:
                             mask=mask,
                             sigma=self.sigma,
                             maxiters=self.max_iters,
+                            use_fast_stats=self.use_fast_stats,
                         )[1]
                 del im
             else:
@@ -725,32 +799,34 @@ class LevelMatchStep:
                     )
                 )
 
-            for i in range(len(files)):
-                for j in range(i + 1, len(files)):
-                    plot_name = self.get_plot_name(
-                        files[i],
-                        files[j],
-                    )
+            # Only consider pairs that can actually overlap
+            all_ijs = get_overlapping_pairs(file_reproj)
 
-                    n_pix, delta, rms, lin_size = self.get_level_match(
-                        files1=file_reproj[i],
-                        files2=file_reproj[j],
-                        plot_name=plot_name,
-                    )
+            for i, j in all_ijs:
+                plot_name = self.get_plot_name(
+                    files[i],
+                    files[j],
+                )
 
-                    # These are symmetrical by design
-                    if n_pix == 0 or delta is None:
-                        continue
+                n_pix, delta, rms, lin_size = self.get_level_match(
+                    files1=file_reproj[i],
+                    files2=file_reproj[j],
+                    plot_name=plot_name,
+                )
+
+                # These are symmetrical by design
+                if n_pix == 0 or delta is None:
+                    continue
 
-                    deltas[j, i] = delta
-                    weights[j, i] = n_pix
-                    rmses[j, i] = rms
-                    lin_sizes[j, i] = lin_size
+                deltas[j, i] = delta
+                weights[j, i] = n_pix
+                rmses[j, i] = rms
+                lin_sizes[j, i] = lin_size
 
-                    deltas[i, j] = -delta
-                    weights[i, j] = n_pix
-                    rmses[i, j] = rms
-                    lin_sizes[i, j] = lin_size
+                deltas[i, j] = -delta
+                weights[i, j] = n_pix
+                rmses[i, j] = rms
+                lin_sizes[i, j] = lin_size
 
             gc.collect()
 
@@ -783,9 +859,10 @@ class LevelMatchStep:
                 pool.join()
                 gc.collect()
 
-            all_ijs = [
-                (i, j) for i in range(len(files)) for j in range(i + 1, len(files))
-            ]
+            # Only consider pairs that can actually overlap
+            all_ijs = get_overlapping_pairs(file_reproj)
+            n_all_ijs = len(files) * (len(files) - 1) // 2
+            log.info(f"Found {len(all_ijs)} overlapping pairs out of {n_all_ijs}")
 
             ijs = []
             delta_vals = []
@@ -793,18 +870,39 @@ class LevelMatchStep:
             rms_vals = []
             lin_size_vals = []
 
-            for ij in tqdm(all_ijs, ascii=True, desc="Calculating delta matrix"):
-                ij, delta, n_pix, rms, lin_size = self.parallel_delta_matrix(
-                    ij=ij,
-                    files=files,
-                    file_reproj=file_reproj,
-                )
-
-                ijs.append(ij)
-                delta_vals.append(delta)
-                n_pix_vals.append(n_pix)
-                rms_vals.append(rms)
-                lin_size_vals.append(lin_size)
+            # Share the reprojected arrays with the workers. Since we fork after setting
+            # this, they're inherited by each process rather than pickled for every pair
+            SHARED_REPROJ["file_reproj"] = file_reproj
+
+            n_procs = max(1, np.nanmin([procs, len(all_ijs)]))
+            chunksize = max(1, len(all_ijs) // (4 * n_procs))
+
+            try:
+                with mp.get_context("fork").Pool(n_procs) as pool:
+                    for ij, delta, n_pix, rms, lin_size in tqdm(
+                            pool.imap_unordered(
+                                partial(
+                                    self.parallel_delta_matrix,
+                                    files=files,
+                                ),
+                                all_ijs,
+                                chunksize=chunksize,
+                            ),
+                            total=len(all_ijs),
+                            desc="Calculating delta matrix",
+                            ascii=True,
+                    ):
+                        ijs.append(ij)
+                        delta_vals.append(delta)
+                        n_pix_vals.append(n_pix)
+                        rms_vals.append(rms)
+                        lin_size_vals.append(lin_size)
+
+                    pool.close()
+                    pool.join()
+                    gc.collect()
+            finally:
+                SHARED_REPROJ.clear()
 
             for idx, ij in enumerate(ijs):
                 i = ij[0]
@@ -830,17 +928,21 @@ class LevelMatchStep:
     def parallel_delta_matrix(
             self,
             ij,
-            file_reproj,
             files,
+            file_reproj=None,
     ):
         """Function to parallelise up getting delta matrix values
 
         Args:
             ij: List of matrix (i, j) values
-            file_reproj: Reprojected file
             files: Full list of files
+            file_reproj: Reprojected files. Defaults to None, which will
+                pull from the arrays shared with the worker processes
         """
 
+        if file_reproj is None:
+            file_reproj = SHARED_REPROJ["file_reproj"]
+
         i = ij[0]
         j = ij[1]
 
@@ -900,19 +1002,16 @@ class LevelMatchStep:
         lin_size = 0
 
         for file_idx1, file1 in enumerate(files1):
-            # Get out coordinates where data is valid, so we can do a linear
+            # Get out extent where data is valid, so we can do a linear
             # extent test
-            ii, jj = np.indices(file1.array.shape, dtype=float)
-            ii[np.where(np.isnan(file1.array))] = np.nan
-            jj[np.where(np.isnan(file1.array))] = np.nan
+            file1_extent = get_valid_extent(file1.array)
 
             # If we have something that's all NaNs
             # (e.g. lyot on MIRI subarray obs.), skip
-            if np.all(np.isnan(ii)):
+            if file1_extent is None:
                 continue
 
-            file1_iaxis = np.nanmax(ii) - np.nanmin(ii)
-            file1_jaxis = np.nanmax(jj) - np.nanmin(jj)
+            file1_iaxis, file1_jaxis = file1_extent
 
             for file_idx2, file2 in enumerate(files2):
                 if file2.overlaps(file1):
@@ -923,29 +1022,23 @@ class LevelMatchStep:
                     diff_arr[diff == 0] = np.nan
                     diff_arr[diff_foot == 0] = np.nan
 
-                    # Get out coordinates where data is valid, so we can do a linear
+                    # Get out extent where data is valid, so we can do a linear
                     # extent test
-                    ii, jj = np.indices(file2.array.shape, dtype=float)
-                    ii[np.where(np.isnan(file2.array))] = np.nan
-                    jj[np.where(np.isnan(file2.array))] = np.nan
+                    file2_extent = get_valid_extent(file2.array)
 
                     # If we have something that's all NaNs
                     # (e.g. lyot on MIRI subarray obs.), skip
-                    if np.all(np.isnan(ii)):
+                    if file2_extent is None:
                         continue
 
-                    file2_iaxis = np.nanmax(ii) - np.nanmin(ii)
-                    file2_jaxis = np.nanmax(jj) - np.nanmin(jj)
+                    file2_iaxis, file2_jaxis = file2_extent
 
-                    ii, jj = np.indices(diff_arr.shape, dtype=float)
-                    ii[np.where(np.isnan(diff_arr))] = np.nan
-                    jj[np.where(np.isnan(diff_arr))] = np.nan
+                    diff_extent = get_valid_extent(diff_arr)
 
                     # If the slices are all NaNs, then we can just move on
-                    if np.all(np.isnan(ii)):
+                    if diff_extent is None:
                         continue
-                    diff_iaxis = np.nanmax(ii) - np.nanmin(ii)
-                    diff_jaxis = np.nanmax(jj) - np.nanmin(jj)
+                    diff_iaxis, diff_jaxis = diff_extent
 
                     # Include everything, but flag if we've hit the minimum linear extent
                     if (
@@ -956,10 +1049,12 @@ class LevelMatchStep:
                     ):
                         lin_size = 1
 
-                    diff = diff_arr[np.isfinite(diff_arr)].tolist()
+                    diff = diff_arr[np.isfinite(diff_arr)]
                     n_pix += len(diff)
 
-                    diffs.extend(diff)
+                    diffs.append(
+                        subsample_evenly(diff, max_points=self.max_diff_points)
+                    )
 
                     if plot_name is not None:
                         if len(diff) > 0:
@@ -981,10 +1076,15 @@ class LevelMatchStep:
             plt.close()
 
         if n_pix > 0:
+            diffs = subsample_evenly(
+                np.concatenate(diffs),
+                max_points=self.max_diff_points,
+            )
+
             # Sigma-clip to remove outliers in the distribution
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
-                _, delta, rms = sigma_clipped_stats(diffs, maxiters=maxiters)
+                _, delta, rms = sigma_clipped_stats(diffs, maxiters=maxiters, use_fast_stats=self.use_fast_stats)
 
             if plot_name is not None:
                 # Get histogram range
@@ -992,7 +1092,7 @@ class LevelMatchStep:
 
                 if self.max_points is not None:
                     if len(diffs) > self.max_points:
-                        diffs_hist = random.sample(diffs, self.max_points)
+                        diffs_hist = np.random.choice(diffs, self.max_points, replace=False)
                 if diffs_hist is None:
                     diffs_hist = copy.deepcopy(diffs)
 
@@ -1101,32 +1201,41 @@ class LevelMatchStep:
         else:
             raise ValueError(f"weight_method {self.weight_method} not known")
 
-        neq = 0
-        for i in range(ns):
-            for j in range(i + 1, ns):
-                if delta_mat[i, j] != 0 and npix_mat[i, j] > 0 and weight[i, j] > 0:
-                    neq += 1
+        # Only pull out valid intersections
+        valid = (delta_mat != 0) & (weight > 0) & (npix_mat > 0)
+        i_idx, j_idx = np.nonzero(np.triu(valid, k=1))
+        neq = len(i_idx)
+        eq_idx = np.arange(neq)
 
         # Create arrays for coefficients and free terms
-        k = np.zeros((neq, ns), dtype=float)
-        f = np.zeros(neq, dtype=float)
-        invalid = ns * [True]
-
-        # Process intersections between the rest of the images
-        ieq = 0
-        for i in range(0, ns):
-            for j in range(i + 1, ns):
-                # Only pull out valid intersections
-                if delta_mat[i, j] != 0 and weight[i, j] > 0 and npix_mat[i, j] > 0:
-                    k[ieq, i] = weight[i, j]
-                    k[ieq, j] = -weight[i, j]
-
-                    f[ieq] = weight[i, j] * delta_mat[i, j]
-                    invalid[i] = False
-                    invalid[j] = False
-                    ieq += 1
-
-        rank = np.linalg.matrix_rank(k, 1.0e-12)
+        eq_weight = weight[i_idx, j_idx]
+        f = eq_weight * delta_mat[i_idx, j_idx]
+        invalid = np.ones(ns, dtype=bool)
+        invalid[i_idx] = False
+        invalid[j_idx] = False
+
+        if self.solver == "dense":
+            k = np.zeros((neq, ns), dtype=float)
+            k[eq_idx, i_idx] = eq_weight
+            k[eq_idx, j_idx] = -eq_weight
+
+            rank = np.linalg.matrix_rank(k, 1.0e-12)
+        else:
+            k = sparse.csr_matrix(
+                (
+                    np.concatenate([eq_weight, -eq_weight]),
+                    (np.concatenate([eq_idx, eq_idx]), np.concatenate([i_idx, j_idx])),
+                ),
+                shape=(neq, ns),
+            )
+
+            # The rank drops by one for each independent group of overlapping images
+            adjacency = sparse.csr_matrix(
+                (np.ones(neq), (i_idx, j_idx)),
+                shape=(ns, ns),
+            )
+            n_components, _ = connected_components(adjacency, directed=False)
+            rank = ns - n_components
 
         if rank < ns - 1:
             logging.warning(
@@ -1139,10 +1248,23 @@ class LevelMatchStep:
             logging.warning("Sky matching (delta) values will be computed only for")
             logging.warning("a subset (or more independent subsets) of input images.")
 
-        inv_k = np.linalg.pinv(k, rcond=1.0e-12)
+        if self.solver == "dense":
+            inv_k = np.linalg.pinv(k, rcond=1.0e-12)
+            deltas = np.dot(inv_k, f)
+        elif neq > 0:
+            # Starting from zero, LSQR converges to the minimum-norm solution, matching
+            # the pseudo-inverse
+            deltas = lsqr(
+                k,
+                f,
+                atol=1.0e-12,
+                btol=1.0e-12,
+                iter_lim=max(1000, 10 * ns),
+            )[0]
+        else:
+            deltas = np.zeros(ns)
 
-        deltas = np.dot(inv_k, f)
-        deltas[np.asarray(invalid, dtype=bool)] = 0
+        deltas[invalid] = 0
 
         return deltas
 
@@ -1171,6 +1293,8 @@ class LevelMatchStep:
                     do_sigma_clip=self.do_sigma_clip,
                     stacked_image=stacked_image,
                     reproject_func=self.reproject_func,
+                    mask_cache_dir=self.mask_cache_dir,
+                    persist_sip_headers=self.persist_sip_headers,
                 )
                 for i in file
             ]
@@ -1182,6 +1306,8 @@ class LevelMatchStep:
                 do_sigma_clip=self.do_sigma_clip,
                 stacked_image=stacked_image,
                 reproject_func=self.reproject_func,
+                mask_cache_dir=self.mask_cache_dir,
+                persist_sip_headers=self.persist_sip_headers,
             )
 
         return file_reproj
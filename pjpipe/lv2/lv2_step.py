@@ -44,6 +44,7 @@ class Lv2Step:
         process_bgr_like_science=False,
         jwst_parameters=None,
         updated_flats_dir=None,
+        use_header_index=False,
         overwrite=False,
     ):
         """Wrapper around the level 2 JWST pipeline
@@ -73,6 +74,9 @@ class Lv2Step:
             updated_flats_dir: Directory with the updated flats to use
                 instead of default ones. Defaults to None, which will
                 use the pipeline default flats
+            use_header_index: If True, will build the observation table for
+                association files straight from the primary headers, cached in
+                a per-directory index. Defaults to False
             overwrite: Whether to overwrite or not. Defaults
                 to False
         """
@@ -96,6 +100,7 @@ class Lv2Step:
         self.process_bgr_like_science = process_bgr_like_science
         self.jwst_parameters = jwst_parameters
         self.updated_flats_dir = updated_flats_dir
+        self.use_header_index = use_header_index
         self.overwrite = overwrite
 
         self.band_type = get_band_type(self.band)
@@ -180,6 +185,8 @@ class Lv2Step:
             check_bgr=check_bgr,
             check_type=self.bgr_check_type,
             background_name=self.bgr_background_name,
+            use_header_index=self.use_header_index,
+            procs=self.procs,
         )
         tab.sort(keys="Start")
 
@@ -56,6 +56,7 @@ class Lv3Step:
             bgr_background_name="off",
             process_bgr_like_science=False,
             jwst_parameters=None,
+            use_header_index=False,
             overwrite=False,
     ):
         """Wrapper around the level 3 JWST pipeline
@@ -103,6 +104,9 @@ class Lv3Step:
             jwst_parameters: Parameter dictionary to pass to
                 the level 2 pipeline. Defaults to None,
                 which will run the observatory defaults
+            use_header_index: If True, will build the observation table for
+                association files straight from the primary headers, cached in
+                a per-directory index. Defaults to False
             overwrite: Whether to overwrite or not. Defaults
                 to False
         """
@@ -136,6 +140,7 @@ class Lv3Step:
         self.bgr_background_name = bgr_background_name
         self.process_bgr_like_science = process_bgr_like_science
         self.jwst_parameters = jwst_parameters
+        self.use_header_index = use_header_index
         self.overwrite = overwrite
 
         self.band_type = get_band_type(self.band)
@@ -228,6 +233,8 @@ class Lv3Step:
             check_bgr=check_bgr,
             check_type=self.bgr_check_type,
             background_name=self.bgr_background_name,
+            use_header_index=self.use_header_index,
+            procs=self.procs,
         )
 
         if self.is_bgr:
@@ -9,11 +9,12 @@ from functools import partial
 
 import numpy as np
 from reproject import reproject_interp
+from shapely.geometry import Polygon, box
 from stdatamodels.jwst import datamodels
 from stdatamodels.jwst.datamodels.dqflags import pixel
 from tqdm import tqdm
 
-from ..utils import get_dq_bit_mask
+from ..utils import get_dq_bit_mask, get_sip_header, BuildManifest
 
 log = logging.getLogger("stpipe")
 log.addHandler(logging.NullHandler())
@@ -24,6 +25,93 @@ ALLOWED_METHODS = ["mask", "mask_overlap"]
 LYOT_I = slice(735, None)
 LYOT_J = slice(None, 290)
 
+# Number of points along each edge of the detector for the footprint polygons,
+# and buffer (in pixels) around them to account for distortion
+N_FOOTPRINT_EDGE_POINTS = 8
+FOOTPRINT_BUFFER = 20
+
+# File info for overlap masking, shared with forked workers
+SHARED_FILE_INFO = {}
+
+
+def get_file_info(
+    files,
+    persist_sip_headers=False,
+):
+    """Get WCS, science (non-lyot) mask and footprint for a list of files
+
+    Args:
+        files: List of files
+        persist_sip_headers: Whether to save FITS SIP headers as sidecar files.
+            Defaults to False
+    """
+
+    file_info = {}
+
+    for file in files:
+        with datamodels.open(file) as im:
+            # Pull out the WCS, and get a science mask (non-lyot)
+            # for each image
+            wcs = get_sip_header(
+                im,
+                file=file,
+                persist=persist_sip_headers,
+            )
+            dq = get_dq_bit_mask(im.dq).astype(bool)
+            dq[LYOT_I, LYOT_J] = 1
+
+            # Sample the edge of the detector, and get the sky positions
+            ny, nx = im.data.shape
+            edge_x = np.linspace(-0.5, nx - 0.5, N_FOOTPRINT_EDGE_POINTS)
+            edge_y = np.linspace(-0.5, ny - 0.5, N_FOOTPRINT_EDGE_POINTS)
+            x = np.concatenate([
+                edge_x,
+                np.full(N_FOOTPRINT_EDGE_POINTS, nx - 0.5),
+                edge_x[::-1],
+                np.full(N_FOOTPRINT_EDGE_POINTS, -0.5),
+            ])
+            y = np.concatenate([
+                np.full(N_FOOTPRINT_EDGE_POINTS, -0.5),
+                edge_y,
+                np.full(N_FOOTPRINT_EDGE_POINTS, ny - 0.5),
+                edge_y[::-1],
+            ])
+            footprint = wcs.all_pix2world(x, y, 0)
+
+            file_info[file] = {
+                "wcs": wcs,
+                "science_mask": ~dq,
+                "footprint": footprint,
+            }
+
+            del im
+
+    return file_info
+
+
+def get_footprint_polygon(
+    footprint,
+    wcs,
+    buffer=FOOTPRINT_BUFFER,
+):
+    """Convert a sky footprint to a polygon in the pixel frame of a WCS
+
+    Args:
+        footprint: RA/Dec of points around the edge of the footprint
+        wcs: WCS to convert into the pixel frame of
+        buffer: Buffer around the polygon, in pixels. Defaults
+            to FOOTPRINT_BUFFER
+    """
+
+    x, y = wcs.wcs_world2pix(footprint[0], footprint[1], 0)
+
+    if not np.all(np.isfinite(x)) or not np.all(np.isfinite(y)):
+        return None
+
+    polygon = Polygon(zip(x, y)).buffer(buffer)
+
+    return polygon
+
 
 class LyotMaskStep:
     def __init__(
@@ -33,6 +121,8 @@ class LyotMaskStep:
         step_ext,
         procs,
         method="mask",
+        persist_sip_headers=False,
+        incremental=False,
         overwrite=False,
     ):
         """Mask the lyot coronagraph in MIRI observations
@@ -47,6 +137,10 @@ class LyotMaskStep:
                 or only parts that overlap the main science
                 chip in other observations (mask_overlap).
                 Defaults to 'mask'
+            persist_sip_headers: Whether to save FITS SIP approximations to the WCS as .sip.hdr sidecar files,
+                so they can be reused between processes and runs. Defaults to False
+            incremental: Whether to only rerun files that are new or have changed since the last run, tracked
+                with a build manifest in the output directory. Defaults to False
             overwrite: Whether to overwrite or not. Defaults
                 to False
         """
@@ -59,8 +153,13 @@ class LyotMaskStep:
         self.step_ext = step_ext
         self.procs = procs
         self.method = method
+        self.persist_sip_headers = persist_sip_headers
+        self.incremental = incremental
         self.overwrite = overwrite
 
+        # Whether an incremental run has changed any outputs, so later steps need rerunning
+        self.files_changed = False
+
     def do_step(self):
         """Run lyot masking"""
 
@@ -76,7 +175,7 @@ class LyotMaskStep:
             self.out_dir,
             "lyot_mask_step_complete.txt",
         )
-        if os.path.exists(step_complete_file):
+        if os.path.exists(step_complete_file) and not self.incremental:
             log.info("Step already run")
             return True
 
@@ -88,6 +187,30 @@ class LyotMaskStep:
         )
         files.sort()
 
+        # Only rerun new or changed files, if requested
+        manifest = None
+        if self.incremental:
+            manifest = BuildManifest(
+                out_dir=self.out_dir,
+                step_name="lyot_mask",
+                parameters=vars(self),
+            )
+            all_files = copy.deepcopy(files)
+            removed_files = manifest.remove_missing_files(all_files)
+            files = manifest.get_stale_files(files)
+
+            # Overlap masking depends on all the files, so if anything has changed redo everything
+            if self.method == "mask_overlap" and (len(files) > 0 or len(removed_files) > 0):
+                files = copy.deepcopy(all_files)
+
+            self.files_changed = len(files) > 0 or len(removed_files) > 0
+
+            if len(files) == 0:
+                log.info("Step already run")
+                return True
+
+            log.info(f"Rerunning {len(files)} of {len(all_files)} files")
+
         # Ensure we're not wasting processes
         procs = np.nanmin([self.procs, len(files)])
 
@@ -101,6 +224,9 @@ class LyotMaskStep:
             log.warning("Failures detected in level 2 pipeline")
             return False
 
+        if manifest is not None:
+            manifest.update(files)
+
         with open(step_complete_file, "w+") as f:
             f.close()
 
@@ -124,6 +250,42 @@ class LyotMaskStep:
 
         log.info(f"Running lyot masking with method {self.method}")
 
+        # For overlap masking, get the WCS, science mask and footprint for each
+        # file once, and share with the workers. This needs to be done before the
+        # pool forks
+        if self.method == "mask_overlap":
+            SHARED_FILE_INFO["file_info"] = get_file_info(
+                files,
+                persist_sip_headers=self.persist_sip_headers,
+            )
+
+        try:
+            successes = self.run_pool(
+                files,
+                procs=procs,
+                mask_value=mask_value,
+            )
+        finally:
+            SHARED_FILE_INFO.clear()
+
+        return successes
+
+    def run_pool(
+        self,
+        files,
+        procs=1,
+        mask_value=513,
+    ):
+        """Run the lyot masking over a pool of processes
+
+        Args:
+            files: List of files to mask lyot in
+            procs: Number of parallel processes to run.
+                Defaults to 1
+            mask_value: DQ bit value for masked values.
+                Defaults to 513 (DO_NOT_USE+NON_SCIENCE)
+        """
+
         with mp.get_context("fork").Pool(procs) as pool:
             successes = []
 
@@ -179,39 +341,65 @@ class LyotMaskStep:
         """
 
         short_file = os.path.split(file)[-1]
-        out_file = os.path.join(
-            self.out_dir,
-            short_file,
-        )
 
         with datamodels.open(file) as im:
-            # If we have subarray data, don't mask
-            is_subarray = "sub" in im.meta.subarray.name.lower()
-            if is_subarray:
-                im.save(out_file)
-                del im
-                return True
+            for out_short_file, out_im in self.process_model(im, short_file, mask_value=mask_value):
+                out_im.save(
+                    os.path.join(
+                        self.out_dir,
+                        out_short_file,
+                    )
+                )
 
-            # Get a rough mask to start
-            lyot_rough_mask = np.zeros_like(im.dq)
-            lyot_rough_mask[LYOT_I, LYOT_J] = 1
+            del im
 
-            # Get DQ mask
-            dq_mask = get_dq_bit_mask(im.dq)
+        return True
 
-            # The final mask is "science" data within
-            # the lyot region
-            lyot_mask = np.logical_and(
-                dq_mask == 0,
-                lyot_rough_mask == 1,
-            )
-            im.dq[lyot_mask] = mask_value
+    def process_model(
+        self,
+        im,
+        short_file,
+        mask_value=None,
+    ):
+        """Mask the lyot in an open datamodel. Only valid for the 'mask' method
 
-            im.save(out_file)
+        Args:
+            im: Input datamodel
+            short_file: Filename (without directory) of the datamodel
+            mask_value: DQ bit value for masked values.
+                Defaults to None, which will use DO_NOT_USE+NON_SCIENCE
 
-            del im
+        Returns:
+            List of (filename, datamodel) tuples to write out
+        """
 
-        return True
+        if self.method != "mask":
+            raise ValueError(f"Can only mask individual datamodels with method 'mask', not {self.method}")
+
+        if mask_value is None:
+            mask_value = pixel["DO_NOT_USE"] + pixel["NON_SCIENCE"]
+
+        # If we have subarray data, don't mask
+        is_subarray = "sub" in im.meta.subarray.name.lower()
+        if is_subarray:
+            return [(short_file, im)]
+
+        # Get a rough mask to start
+        lyot_rough_mask = np.zeros_like(im.dq)
+        lyot_rough_mask[LYOT_I, LYOT_J] = 1
+
+        # Get DQ mask
+        dq_mask = get_dq_bit_mask(im.dq)
+
+        # The final mask is "science" data within
+        # the lyot region
+        lyot_mask = np.logical_and(
+            dq_mask == 0,
+            lyot_rough_mask == 1,
+        )
+        im.dq[lyot_mask] = mask_value
+
+        return [(short_file, im)]
 
     def parallel_lyot_mask_overlap(
         self,
@@ -234,21 +422,16 @@ class LyotMaskStep:
             short_file,
         )
 
-        all_file_info = []
-        for all_file in all_files:
-            with datamodels.open(all_file) as im:
-                # Pull out the WCS, and get a science mask (non-lyot)
-                # for each image
-                wcs = copy.deepcopy(im.meta.wcs.to_fits_sip())
-                dq = get_dq_bit_mask(im.dq).astype(bool)
-                dq[LYOT_I, LYOT_J] = 1
-
-                all_file_info.append([wcs, ~dq, all_file])
-                del im
+        file_info = SHARED_FILE_INFO.get("file_info", None)
+        if file_info is None:
+            file_info = get_file_info(
+                all_files,
+                persist_sip_headers=self.persist_sip_headers,
+            )
 
         with datamodels.open(file) as im:
             im_shape = im.data.shape
-            im_wcs = im.meta.wcs.to_fits_sip()
+            im_wcs = file_info[file]["wcs"]
 
             lyot_rough_mask = np.zeros_like(im.data)
             lyot_rough_mask[LYOT_I, LYOT_J] = 1
@@ -263,30 +446,48 @@ class LyotMaskStep:
                 lyot_rough_mask == 1,
             )
 
+            # Pixel bounds of the lyot region, and its WCS
+            i_min, i_max, _ = LYOT_I.indices(im_shape[0])
+            j_min, j_max, _ = LYOT_J.indices(im_shape[1])
+            lyot_box = box(j_min, i_min, j_max, i_max)
+            lyot_wcs = im_wcs[LYOT_I, LYOT_J]
+            lyot_shape = (i_max - i_min, j_max - j_min)
+
             # We now loop over each file, reprojecting the science
             # (non-lyot) data to see if the lyot is overlapping other
-            # science regions
+            # science regions. Skip files whose footprint definitely
+            # can't reach the lyot, but if we can't build a footprint
+            # then be conservative and check anyway
             cumulative_mask = np.zeros_like(im.data, dtype=bool)
 
-            for file_info in all_file_info:
-                if file == file_info[-1]:
+            for all_file in all_files:
+                if file == all_file:
                     continue
 
-                file_wcs = copy.deepcopy(file_info[0])
-                file_science_mask = copy.deepcopy(file_info[1])
+                footprint = get_footprint_polygon(
+                    file_info[all_file]["footprint"],
+                    wcs=im_wcs,
+                )
+                if footprint is not None and not footprint.intersects(lyot_box):
+                    continue
 
                 # Reproject the science mask
                 rd = reproject_interp(
-                    input_data=(file_science_mask, file_wcs),
-                    output_projection=im_wcs,
-                    shape_out=im_shape,
+                    input_data=(
+                        file_info[all_file]["science_mask"],
+                        file_info[all_file]["wcs"],
+                    ),
+                    output_projection=lyot_wcs,
+                    shape_out=lyot_shape,
                     order="nearest-neighbor",
                     return_footprint=False,
                 )
 
                 # For pixels within the lyot mask and also science data of another
                 # image, mask now!
-                cumulative_mask[np.logical_and(lyot_mask == 1, rd == 1)] = True
+                cumulative_mask[LYOT_I, LYOT_J][
+                    np.logical_and(lyot_mask[LYOT_I, LYOT_J] == 1, rd == 1)
+                ] = True
             im.dq[cumulative_mask] = mask_value
 
             im.save(out_file)
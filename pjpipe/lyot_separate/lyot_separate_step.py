@@ -12,7 +12,7 @@ from stdatamodels.jwst import datamodels
 from stdatamodels.jwst.datamodels.dqflags import pixel
 from tqdm import tqdm
 
-from ..utils import get_dq_bit_mask
+from ..utils import get_dq_bit_mask, BuildManifest
 
 log = logging.getLogger("stpipe")
 log.addHandler(logging.NullHandler())
@@ -30,6 +30,7 @@ class LyotSeparateStep:
         step_ext,
         procs,
         miri_ext="mirimage",
+        incremental=False,
         overwrite=False,
     ):
         """Separate each MIRI file out into main science chip and lyot coronagraph
@@ -41,6 +42,8 @@ class LyotSeparateStep:
                 into the step
             procs: Number of processes to run in parallel
             miri_ext: MIRI filename extension. Defaults to "mirimage"
+            incremental: Whether to only rerun files that are new or have changed since the last run, tracked
+                with a build manifest in the output directory. Defaults to False
             overwrite: Whether to overwrite or not. Defaults
                 to False
         """
@@ -50,8 +53,12 @@ class LyotSeparateStep:
         self.step_ext = step_ext
         self.procs = procs
         self.miri_ext = miri_ext
+        self.incremental = incremental
         self.overwrite = overwrite
 
+        # Whether an incremental run has changed any outputs, so later steps need rerunning
+        self.files_changed = False
+
     def do_step(self):
         """Run lyot separation"""
 
@@ -67,7 +74,7 @@ class LyotSeparateStep:
             self.out_dir,
             "lyot_separate_step_complete.txt",
         )
-        if os.path.exists(step_complete_file):
+        if os.path.exists(step_complete_file) and not self.incremental:
             log.info("Step already run")
             return True
 
@@ -79,6 +86,26 @@ class LyotSeparateStep:
         )
         files.sort()
 
+        # Only rerun new or changed files, if requested
+        manifest = None
+        if self.incremental:
+            manifest = BuildManifest(
+                out_dir=self.out_dir,
+                step_name="lyot_separate",
+                parameters=vars(self),
+            )
+            all_files = copy.deepcopy(files)
+            removed_files = manifest.remove_missing_files(all_files)
+            files = manifest.get_stale_files(files)
+
+            self.files_changed = len(files) > 0 or len(removed_files) > 0
+
+            if len(files) == 0:
+                log.info("Step already run")
+                return True
+
+            log.info(f"Rerunning {len(files)} of {len(all_files)} files")
+
         # Ensure we're not wasting processes
         procs = np.nanmin([self.procs, len(files)])
 
@@ -92,11 +119,39 @@ class LyotSeparateStep:
             log.warning("Failures detected in level 2 pipeline")
             return False
 
+        if manifest is not None:
+            manifest.update(
+                files,
+                outputs={file: self.get_output_files(file) for file in files},
+            )
+
         with open(step_complete_file, "w+") as f:
             f.close()
 
         return True
 
+    def get_output_files(
+        self,
+        file,
+    ):
+        """Get the main chip and lyot filenames that a file will be separated into
+
+        Args:
+            file: Input file
+        """
+
+        short_file = os.path.split(file)[-1]
+
+        output_files = [
+            os.path.join(
+                self.out_dir,
+                short_file.replace(self.miri_ext, f"{self.miri_ext}{suffix}"),
+            )
+            for suffix in ["s", "l"]
+        ]
+
+        return output_files
+
     def run_step(
         self,
         files,
@@ -153,57 +208,84 @@ class LyotSeparateStep:
 
         short_file = os.path.split(file)[-1]
 
+        with datamodels.open(file) as im:
+            out_ims = self.process_model(
+                im,
+                short_file,
+                mask_value=mask_value,
+            )
+            for out_short_file, out_im in out_ims:
+                out_im.save(
+                    os.path.join(
+                        self.out_dir,
+                        out_short_file,
+                    )
+                )
+
+            del out_ims, im
+
+        return True
+
+    def process_model(
+        self,
+        im,
+        short_file,
+        mask_value=None,
+    ):
+        """Separate the lyot from the main science chip in an open datamodel
+
+        Args:
+            im: Input datamodel
+            short_file: Filename (without directory) of the datamodel
+            mask_value: DQ bit value for masked values.
+                Defaults to None, which will use DO_NOT_USE+NON_SCIENCE
+
+        Returns:
+            List of (filename, datamodel) tuples to write out
+        """
+
+        if mask_value is None:
+            mask_value = pixel["DO_NOT_USE"] + pixel["NON_SCIENCE"]
+
         # Pull out filenames for the main chip image
         # and lyot. These need to be distinct, but the
         # same length. We do this by distinguishing the
         # main science as miri_ext+"s", and the lyot as
         # miri_ext+"l"
-        main_chip_out_file = os.path.join(
-            self.out_dir,
-            short_file.replace(self.miri_ext, f"{self.miri_ext}s"),
-        )
-
-        lyot_out_file = os.path.join(
-            self.out_dir,
-            short_file.replace(self.miri_ext, f"{self.miri_ext}l"),
-        )
-
-        with datamodels.open(file) as im:
-            lyot_rough_mask = np.zeros_like(im.data)
-            lyot_rough_mask[LYOT_I, LYOT_J] = 1
-
-            # If we have subarray data, don't separate things out
-            is_subarray = "sub" in im.meta.subarray.name.lower()
-            if is_subarray:
-                im.save(main_chip_out_file)
-                del im
-                return True
+        main_chip_short_file = short_file.replace(self.miri_ext, f"{self.miri_ext}s")
+        lyot_short_file = short_file.replace(self.miri_ext, f"{self.miri_ext}l")
 
-            # Get DQ mask
-            dq_mask = get_dq_bit_mask(im.dq)
+        lyot_rough_mask = np.zeros_like(im.data)
+        lyot_rough_mask[LYOT_I, LYOT_J] = 1
 
-            # Create 2 masks for the lyot and the main
-            # science chip
-            lyot_mask = np.logical_and(
-                dq_mask == 0,
-                lyot_rough_mask == 1,
-            )
-            main_chip_mask = np.logical_and(
-                dq_mask == 0,
-                lyot_rough_mask == 0,
-            )
+        # If we have subarray data, don't separate things out
+        is_subarray = "sub" in im.meta.subarray.name.lower()
+        if is_subarray:
+            return [(main_chip_short_file, im)]
 
-            main_chip_im = copy.deepcopy(im)
-            lyot_im = copy.deepcopy(im)
+        # Get DQ mask
+        dq_mask = get_dq_bit_mask(im.dq)
 
-            # Mask lyot in main chip, and main
-            # chip in lyot
-            main_chip_im.dq[lyot_mask] = mask_value
-            lyot_im.dq[main_chip_mask] = mask_value
+        # Create 2 masks for the lyot and the main
+        # science chip
+        lyot_mask = np.logical_and(
+            dq_mask == 0,
+            lyot_rough_mask == 1,
+        )
+        main_chip_mask = np.logical_and(
+            dq_mask == 0,
+            lyot_rough_mask == 0,
+        )
 
-            main_chip_im.save(main_chip_out_file)
-            lyot_im.save(lyot_out_file)
+        main_chip_im = copy.deepcopy(im)
+        lyot_im = copy.deepcopy(im)
 
-            del main_chip_im, lyot_im, im
+        # Mask lyot in main chip, and main
+        # chip in lyot
+        main_chip_im.dq[lyot_mask] = mask_value
+        lyot_im.dq[main_chip_mask] = mask_value
 
-        return True
+        return [
+            (main_chip_short_file, main_chip_im),
+            (lyot_short_file, lyot_im),
+        ]
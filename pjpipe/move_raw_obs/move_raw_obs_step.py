@@ -4,11 +4,13 @@ import glob
 import logging
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+from astropy.io import fits
 from stdatamodels.jwst import datamodels
 from tqdm import tqdm
 
-from ..utils import get_band_ext, get_band_type, save_file
+from ..utils import get_band_ext, get_band_type, save_file, stage_file
 
 log = logging.getLogger("stpipe")
 log.addHandler(logging.NullHandler())
@@ -24,8 +26,10 @@ class MoveRawObsStep:
         out_dir,
         dr_version,
         is_bgr,
+        procs,
         obs_to_skip=None,
         extra_obs_to_include=None,
+        stage_strategy=None,
         overwrite=False,
     ):
         """Move raw observations from the MAST folder into a specific target/band folder
@@ -48,10 +52,16 @@ class MoveRawObsStep:
             out_dir: Where to move files to
             dr_version: Data reprocessing version
             is_bgr: Whether we're processing background observations or not
+            procs: Number of threads to use when staging files
             obs_to_skip: List of failed or otherwise observations that shouldn't be moved.
                 Defaults to None, which skips nothing
             extra_obs_to_include: List of extra observations to include, for example MIRI
                 flats from elsewhere. Defaults to None, which includes nothing extra
+            stage_strategy: How to stage the raw files. If None, each file is opened as a
+                datamodel and re-saved with pjpipe version info. Otherwise, the filter is
+                checked from the primary header alone, and the file is staged as-is using
+                'copy', 'hardlink', or 'reflink' (see stage_file). Version info will then be
+                added when the files are first processed. Defaults to None
             overwrite (bool): Whether to overwrite or not. Defaults to False
         """
 
@@ -69,8 +79,10 @@ class MoveRawObsStep:
         self.out_dir = out_dir
         self.dr_version = dr_version
         self.is_bgr = is_bgr
+        self.procs = procs
         self.obs_to_skip = obs_to_skip
         self.extra_obs_to_include = extra_obs_to_include
+        self.stage_strategy = stage_strategy
         self.overwrite = overwrite
 
         self.band_type = get_band_type(band)
@@ -184,11 +196,9 @@ class MoveRawObsStep:
     ):
         """Actually move the raw files"""
 
-        for raw_file in tqdm(
-            raw_files,
-            ascii=True,
-            desc="Moving raw files",
-        ):
+        raw_files_to_move = []
+
+        for raw_file in raw_files:
             raw_fits_name = raw_file.split(os.path.sep)[-1]
             hdu_out_name = os.path.join(self.out_dir, raw_fits_name)
 
@@ -220,36 +230,119 @@ class MoveRawObsStep:
                 continue
 
             if not os.path.exists(hdu_out_name) or self.overwrite:
-                with datamodels.open(raw_file) as im:
-                    # Check we've got the right filter
-                    hdu_filter = im.meta.instrument.filter
+                raw_files_to_move.append(raw_file)
 
-                    if self.band_type == "nircam":
-                        hdu_pupil = im.meta.instrument.pupil
+        if self.stage_strategy is not None:
+            return self.stage_raw_files(raw_files_to_move)
 
-                        pupil = "CLEAR"
-                        jwst_filter = copy.deepcopy(self.band)
+        for raw_file in tqdm(
+            raw_files_to_move,
+            ascii=True,
+            desc="Moving raw files",
+        ):
+            raw_fits_name = raw_file.split(os.path.sep)[-1]
+            hdu_out_name = os.path.join(self.out_dir, raw_fits_name)
 
-                        # For some NIRCAM filters, we need to distinguish filter/pupil.
-                        # TODO: These may not be unique, so may need editing
-                        if self.band in ["F162M", "F164N"]:
-                            pupil = copy.deepcopy(self.band)
-                            jwst_filter = "F150W2"
-                        if self.band == "F323N":
-                            pupil = copy.deepcopy(self.band)
-                            jwst_filter = "F322W2"
-                        if self.band in ["F405N", "F466N", "F470N"]:
-                            pupil = copy.deepcopy(self.band)
-                            jwst_filter = "F444W"
+            with datamodels.open(raw_file) as im:
+                # Check we've got the right filter
+                hdu_filter = im.meta.instrument.filter
+                hdu_pupil = None
+                if self.band_type == "nircam":
+                    hdu_pupil = im.meta.instrument.pupil
 
-                        if hdu_filter == jwst_filter and hdu_pupil == pupil:
+                if self.is_correct_filter(hdu_filter, hdu_pupil):
+                    save_file(im=im, out_name=hdu_out_name, dr_version=self.dr_version)
 
-                            save_file(im=im, out_name=hdu_out_name, dr_version=self.dr_version)
+            del im
 
-                    elif self.band_type == "miri":
-                        if hdu_filter == self.band:
-                            save_file(im=im, out_name=hdu_out_name, dr_version=self.dr_version)
+        return True
 
-                del im
+    def stage_raw_files(
+        self,
+        raw_files,
+    ):
+        """Stage raw files as-is, checking the filter from the primary header
+
+        Args:
+            raw_files: List of raw files to stage
+        """
+
+        with ThreadPoolExecutor(max_workers=max(min(self.procs, len(raw_files)), 1)) as executor:
+            futures = [
+                executor.submit(
+                    self.stage_raw_file,
+                    raw_file,
+                )
+                for raw_file in raw_files
+            ]
+
+            for future in tqdm(
+                as_completed(futures),
+                ascii=True,
+                desc="Staging raw files",
+                total=len(futures),
+            ):
+                future.result()
 
         return True
+
+    def stage_raw_file(
+        self,
+        raw_file,
+    ):
+        """Stage a single raw file, if it's the right filter
+
+        Args:
+            raw_file: Raw file to stage
+        """
+
+        header = fits.getheader(raw_file, ext=0)
+
+        hdu_filter = header.get("FILTER", None)
+        hdu_pupil = header.get("PUPIL", None)
+
+        if not self.is_correct_filter(hdu_filter, hdu_pupil):
+            return False
+
+        stage_file(
+            raw_file,
+            self.out_dir,
+            strategy=self.stage_strategy,
+        )
+
+        return True
+
+    def is_correct_filter(
+        self,
+        hdu_filter,
+        hdu_pupil=None,
+    ):
+        """Check whether a filter/pupil combination matches the band
+
+        Args:
+            hdu_filter: Filter of the observation
+            hdu_pupil: Pupil of the observation. Only used for NIRCam
+        """
+
+        if self.band_type == "nircam":
+            pupil = "CLEAR"
+            jwst_filter = copy.deepcopy(self.band)
+
+            # For some NIRCAM filters, we need to distinguish filter/pupil.
+            # TODO: These may not be unique, so may need editing
+            if self.band in ["F162M", "F164N"]:
+                pupil = copy.deepcopy(self.band)
+                jwst_filter = "F150W2"
+            if self.band == "F323N":
+                pupil = copy.deepcopy(self.band)
+                jwst_filter = "F322W2"
+            if self.band in ["F405N", "F466N", "F470N"]:
+                pupil = copy.deepcopy(self.band)
+                jwst_filter = "F444W"
+
+            return hdu_filter == jwst_filter and hdu_pupil == pupil
+
+        elif self.band_type == "miri":
+            return hdu_filter == self.band
+
+        return False
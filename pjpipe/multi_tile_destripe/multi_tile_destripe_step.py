@@ -13,7 +13,6 @@ import crds
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
-from astropy.stats import sigma_clipped_stats
 from astropy.wcs import WCS
 from jwst.flatfield.flat_field import do_correction
 from mpl_toolkits.axes_grid1 import make_axes_locatable
@@ -24,7 +23,8 @@ from scipy.ndimage import uniform_filter, median_filter
 from stdatamodels.jwst import datamodels
 from tqdm import tqdm
 
-from ..utils import get_dq_bit_mask, make_source_mask, reproject_image, level_data
+from ..utils import get_dq_bit_mask, make_source_mask, reproject_image, level_data, sigma_clipped_stats, \
+    get_sip_header
 
 matplotlib.use("agg")
 matplotlib.rcParams['mathtext.fontset'] = 'stix'
@@ -193,6 +193,7 @@ def parallel_reproject_weight(
         weight_type="exptime",
         do_level_data=True,
         reproject_func="interp",
+        persist_sip_headers=False,
 ):
     """Function to parallelise reprojecting with associated weights
 
@@ -206,6 +207,8 @@ def parallel_reproject_weight(
         do_level_data: Whether to level data or not. Defaults to True
         reproject_func: Which reproject function to use. Defaults to 'interp',
             but can also be 'exact' or 'adaptive'
+        persist_sip_headers: Whether to save FITS SIP headers as sidecar files.
+            Defaults to False
     """
 
     file = files[idx]
@@ -216,6 +219,7 @@ def parallel_reproject_weight(
         optimal_shape=optimal_shape,
         do_level_data=do_level_data,
         reproject_func=reproject_func,
+        persist_sip_headers=persist_sip_headers,
     )
     # Set any bad data to 0
     data_array.array[np.isnan(data_array.array)] = 0
@@ -236,7 +240,8 @@ def parallel_reproject_weight(
             optimal_wcs=optimal_wcs,
             optimal_shape=optimal_shape,
             hdu_type="var_rnoise",
-            reproject_func=reproject_func
+            reproject_func=reproject_func,
+            persist_sip_headers=persist_sip_headers,
         )
         weight_array.array = weight_array.array ** -1
         weight_array.array[np.isnan(weight_array.array)] = 0
@@ -276,7 +281,11 @@ class MultiTileDestripeStep:
             sigma=3,
             dilate_size=7,
             maxiters=None,
+            stack_memory_limit=None,
             reproject_func="interp",
+            use_fast_stats=False,
+            mask_cache_dir=None,
+            persist_sip_headers=False,
             overwrite=False,
     ):
         """Subtracts large-scale stripes using dither information
@@ -326,6 +335,17 @@ class MultiTileDestripeStep:
             sigma: sigma value for sigma-clipped statistics. Defaults to 3
             dilate_size: Dilation size for mask creation. Defaults to 7
             maxiters: Maximum number of sigma-clipping iterations. Defaults to None
+            stack_memory_limit: Approximate memory limit (in GB) for the image stack
+                when weight_method is 'median' or 'sigma_clip'. If set, the stack will be
+                built and averaged in blocks of rows. Defaults to None, which will do the
+                whole image at once
+            use_fast_stats: Whether to use the fast sigma-clipped statistics (see
+                pjpipe.utils.fast_sigma_clipped_stats) rather than astropy's. Defaults to False
+            mask_cache_dir: Directory to cache source masks in. Masks are keyed on the data and masking
+                parameters, so can be shared between steps and re-runs. Defaults to None, which will not
+                cache masks
+            persist_sip_headers: Whether to save FITS SIP approximations to the WCS as .sip.hdr sidecar files,
+                so they can be reused between processes and runs. Defaults to False
             overwrite: Whether to overwrite or not. Defaults
                 to False
         """
@@ -369,7 +389,11 @@ class MultiTileDestripeStep:
         self.sigma = sigma
         self.dilate_size = dilate_size
         self.maxiters = maxiters
+        self.stack_memory_limit = stack_memory_limit
         self.reproject_func = reproject_func
+        self.use_fast_stats = use_fast_stats
+        self.persist_sip_headers = persist_sip_headers
+        self.mask_cache_dir = mask_cache_dir
         self.overwrite = overwrite
 
         self.files_reproj = None
@@ -534,6 +558,7 @@ class MultiTileDestripeStep:
                             weight_type=self.weight_type,
                             do_level_data=True,
                             reproject_func=self.reproject_func,
+                            persist_sip_headers=self.persist_sip_headers,
                         ),
                         range(len(files)),
                     ),
@@ -569,7 +594,11 @@ class MultiTileDestripeStep:
 
             for file in self.files_reproj:
                 with datamodels.open(file) as im:
-                    wcs = im.meta.wcs.to_fits_sip()
+                    wcs = get_sip_header(
+                        im,
+                        file=file,
+                        persist=self.persist_sip_headers,
+                    )
                     w = WCS(wcs)
 
                     indiv_rots.append(get_rotation_angle(w))
@@ -721,7 +750,7 @@ class MultiTileDestripeStep:
                     # If we're not in subarray mode, here we want to level out between amplifiers
                     # for safety
                     if "sub" not in im.meta.subarray.name.lower():
-                        im.data = level_data(im)
+                        im.data = level_data(im, use_fast_stats=self.use_fast_stats)
 
                     im.data[zero_idx] = 0
                     im.data[nan_idx] = np.nan
@@ -789,54 +818,26 @@ class MultiTileDestripeStep:
                 array.array -= correction
                 array.array[zero_idx] = 0
 
-        # First, put the original image in
+        # For the mean, this is weighted
         if self.weight_method == "mean":
             output_array = np.zeros(self.optimal_shape)
-        elif self.weight_method in ["median", "sigma_clip"]:
-            output_array = np.zeros([self.optimal_shape[0], self.optimal_shape[1], len(data)])
-        else:
-            raise ValueError(f"weight_method should be one of {ALLOWED_WEIGHT_METHODS}")
+            output_weights = np.zeros_like(output_array)
 
-        output_weights = np.zeros_like(output_array)
-
-        for i, (array, weight) in enumerate(zip(data, weights)):
-
-            # Put the reprojected data into the array. This will be different depending on
-            # the weight method
-            if self.weight_method == "mean":
+            for array, weight in zip(data, weights):
                 output_array[array.view_in_original_array] += array.array * weight.array
                 output_weights[weight.view_in_original_array] += weight.array
-            elif self.weight_method in ["median", "sigma_clip"]:
-                output_array[array.view_in_original_array[0], array.view_in_original_array[1], i] = array.array
-                output_weights[weight.view_in_original_array[0], weight.view_in_original_array[1], i] = weight.array
-            else:
-                raise ValueError(
-                    f"weight_method should be one of {ALLOWED_WEIGHT_METHODS}"
-                )
 
-        output_array[output_weights == 0] = np.nan
+            output_array[output_weights == 0] = np.nan
 
-        # Now we can calculate the average. For the mean, this is weighted
-        if self.weight_method == "mean":
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
                 data_avg = output_array / output_weights
 
-        # For the median, ignore weights (apart from 0s)
-        elif self.weight_method == "median":
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                data_avg = np.nanmedian(data, axis=-1)
-
-        # Sigma-clipped median (this will ignore weights)
-        elif self.weight_method == "sigma_clip":
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                data_avg = sigma_clipped_stats(output_array,
-                                               sigma=self.sigma,
-                                               maxiters=self.maxiters,
-                                               axis=-1,
-                                               )[1]
+        # For the median and sigma-clipped median, ignore weights (apart from 0s)
+        elif self.weight_method in ["median", "sigma_clip"]:
+            data_avg = self.create_stacked_avg_image(data,
+                                                     weights,
+                                                     )
 
         else:
             raise ValueError(f"weight_method should be one of {ALLOWED_WEIGHT_METHODS}")
@@ -846,6 +847,76 @@ class MultiTileDestripeStep:
 
         return data_avg
 
+    def create_stacked_avg_image(
+            self,
+            data,
+            weights,
+    ):
+        """Create a median or sigma-clipped median image from a bunch of reprojected ones
+
+        Since this needs the full stack of values for each pixel, build this up in
+        blocks of rows to keep within the memory limit
+
+        Args:
+            data: List of data arrays
+            weights: List of weights. Should be same length as data
+        """
+
+        ny, nx = self.optimal_shape
+        n_files = len(data)
+
+        if self.stack_memory_limit is None:
+            block_rows = ny
+        else:
+            # Leave some headroom for temporary arrays in the averaging
+            bytes_per_row = 4 * nx * n_files * np.dtype(float).itemsize
+            block_rows = int(self.stack_memory_limit * 1024 ** 3 // bytes_per_row)
+            block_rows = int(np.clip(block_rows, 1, ny))
+
+        data_avg = np.full(self.optimal_shape, np.nan)
+
+        for j_start in range(0, ny, block_rows):
+            j_end = min(j_start + block_rows, ny)
+
+            block = np.full([j_end - j_start, nx, n_files], np.nan)
+
+            for i, (array, weight) in enumerate(zip(data, weights)):
+
+                # Skip anything that doesn't fall in this block
+                j_min = max(array.jmin, j_start)
+                j_max = min(array.jmax, j_end)
+                if j_max <= j_min:
+                    continue
+
+                array_block = array.array[j_min - array.jmin:j_max - array.jmin, :]
+                weight_block = weight.array[j_min - weight.jmin:j_max - weight.jmin, :]
+
+                block[j_min - j_start:j_max - j_start, array.imin:array.imax, i] = np.where(
+                    weight_block == 0, np.nan, array_block
+                )
+
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+
+                if self.weight_method == "median":
+                    block_avg = np.nanmedian(block, axis=-1)
+                elif self.weight_method == "sigma_clip":
+                    block_avg = sigma_clipped_stats(block,
+                                                    sigma=self.sigma,
+                                                    maxiters=self.maxiters,
+                                                    axis=-1,
+                                                    use_fast_stats=self.use_fast_stats,
+                                                    )[1]
+                else:
+                    raise ValueError(f"weight_method should be one of {ALLOWED_WEIGHT_METHODS}")
+
+            data_avg[j_start:j_end, :] = block_avg
+
+            del block
+            gc.collect()
+
+        return data_avg
+
     def get_data_avg_smooth(self,
                             direction=None,
                             ):
@@ -944,6 +1015,7 @@ class MultiTileDestripeStep:
                 nsigma=self.sigma,
                 dilate_size=self.dilate_size,
                 sigclip_iters=self.maxiters,
+                cache_dir=self.mask_cache_dir,
             )
             mask_neg = make_source_mask(
                 -data,
@@ -951,6 +1023,7 @@ class MultiTileDestripeStep:
                 nsigma=self.sigma,
                 dilate_size=self.dilate_size,
                 sigclip_iters=self.maxiters,
+                cache_dir=self.mask_cache_dir,
             )
         mask = mask_pos | mask_neg
 
@@ -998,7 +1071,7 @@ class MultiTileDestripeStep:
 
                 # If we're not in subarray mode, level everything out
                 else:
-                    model.data = level_data(model)
+                    model.data = level_data(model, use_fast_stats=self.use_fast_stats)
 
                 dq_bit_mask = get_dq_bit_mask(model.dq)
 
@@ -1006,7 +1079,11 @@ class MultiTileDestripeStep:
                 data = copy.deepcopy(model.data)
                 data[dq_bit_mask != 0] = np.nan
 
-                wcs = model.meta.wcs.to_fits_sip()
+                wcs = get_sip_header(
+                    model,
+                    file=file,
+                    persist=self.persist_sip_headers,
+                )
             del model
 
             # Reproject the average image
@@ -1046,6 +1123,7 @@ class MultiTileDestripeStep:
                     sigma=self.sigma,
                     maxiters=self.maxiters,
                     axis=1,
+                    use_fast_stats=self.use_fast_stats,
                 )[1]
 
                 mask = np.isnan(stripes_smooth)
@@ -1073,6 +1151,7 @@ class MultiTileDestripeStep:
                     sigma=self.sigma,
                     maxiters=self.maxiters,
                     axis=0,
+                    use_fast_stats=self.use_fast_stats,
                 )[1]
 
                 # Centre around 0, replace NaNs with nearest value
@@ -1097,6 +1176,7 @@ class MultiTileDestripeStep:
                 sigma=self.sigma,
                 maxiters=self.maxiters,
                 axis=1,
+                use_fast_stats=self.use_fast_stats,
             )[1]
             stripes_x_full[stripes_x_full == 0] = np.nan
 
@@ -1119,6 +1199,7 @@ class MultiTileDestripeStep:
                         sigma=self.sigma,
                         maxiters=self.maxiters,
                         axis=1,
+                        use_fast_stats=self.use_fast_stats,
                     )[1]
                     stripes_x[stripes_x == 0] = np.nan
 
@@ -1,13 +1,16 @@
 import copy
+import glob
 import logging
 import os
 import shutil
 import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from .apply_wcs_adjust import ApplyWCSAdjustStep
 from .astrometric_align import AstrometricAlignStep
 from .astrometric_catalog import AstrometricCatalogStep
 from .download import DownloadStep
+from .fused import FusedStep
 from .gaia_query import GaiaQueryStep
 from .level_match import LevelMatchStep
 from .lv1 import Lv1Step
@@ -61,6 +64,14 @@ COMBINED_BAND_STEPS = [
     "regress_against_previous",
 ]
 
+# Purely per-file steps, which can be run in memory one after the other
+FUSABLE_STEPS = [
+    "lyot_separate",
+    "lyot_mask",
+    "apply_wcs_adjust",
+    "single_tile_destripe",
+]
+
 # .fits extensions and input/output
 # directories
 IN_STEP_EXTS = {
@@ -150,6 +161,16 @@ class PJPipeline:
         self.steps = config["steps"]
         self.version = config["version"]
         self.parameters = config["parameters"]
+
+        # Optionally run consecutive per-file steps in memory
+        if "fuse_steps" in config:
+            self.fuse_steps = config["fuse_steps"]
+        else:
+            self.fuse_steps = False
+        if "save_fused_intermediates" in config:
+            self.save_fused_intermediates = config["save_fused_intermediates"]
+        else:
+            self.save_fused_intermediates = False
         self.raw_dir = local["raw_dir"]
         self.reprocess_dir = os.path.join(
             local["reprocess_dir"],
@@ -178,11 +199,19 @@ class PJPipeline:
             procs = mp.cpu_count()
         self.procs = procs
 
+        # Number of bands to run through per-band steps at once
+        if "concurrent_bands" in local:
+            concurrent_bands = local["concurrent_bands"]
+        else:
+            concurrent_bands = 1
+        self.concurrent_bands = concurrent_bands
+
         # Log the environment variables that should be set
         log.info(f"Using CRDS_SERVER_URL: {os.environ['CRDS_SERVER_URL']}")
         log.info(f"Using CRDS_PATH: {os.environ['CRDS_PATH']}")
         log.info(f"Using CRDS_CONTEXT: {crds_context}")
         log.info(f"Using {self.procs} processes")
+        log.info(f"Running {self.concurrent_bands} bands concurrently")
 
         # Log targets/band/steps out
         log.info("Found targets:")
@@ -203,571 +232,1045 @@ class PJPipeline:
 
             log.info(f"Beginning reprocessing: {target}")
 
-            for step_full in self.steps:
-                # Parse out any potential instrument/observing type specific steps
-                step = None
-                step_instrument = None
-                step_science_type = None
+            # Get a target directory
+            target_dir = os.path.join(
+                self.reprocess_dir,
+                target,
+            )
+
+            for step_group in self.get_step_groups():
+                step = self.parse_step(step_group[0])[0]
 
-                if "." in step_full:
-                    step_split = step_full.split(".")
+                # Some steps operate on all bands, distinguish that here
+                if step in COMBINED_BAND_STEPS:
+                    # Finish off any fused steps before we move on
+                    self.run_all_fused_steps(
+                        target_progress_dict=progress_dict[target],
+                        target_dir=target_dir,
+                    )
 
-                    # First search for sci/bgr
-                    if "bgr" in step_split:
-                        step_science_type = "bgr"
-                        step_split.remove(step_science_type)
-                    if "sci" in step_split:
-                        step_science_type = "sci"
-                        step_split.remove(step_science_type)
+                    self.run_combined_band_step(
+                        target=target,
+                        target_dir=target_dir,
+                        step_full=step_group[0],
+                        target_progress_dict=progress_dict[target],
+                    )
 
-                    step, step_instrument = copy.deepcopy(step_split)
                 else:
-                    step = copy.deepcopy(step_full)
+                    self.run_band_steps(
+                        target=target,
+                        target_dir=target_dir,
+                        step_fulls=step_group,
+                        target_progress_dict=progress_dict[target],
+                    )
+
+            # Finish off any remaining fused steps
+            self.run_all_fused_steps(
+                target_progress_dict=progress_dict[target],
+                target_dir=target_dir,
+            )
+
+    def parse_step(
+        self,
+        step_full,
+    ):
+        """Parse out any potential instrument/observing type specific steps
+
+        Args:
+            step_full: Full step name, e.g. lyot_mask.miri.bgr
+
+        Returns:
+            step, step instrument, and step science type. The latter two are None if not specified
+        """
+
+        step = None
+        step_instrument = None
+        step_science_type = None
+
+        if "." in step_full:
+            step_split = step_full.split(".")
+
+            # First search for sci/bgr
+            if "bgr" in step_split:
+                step_science_type = "bgr"
+                step_split.remove(step_science_type)
+            if "sci" in step_split:
+                step_science_type = "sci"
+                step_split.remove(step_science_type)
+
+            step, step_instrument = copy.deepcopy(step_split)
+        else:
+            step = copy.deepcopy(step_full)
+
+        if step not in ALLOWED_STEPS:
+            raise ValueError(
+                f"step should be one of {ALLOWED_STEPS}, not {step}"
+            )
+
+        return step, step_instrument, step_science_type
+
+    def get_step_groups(self):
+        """Split steps into runs of per-band steps, separated by steps that operate on all bands"""
+
+        step_groups = []
+        for step_full in self.steps:
+            step = self.parse_step(step_full)[0]
+
+            start_new_group = True
+            if len(step_groups) > 0 and step not in COMBINED_BAND_STEPS:
+                prev_step = self.parse_step(step_groups[-1][0])[0]
+                if prev_step not in COMBINED_BAND_STEPS:
+                    start_new_group = False
+
+            if start_new_group:
+                step_groups.append([step_full])
+            else:
+                step_groups[-1].append(step_full)
+
+        return step_groups
+
+    def get_step_parameters(
+        self,
+        step,
+    ):
+        """Get the parameters and default input .fits extension for a step
+
+        Args:
+            step: Step name
+        """
+
+        if step in self.parameters:
+            step_parameters = self.parameters[step]
+        else:
+            step_parameters = {}
+
+        # Get the default in/out .fits extension for this step
+        if step in IN_STEP_EXTS:
+            in_step_ext = IN_STEP_EXTS[step]
+        else:
+            in_step_ext = "cal"
+
+        return step_parameters, in_step_ext
+
+    def run_combined_band_step(
+        self,
+        target,
+        target_dir,
+        step_full,
+        target_progress_dict,
+    ):
+        """Run a step that operates on all bands at once
+
+        Args:
+            target: Target name
+            target_dir: Target directory
+            step_full: Full step name
+            target_progress_dict: Progress dictionary for this target
+        """
+
+        step = self.parse_step(step_full)[0]
+        step_parameters, in_step_ext = self.get_step_parameters(step)
+
+        if not os.path.exists(target_dir):
+            os.makedirs(target_dir)
+
+        log.info(f"Beginning {step}")
+
+        # Download
+        if step == "download":
+            download_dir = os.path.join(
+                self.raw_dir,
+                target,
+            )
+
+            download = DownloadStep(
+                target=target,
+                download_dir=download_dir,
+                procs=self.procs,
+                **step_parameters,
+            )
+            step_result = download.do_step()
 
-                if step not in ALLOWED_STEPS:
-                    raise ValueError(
-                        f"step should be one of {ALLOWED_STEPS}, not {step}"
+        elif step == "gaia_query":
+            gaia_query = GaiaQueryStep(
+                target=target,
+                out_dir=self.alignment_dir,
+                **step_parameters,
+            )
+            step_result = gaia_query.do_step()
+
+        elif step == "get_wcs_adjust":
+            get_wcs_adjust = GetWCSAdjustStep(
+                directory=target_dir,
+                progress_dict=target_progress_dict,
+                target=target,
+                alignment_dir=self.alignment_dir,
+                procs=self.procs,
+                **step_parameters,
+            )
+            step_result = get_wcs_adjust.do_step()
+
+        # anchoring is in the part operating for all bands because
+        # we need more control on the sequence (reference nircam and miri bands first)
+        elif step == "anchoring":
+
+            in_subdir = IN_BAND_DIRS[step]
+            out_subdir = OUT_BAND_DIRS[step]
+
+            anchoring = AnchoringStep(
+                target=target,
+                bands=self.bands,
+                in_dir=target_dir,
+                in_subdir=in_subdir,
+                out_subdir=out_subdir,
+                ref_dir=self.anchor_ref_dir,
+                kernel_dir=self.kernel_dir,
+                in_step_ext=in_step_ext,
+                out_step_ext='i2d_anchor',
+                procs=self.procs,
+                **step_parameters,
+            )
+            step_result = anchoring.do_step()
+
+        elif step == "release":
+            release = ReleaseStep(
+                in_dir=target_dir,
+                out_dir=self.release_dir,
+                target=target,
+                bands=self.bands,
+                procs=self.procs,
+                **step_parameters,
+            )
+            step_result = release.do_step()
+
+        elif step == "regress_against_previous":
+            regress = RegressAgainstPreviousStep(
+                target=target,
+                in_dir=self.release_dir,
+                curr_version=self.version,
+                procs=self.procs,
+                **step_parameters,
+            )
+            step_result = regress.do_step()
+
+        else:
+            raise ValueError(
+                f"step should be one of {ALLOWED_STEPS}, not {step}"
+            )
+
+        # If we're not successful here, log a warning and delete the whole target folder
+        if not step_result:
+            log.warning(
+                f"Failures detected for {target}. "
+                f"Will remove target directory and continue."
+            )
+            shutil.rmtree(target_dir)
+
+        log.info(f"Completed {step}")
+
+    def run_band_steps(
+        self,
+        target,
+        target_dir,
+        step_fulls,
+        target_progress_dict,
+    ):
+        """Run a sequence of per-band steps over all bands
+
+        If concurrent_bands is more than 1, each band's chain of steps will be run in a separate
+        process, with the processors split between them. Otherwise, each step is run for
+        all bands before moving on to the next
+
+        Args:
+            target: Target name
+            target_dir: Target directory
+            step_fulls: List of full step names
+            target_progress_dict: Progress dictionary for this target
+        """
+
+        for band_full in self.bands:
+            if band_full not in target_progress_dict:
+                target_progress_dict[band_full] = {
+                    "success": True,
+                    "data_moved": False,
+                    "dir": None,
+                    "run_astro_cat": False,
+                    "fused_steps": [],
+                }
+
+        concurrent_bands = min(self.concurrent_bands, len(self.bands))
+
+        if concurrent_bands <= 1:
+            for step_full in step_fulls:
+                for band_full in self.bands:
+                    self.run_band_step(
+                        target=target,
+                        target_dir=target_dir,
+                        step_full=step_full,
+                        band_full=band_full,
+                        band_progress_dict=target_progress_dict[band_full],
+                        procs=self.procs,
                     )
+            return
+
+        # Split the processors between the bands we're running at once
+        procs = max(self.procs // concurrent_bands, 1)
+
+        log.info(f"Running {concurrent_bands} bands concurrently, with {procs} processes each")
+
+        # Steps use their own process pools, so these need to be non-daemonic processes
+        with ProcessPoolExecutor(
+            max_workers=concurrent_bands,
+            mp_context=mp.get_context("fork"),
+        ) as executor:
+            futures = {
+                executor.submit(
+                    self.run_band_chain,
+                    target=target,
+                    target_dir=target_dir,
+                    step_fulls=step_fulls,
+                    band_full=band_full,
+                    band_progress_dict=target_progress_dict[band_full],
+                    procs=procs,
+                ): band_full
+                for band_full in self.bands
+            }
+
+            for future in as_completed(futures):
+                target_progress_dict[futures[future]] = future.result()
+
+    def run_band_chain(
+        self,
+        target,
+        target_dir,
+        step_fulls,
+        band_full,
+        band_progress_dict,
+        procs,
+    ):
+        """Run a sequence of steps for a single band
 
-                if step in self.parameters:
-                    step_parameters = self.parameters[step]
-                else:
-                    step_parameters = {}
+        Args:
+            target: Target name
+            target_dir: Target directory
+            step_fulls: List of full step names
+            band_full: Full band name
+            band_progress_dict: Progress dictionary for this band
+            procs: Number of processes for each step to use
+
+        Returns:
+            Updated band progress dictionary
+        """
+
+        for step_full in step_fulls:
+            self.run_band_step(
+                target=target,
+                target_dir=target_dir,
+                step_full=step_full,
+                band_full=band_full,
+                band_progress_dict=band_progress_dict,
+                procs=procs,
+            )
+
+        # Step instances don't come back from this process, so finish any fused steps here
+        band_dir = os.path.join(
+            target_dir,
+            band_full,
+        )
+        self.run_fused_steps(
+            band_progress_dict=band_progress_dict,
+            band_dir=band_dir,
+            procs=procs,
+        )
+
+        return band_progress_dict
+
+    def run_band_step(
+        self,
+        target,
+        target_dir,
+        step_full,
+        band_full,
+        band_progress_dict,
+        procs,
+    ):
+        """Run a step for a single band
+
+        Args:
+            target: Target name
+            target_dir: Target directory
+            step_full: Full step name
+            band_full: Full band name
+            band_progress_dict: Progress dictionary for this band
+            procs: Number of processes for the step to use
+        """
+
+        step, step_instrument, step_science_type = self.parse_step(step_full)
+        step_parameters, in_step_ext = self.get_step_parameters(step)
+
+        if not os.path.exists(target_dir):
+            os.makedirs(target_dir)
+
+        if "bgr" in band_full:
+            is_bgr = True
+            band = band_full.replace("_bgr", "")
+        else:
+            is_bgr = False
+            band = copy.deepcopy(band_full)
+
+        band_dir = os.path.join(
+            target_dir,
+            band_full,
+        )
+
+        # Pull out the band type
+        band_type = get_band_type(band)
+
+        # Pull out whether we will do this step for this particular band
+        # and science type
+        do_step = True
+        if step_instrument is not None:
+            if step_instrument != band_type:
+                do_step = False
+
+        if step_science_type is not None:
+            if is_bgr and step_science_type == "sci":
+                do_step = False
+            if not is_bgr and step_science_type == "bgr":
+                do_step = False
+
+        if not do_step:
+            return
+
+        # If we've failed elsewhere, skip here
+        if not band_progress_dict["success"]:
+            return
+
+        # If we have fused steps waiting and this step can't be fused, run them now
+        if step not in FUSABLE_STEPS:
+            fused_result = self.run_fused_steps(
+                band_progress_dict=band_progress_dict,
+                band_dir=band_dir,
+                procs=procs,
+            )
+            if not fused_result:
+                return
+
+        log.info(f"Beginning {step} for {band_full}")
+
+        # Pull out and make the directories we need
+        in_dir = copy.deepcopy(band_progress_dict["dir"])
+        if in_dir is None:
+            # Pull the in band directory, else default to cal
+            if step in IN_BAND_DIRS:
+                in_band_dir = IN_BAND_DIRS[step]
+            else:
+                in_band_dir = "cal"
+
+            in_dir = os.path.join(
+                band_dir,
+                in_band_dir,
+            )
+
+        # If we need a specific out directory, pull it here.
+        # Else default to the name of the step
+        if step in OUT_BAND_DIRS:
+            out_band_dir = OUT_BAND_DIRS[step]
+        else:
+            out_band_dir = copy.deepcopy(step)
 
-                # Get a target directory
-                target_dir = os.path.join(
-                    self.reprocess_dir,
-                    target,
+        out_dir = os.path.join(
+            band_dir,
+            out_band_dir,
+        )
+
+        if not os.path.exists(in_dir):
+            os.makedirs(in_dir)
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+
+        # Move raw observations
+        if not band_progress_dict["data_moved"]:
+            log.info(f"Moving raw observations for {band_full}")
+
+            if "move_raw_obs" in self.parameters:
+                move_raw_params = self.parameters["move_raw_obs"]
+            else:
+                move_raw_params = {}
+
+            kws = get_kws(
+                parameters=move_raw_params,
+                func=MoveRawObsStep,
+                target=target,
+                band=band,
+                max_level=1,
+            )
+
+            move_raw_obs = MoveRawObsStep(
+                target=target,
+                band=band,
+                step_ext=in_step_ext,
+                in_dir=self.raw_dir,
+                out_dir=in_dir,
+                dr_version=self.version,
+                is_bgr=is_bgr,
+                procs=procs,
+                **kws,
+            )
+            step_result = move_raw_obs.do_step()
+
+            band_progress_dict["success"] = copy.deepcopy(
+                step_result
+            )
+
+            # If we're not successful here, log a warning and delete the band folder,
+            # and move on
+            if not band_progress_dict["success"]:
+                log.warning(
+                    f"Failures detected moving raw data for {target}, {band}. "
+                    f"Removing directories and continuing"
                 )
-                if not os.path.exists(target_dir):
-                    os.makedirs(target_dir)
+                shutil.rmtree(out_dir)
+                return
+
+            # Save out file moved state
+            band_progress_dict["data_moved"] = True
+
+            log.info(f"Moved raw observations for {band_full}")
+
+        # Level 1 processing
+        if step == "lv1":
+            kws = get_kws(
+                parameters=step_parameters,
+                func=Lv1Step,
+                target=target,
+                band=band,
+                max_level=0,
+            )
 
-                # Get the default in/out .fits extension for this step
-                if step in IN_STEP_EXTS:
-                    in_step_ext = IN_STEP_EXTS[step]
-                else:
-                    in_step_ext = "cal"
+            lv1 = Lv1Step(
+                target=target,
+                band=band,
+                in_dir=in_dir,
+                out_dir=out_dir,
+                dr_version=self.version,
+                step_ext=in_step_ext,
+                procs=procs,
+                is_bgr=is_bgr,
+                **kws,
+            )
+            step_result = lv1.do_step()
+
+        # Level 2 processing
+        elif step == "lv2":
+            kws = get_kws(
+                parameters=step_parameters,
+                func=Lv2Step,
+                target=target,
+                band=band,
+                max_level=0,
+            )
 
-                # Some steps operate on all bands, distinguish that here
-                if step in COMBINED_BAND_STEPS:
-                    log.info(f"Beginning {step}")
-
-                    # Download
-                    if step == "download":
-                        download_dir = os.path.join(
-                            self.raw_dir,
-                            target,
-                        )
-
-                        download = DownloadStep(
-                            target=target,
-                            download_dir=download_dir,
-                            procs=self.procs,
-                            **step_parameters,
-                        )
-                        step_result = download.do_step()
-
-                    elif step == "gaia_query":
-                        gaia_query = GaiaQueryStep(
-                            target=target,
-                            out_dir=self.alignment_dir,
-                            **step_parameters,
-                        )
-                        step_result = gaia_query.do_step()
-
-                    elif step == "get_wcs_adjust":
-                        get_wcs_adjust = GetWCSAdjustStep(
-                            directory=target_dir,
-                            progress_dict=progress_dict[target],
-                            target=target,
-                            alignment_dir=self.alignment_dir,
-                            procs=self.procs,
-                            **step_parameters,
-                        )
-                        step_result = get_wcs_adjust.do_step()
-
-                    # anchoring is in the part operating for all bands because
-                    # we need more control on the sequence (reference nircam and miri bands first)
-                    elif step == "anchoring":
-
-                        in_subdir = IN_BAND_DIRS[step]
-                        out_subdir = OUT_BAND_DIRS[step]
-
-                        anchoring = AnchoringStep(
-                            target=target,
-                            bands=self.bands,
-                            in_dir=target_dir,
-                            in_subdir=in_subdir,
-                            out_subdir=out_subdir,
-                            ref_dir=self.anchor_ref_dir,
-                            kernel_dir=self.kernel_dir,
-                            in_step_ext=in_step_ext,
-                            out_step_ext='i2d_anchor',
-                            procs=self.procs,
-                            **step_parameters,
-                        )
-                        step_result = anchoring.do_step()
-
-                    elif step == "release":
-                        release = ReleaseStep(
-                            in_dir=target_dir,
-                            out_dir=self.release_dir,
-                            target=target,
-                            bands=self.bands,
-                            **step_parameters,
-                        )
-                        step_result = release.do_step()
-
-                    elif step == "regress_against_previous":
-                        regress = RegressAgainstPreviousStep(
-                            target=target,
-                            in_dir=self.release_dir,
-                            curr_version=self.version,
-                            **step_parameters,
-                        )
-                        step_result = regress.do_step()
-
-                    else:
-                        raise ValueError(
-                            f"step should be one of {ALLOWED_STEPS}, not {step}"
-                        )
-
-                    # If we're not successful here, log a warning and delete the whole target folder
-                    if not step_result:
-                        log.warning(
-                            f"Failures detected for {target}. "
-                            f"Will remove target directory and continue."
-                        )
-                        shutil.rmtree(target_dir)
-
-                    log.info(f"Completed {step}")
+            lv2 = Lv2Step(
+                target=target,
+                band=band,
+                in_dir=in_dir,
+                out_dir=out_dir,
+                dr_version=self.version,
+                step_ext=in_step_ext,
+                is_bgr=is_bgr,
+                procs=procs,
+                **kws,
+            )
+            step_result = lv2.do_step()
+
+        elif step == "single_tile_destripe":
+            kws = get_kws(
+                parameters=step_parameters,
+                func=SingleTileDestripeStep,
+                target=target,
+                band=band,
+            )
 
+            # If we're going from lv1, then this will be a rate file,
+            # otherwise a cal
+            if os.path.split(in_dir)[-1] == "lv1":
+                in_step_ext = "rate"
+
+            destripe = SingleTileDestripeStep(
+                in_dir=in_dir,
+                out_dir=out_dir,
+                step_ext=in_step_ext,
+                procs=procs,
+                **kws,
+            )
+            step_result = self.run_or_fuse_step(
+                step_instance=destripe,
+                step=step,
+                band_progress_dict=band_progress_dict,
+                band_dir=band_dir,
+                procs=procs,
+            )
+
+        elif step == "lyot_mask":
+            kws = get_kws(
+                parameters=step_parameters,
+                func=LyotMaskStep,
+                target=target,
+                band=band,
+            )
+
+            lyot_mask = LyotMaskStep(
+                in_dir=in_dir,
+                out_dir=out_dir,
+                step_ext=in_step_ext,
+                procs=procs,
+                **kws,
+            )
+            step_result = self.run_or_fuse_step(
+                step_instance=lyot_mask,
+                step=step,
+                band_progress_dict=band_progress_dict,
+                band_dir=band_dir,
+                procs=procs,
+            )
+
+        elif step == "lyot_separate":
+            kws = get_kws(
+                parameters=step_parameters,
+                func=LyotSeparateStep,
+                target=target,
+                band=band,
+            )
+
+            lyot_separate = LyotSeparateStep(
+                in_dir=in_dir,
+                out_dir=out_dir,
+                step_ext=in_step_ext,
+                procs=procs,
+                **kws,
+            )
+            step_result = self.run_or_fuse_step(
+                step_instance=lyot_separate,
+                step=step,
+                band_progress_dict=band_progress_dict,
+                band_dir=band_dir,
+                procs=procs,
+            )
+
+        elif step == "multi_tile_destripe":
+            kws = get_kws(
+                parameters=step_parameters,
+                func=MultiTileDestripeStep,
+                target=target,
+                band=band,
+            )
+
+            multi_tile_destripe = MultiTileDestripeStep(
+                in_dir=in_dir,
+                out_dir=out_dir,
+                step_ext=in_step_ext,
+                procs=procs,
+                **kws,
+            )
+            step_result = multi_tile_destripe.do_step()
+
+        elif step == "apply_wcs_adjust":
+            kws = get_kws(
+                parameters=step_parameters,
+                func=ApplyWCSAdjustStep,
+                target=target,
+                band=band,
+            )
+
+            wcs_adjust_file = os.path.join(
+                target_dir,
+                f"{target}_wcs_adjust.toml",
+            )
+            wcs_adjust = load_toml(wcs_adjust_file)
+
+            apply_wcs = ApplyWCSAdjustStep(
+                wcs_adjust=wcs_adjust,
+                in_dir=in_dir,
+                out_dir=out_dir,
+                step_ext=in_step_ext,
+                procs=procs,
+                **kws,
+            )
+            step_result = self.run_or_fuse_step(
+                step_instance=apply_wcs,
+                step=step,
+                band_progress_dict=band_progress_dict,
+                band_dir=band_dir,
+                procs=procs,
+            )
+
+        elif step == "level_match":
+            kws = get_kws(
+                parameters=step_parameters,
+                func=LevelMatchStep,
+                target=target,
+                band=band,
+            )
+
+            level_match = LevelMatchStep(
+                in_dir=in_dir,
+                out_dir=out_dir,
+                step_ext=in_step_ext,
+                procs=procs,
+                band=band,
+                **kws,
+            )
+            step_result = level_match.do_step()
+
+        elif step == "psf_model":
+            kws = get_kws(
+                parameters=step_parameters,
+                func=PSFModelStep,
+                target=target,
+                band=band,
+            )
+
+            psf_model = PSFModelStep(
+                in_dir=in_dir,
+                out_dir=out_dir,
+                step_ext=in_step_ext,
+                procs=procs,
+                **kws,
+            )
+            step_result = psf_model.do_step()
+
+        elif step == "lv3":
+            kws = get_kws(
+                parameters=step_parameters,
+                func=Lv3Step,
+                target=target,
+                band=band,
+                max_level=0,
+            )
+
+            lv3 = Lv3Step(
+                target=target,
+                band=band,
+                in_dir=in_dir,
+                out_dir=out_dir,
+                dr_version=self.version,
+                is_bgr=is_bgr,
+                step_ext=in_step_ext,
+                procs=procs,
+                **kws,
+            )
+            step_result = lv3.do_step()
+
+        elif step == "astrometric_catalog":
+            kws = get_kws(
+                parameters=step_parameters,
+                func=AstrometricCatalogStep,
+                target=target,
+                band=band,
+                max_level=0,
+            )
+
+            astrometric_catalog = AstrometricCatalogStep(
+                target=target, band=band, in_dir=in_dir, **kws
+            )
+            step_result = astrometric_catalog.do_step()
+
+            band_progress_dict["run_astro_cat"] = True
+
+        elif step == "astrometric_align":
+            # If we've run the astrometric catalog step, track
+            # that here
+            run_astro_cat = copy.deepcopy(
+                band_progress_dict["run_astro_cat"]
+            )
+
+            kws = get_kws(
+                parameters=step_parameters,
+                func=AstrometricAlignStep,
+                target=target,
+                band=band,
+                max_level=0,
+            )
+
+            astrometric_catalog = AstrometricAlignStep(
+                target=target,
+                band=band,
+                target_dir=target_dir,
+                in_dir=in_dir,
+                is_bgr=is_bgr,
+                catalog_dir=self.alignment_dir,
+                run_astro_cat=run_astro_cat,
+                step_ext=in_step_ext,
+                procs=procs,
+                **kws,
+            )
+            step_result = astrometric_catalog.do_step()
+
+        elif step == "mosaic_individual_fields":
+            # Here, the input directory should be level 3
+            mosaic_in_dir = os.path.join(
+                band_dir,
+                "lv3",
+            )
+
+            kws = get_kws(
+                parameters=step_parameters,
+                func=MosaicIndividualFieldsStep,
+                target=target,
+                band=band,
+                max_level=0,
+            )
+
+            mosaic_individual_fields = MosaicIndividualFieldsStep(
+                target=target,
+                band=band,
+                in_dir=mosaic_in_dir,
+                out_dir=out_dir,
+                procs=procs,
+                **kws,
+            )
+            step_result = mosaic_individual_fields.do_step()
+
+        elif step == "psf_matching":
+
+            psf_matching = PSFMatchingStep(
+                target=target,
+                band=band,
+                in_dir=in_dir,
+                out_dir=out_dir,
+                kernel_dir=self.kernel_dir,
+                in_step_ext=in_step_ext,
+                procs=procs,
+                **step_parameters,
+            )
+            step_result = psf_matching.do_step()
+
+        else:
+            raise ValueError(
+                f"step should be one of {ALLOWED_STEPS}, not {step}"
+            )
+
+        band_progress_dict["success"] = copy.deepcopy(
+            step_result
+        )
+        band_progress_dict["dir"] = copy.deepcopy(out_dir)
+
+        # If we're not successful here, log a warning and delete the band folder
+        if not band_progress_dict["success"]:
+            log.warning(
+                f"Failures detected in step {step} for {target}, {band_full}. "
+                f"Removing folder and continuing"
+            )
+            if os.path.exists(band_dir):
+                shutil.rmtree(band_dir)
+
+        log.info(f"Completed {step} for {band_full}")
+
+
+    def is_fusable_step(
+        self,
+        step_instance,
+        step,
+    ):
+        """Check whether a step can be queued up to run fused with its neighbours
+
+        Args:
+            step_instance: Instance of the step
+            step: Name of the step
+        """
+
+        if not self.fuse_steps or step not in FUSABLE_STEPS:
+            return False
+
+        # Overlap lyot masking needs all the files at once
+        if step == "lyot_mask" and step_instance.method != "mask":
+            return False
+
+        # Incremental runs need to track each step's inputs, so run those separately
+        if getattr(step_instance, "incremental", False):
+            return False
+
+        return True
+
+    def run_or_fuse_step(
+        self,
+        step_instance,
+        step,
+        band_progress_dict,
+        band_dir,
+        procs,
+    ):
+        """Either run a per-file step, or queue it up to run fused with its neighbours
+
+        Args:
+            step_instance: Instance of the step
+            step: Name of the step
+            band_progress_dict: Progress dictionary for this band
+            band_dir: Band directory, which will be removed on failure
+            procs: Number of processes to use for any queued fused steps
+        """
+
+        if not self.is_fusable_step(step_instance, step):
+            # Any queued steps produce this step's input, so run them first
+            fused_result = self.run_fused_steps(
+                band_progress_dict=band_progress_dict,
+                band_dir=band_dir,
+                procs=procs,
+            )
+            if not fused_result:
+                return False
+
+            step_result = step_instance.do_step()
+
+            # If an incremental run has changed anything, later steps are out of date
+            if getattr(step_instance, "files_changed", False):
+                self.remove_later_step_complete_files(
+                    step=step,
+                    band_dir=band_dir,
+                )
+
+            return step_result
+
+        log.info(f"Queueing {step} to run fused")
+        band_progress_dict["fused_steps"].append((step, step_instance))
+
+        return True
+
+    def remove_later_step_complete_files(
+        self,
+        step,
+        band_dir,
+    ):
+        """Remove the step complete files for every step after this one, so they will be rerun
+
+        Steps that combine all bands will also be rerun, since they include this band
+
+        Args:
+            step: Name of the step
+            band_dir: Band directory
+        """
+
+        target_dir = os.path.dirname(band_dir)
+        target = os.path.split(target_dir)[-1]
+
+        step_names = [self.parse_step(step_full)[0] for step_full in self.steps]
+        later_steps = step_names[step_names.index(step) + 1:]
+
+        for later_step in later_steps:
+            # These don't depend on the reduced data
+            if later_step in ["download", "gaia_query"]:
+                continue
+
+            if later_step == "regress_against_previous":
+                step_complete_files = glob.glob(
+                    os.path.join(
+                        self.release_dir,
+                        "*",
+                        f"{target}_regress_against_previous_step_complete.txt",
+                    )
+                )
+            elif later_step in COMBINED_BAND_STEPS:
+                step_complete_files = [
+                    os.path.join(
+                        target_dir,
+                        f"{later_step}_step_complete.txt",
+                    )
+                ]
+            else:
+                if later_step in OUT_BAND_DIRS:
+                    out_band_dir = OUT_BAND_DIRS[later_step]
                 else:
-                    for band_full in self.bands:
-                        if "bgr" in band_full:
-                            is_bgr = True
-                            band = band_full.replace("_bgr", "")
-                        else:
-                            is_bgr = False
-                            band = copy.deepcopy(band_full)
-
-                        band_dir = os.path.join(
-                            target_dir,
-                            band_full,
-                        )
-
-                        if band_full not in progress_dict[target]:
-                            progress_dict[target][band_full] = {
-                                "success": True,
-                                "data_moved": False,
-                                "dir": None,
-                                "run_astro_cat": False,
-                            }
-
-                        # Pull out the band type
-                        band_type = get_band_type(band)
-
-                        # Pull out whether we will do this step for this particular band
-                        # and science type
-                        do_step = True
-                        if step_instrument is not None:
-                            if step_instrument != band_type:
-                                do_step = False
-
-                        if step_science_type is not None:
-                            if is_bgr and step_science_type == "sci":
-                                do_step = False
-                            if not is_bgr and step_science_type == "bgr":
-                                do_step = False
-
-                        if not do_step:
-                            continue
-
-                        # If we've failed elsewhere, skip here
-                        if not progress_dict[target][band_full]["success"]:
-                            continue
-
-                        log.info(f"Beginning {step} for {band_full}")
-
-                        # Pull out and make the directories we need
-                        in_dir = copy.deepcopy(progress_dict[target][band_full]["dir"])
-                        if in_dir is None:
-                            # Pull the in band directory, else default to cal
-                            if step in IN_BAND_DIRS:
-                                in_band_dir = IN_BAND_DIRS[step]
-                            else:
-                                in_band_dir = "cal"
-
-                            in_dir = os.path.join(
-                                band_dir,
-                                in_band_dir,
-                            )
-
-                        # If we need a specific out directory, pull it here.
-                        # Else default to the name of the step
-                        if step in OUT_BAND_DIRS:
-                            out_band_dir = OUT_BAND_DIRS[step]
-                        else:
-                            out_band_dir = copy.deepcopy(step)
-
-                        out_dir = os.path.join(
-                            band_dir,
-                            out_band_dir,
-                        )
-
-                        if not os.path.exists(in_dir):
-                            os.makedirs(in_dir)
-                        if not os.path.exists(out_dir):
-                            os.makedirs(out_dir)
-
-                        # Move raw observations
-                        if not progress_dict[target][band_full]["data_moved"]:
-                            log.info(f"Moving raw observations for {band_full}")
-
-                            if "move_raw_obs" in self.parameters:
-                                move_raw_params = self.parameters["move_raw_obs"]
-                            else:
-                                move_raw_params = {}
-
-                            kws = get_kws(
-                                parameters=move_raw_params,
-                                func=MoveRawObsStep,
-                                target=target,
-                                band=band,
-                                max_level=1,
-                            )
-
-                            move_raw_obs = MoveRawObsStep(
-                                target=target,
-                                band=band,
-                                step_ext=in_step_ext,
-                                in_dir=self.raw_dir,
-                                out_dir=in_dir,
-                                dr_version=self.version,
-                                is_bgr=is_bgr,
-                                **kws,
-                            )
-                            step_result = move_raw_obs.do_step()
-
-                            progress_dict[target][band_full]["success"] = copy.deepcopy(
-                                step_result
-                            )
-
-                            # If we're not successful here, log a warning and delete the band folder,
-                            # and move on
-                            if not progress_dict[target][band_full]["success"]:
-                                log.warning(
-                                    f"Failures detected moving raw data for {target}, {band}. "
-                                    f"Removing directories and continuing"
-                                )
-                                shutil.rmtree(out_dir)
-                                continue
-
-                            # Save out file moved state
-                            progress_dict[target][band_full]["data_moved"] = True
-
-                            log.info(f"Moved raw observations for {band_full}")
-
-                        # Level 1 processing
-                        if step == "lv1":
-                            kws = get_kws(
-                                parameters=step_parameters,
-                                func=Lv1Step,
-                                target=target,
-                                band=band,
-                                max_level=0,
-                            )
-
-                            lv1 = Lv1Step(
-                                target=target,
-                                band=band,
-                                in_dir=in_dir,
-                                out_dir=out_dir,
-                                dr_version=self.version,
-                                step_ext=in_step_ext,
-                                procs=self.procs,
-                                is_bgr=is_bgr,
-                                **kws,
-                            )
-                            step_result = lv1.do_step()
-
-                        # Level 2 processing
-                        elif step == "lv2":
-                            kws = get_kws(
-                                parameters=step_parameters,
-                                func=Lv2Step,
-                                target=target,
-                                band=band,
-                                max_level=0,
-                            )
-
-                            lv2 = Lv2Step(
-                                target=target,
-                                band=band,
-                                in_dir=in_dir,
-                                out_dir=out_dir,
-                                dr_version=self.version,
-                                step_ext=in_step_ext,
-                                is_bgr=is_bgr,
-                                procs=self.procs,
-                                **kws,
-                            )
-                            step_result = lv2.do_step()
-
-                        elif step == "single_tile_destripe":
-                            kws = get_kws(
-                                parameters=step_parameters,
-                                func=SingleTileDestripeStep,
-                                target=target,
-                                band=band,
-                            )
-
-                            # If we're going from lv1, then this will be a rate file,
-                            # otherwise a cal
-                            if os.path.split(in_dir)[-1] == "lv1":
-                                in_step_ext = "rate"
-
-                            destripe = SingleTileDestripeStep(
-                                in_dir=in_dir,
-                                out_dir=out_dir,
-                                step_ext=in_step_ext,
-                                procs=self.procs,
-                                **kws,
-                            )
-                            step_result = destripe.do_step()
-
-                        elif step == "lyot_mask":
-                            kws = get_kws(
-                                parameters=step_parameters,
-                                func=LyotMaskStep,
-                                target=target,
-                                band=band,
-                            )
-
-                            lyot_mask = LyotMaskStep(
-                                in_dir=in_dir,
-                                out_dir=out_dir,
-                                step_ext=in_step_ext,
-                                procs=self.procs,
-                                **kws,
-                            )
-                            step_result = lyot_mask.do_step()
-
-                        elif step == "lyot_separate":
-                            kws = get_kws(
-                                parameters=step_parameters,
-                                func=LyotSeparateStep,
-                                target=target,
-                                band=band,
-                            )
-
-                            lyot_separate = LyotSeparateStep(
-                                in_dir=in_dir,
-                                out_dir=out_dir,
-                                step_ext=in_step_ext,
-                                procs=self.procs,
-                                **kws,
-                            )
-                            step_result = lyot_separate.do_step()
-
-                        elif step == "multi_tile_destripe":
-                            kws = get_kws(
-                                parameters=step_parameters,
-                                func=MultiTileDestripeStep,
-                                target=target,
-                                band=band,
-                            )
-
-                            multi_tile_destripe = MultiTileDestripeStep(
-                                in_dir=in_dir,
-                                out_dir=out_dir,
-                                step_ext=in_step_ext,
-                                procs=self.procs,
-                                **kws,
-                            )
-                            step_result = multi_tile_destripe.do_step()
-
-                        elif step == "apply_wcs_adjust":
-                            kws = get_kws(
-                                parameters=step_parameters,
-                                func=ApplyWCSAdjustStep,
-                                target=target,
-                                band=band,
-                            )
-
-                            wcs_adjust_file = os.path.join(
-                                target_dir,
-                                f"{target}_wcs_adjust.toml",
-                            )
-                            wcs_adjust = load_toml(wcs_adjust_file)
-
-                            apply_wcs = ApplyWCSAdjustStep(
-                                wcs_adjust=wcs_adjust,
-                                in_dir=in_dir,
-                                out_dir=out_dir,
-                                step_ext=in_step_ext,
-                                procs=self.procs,
-                                **kws,
-                            )
-                            step_result = apply_wcs.do_step()
-
-                        elif step == "level_match":
-                            kws = get_kws(
-                                parameters=step_parameters,
-                                func=LevelMatchStep,
-                                target=target,
-                                band=band,
-                            )
-
-                            level_match = LevelMatchStep(
-                                in_dir=in_dir,
-                                out_dir=out_dir,
-                                step_ext=in_step_ext,
-                                procs=self.procs,
-                                band=band,
-                                **kws,
-                            )
-                            step_result = level_match.do_step()
-
-                        elif step == "psf_model":
-                            kws = get_kws(
-                                parameters=step_parameters,
-                                func=PSFModelStep,
-                                target=target,
-                                band=band,
-                            )
-
-                            psf_model = PSFModelStep(
-                                in_dir=in_dir,
-                                out_dir=out_dir,
-                                step_ext=in_step_ext,
-                                procs=self.procs,
-                                **kws,
-                            )
-                            step_result = psf_model.do_step()
-
-                        elif step == "lv3":
-                            kws = get_kws(
-                                parameters=step_parameters,
-                                func=Lv3Step,
-                                target=target,
-                                band=band,
-                                max_level=0,
-                            )
-
-                            lv3 = Lv3Step(
-                                target=target,
-                                band=band,
-                                in_dir=in_dir,
-                                out_dir=out_dir,
-                                dr_version=self.version,
-                                is_bgr=is_bgr,
-                                step_ext=in_step_ext,
-                                procs=self.procs,
-                                **kws,
-                            )
-                            step_result = lv3.do_step()
-
-                        elif step == "astrometric_catalog":
-                            kws = get_kws(
-                                parameters=step_parameters,
-                                func=AstrometricCatalogStep,
-                                target=target,
-                                band=band,
-                                max_level=0,
-                            )
-
-                            astrometric_catalog = AstrometricCatalogStep(
-                                target=target, band=band, in_dir=in_dir, **kws
-                            )
-                            step_result = astrometric_catalog.do_step()
-
-                            progress_dict[target][band_full]["run_astro_cat"] = True
-
-                        elif step == "astrometric_align":
-                            # If we've run the astrometric catalog step, track
-                            # that here
-                            run_astro_cat = copy.deepcopy(
-                                progress_dict[target][band_full]["run_astro_cat"]
-                            )
-
-                            kws = get_kws(
-                                parameters=step_parameters,
-                                func=AstrometricAlignStep,
-                                target=target,
-                                band=band,
-                                max_level=0,
-                            )
-
-                            astrometric_catalog = AstrometricAlignStep(
-                                target=target,
-                                band=band,
-                                target_dir=target_dir,
-                                in_dir=in_dir,
-                                is_bgr=is_bgr,
-                                catalog_dir=self.alignment_dir,
-                                run_astro_cat=run_astro_cat,
-                                step_ext=in_step_ext,
-                                procs=self.procs,
-                                **kws,
-                            )
-                            step_result = astrometric_catalog.do_step()
-
-                        elif step == "mosaic_individual_fields":
-                            # Here, the input directory should be level 3
-                            mosaic_in_dir = os.path.join(
-                                band_dir,
-                                "lv3",
-                            )
-
-                            kws = get_kws(
-                                parameters=step_parameters,
-                                func=MosaicIndividualFieldsStep,
-                                target=target,
-                                band=band,
-                                max_level=0,
-                            )
-
-                            mosaic_individual_fields = MosaicIndividualFieldsStep(
-                                target=target,
-                                band=band,
-                                in_dir=mosaic_in_dir,
-                                out_dir=out_dir,
-                                procs=self.procs,
-                                **kws,
-                            )
-                            step_result = mosaic_individual_fields.do_step()
-
-                        elif step == "psf_matching":
-
-                            psf_matching = PSFMatchingStep(
-                                target=target,
-                                band=band,
-                                in_dir=in_dir,
-                                out_dir=out_dir,
-                                kernel_dir=self.kernel_dir,
-                                in_step_ext=in_step_ext,
-                                procs=self.procs,
-                                **step_parameters,
-                            )
-                            step_result = psf_matching.do_step()
-
-                        else:
-                            raise ValueError(
-                                f"step should be one of {ALLOWED_STEPS}, not {step}"
-                            )
-
-                        progress_dict[target][band_full]["success"] = copy.deepcopy(
-                            step_result
-                        )
-                        progress_dict[target][band_full]["dir"] = copy.deepcopy(out_dir)
-
-                        # If we're not successful here, log a warning and delete the band folder
-                        if not progress_dict[target][band_full]["success"]:
-                            log.warning(
-                                f"Failures detected in step {step} for {target}, {band_full}. "
-                                f"Removing folder and continuing"
-                            )
-                            shutil.rmtree(band_dir)
-
-                        log.info(f"Completed {step} for {band_full}")
+                    out_band_dir = copy.deepcopy(later_step)
+
+                step_complete_files = [
+                    os.path.join(
+                        band_dir,
+                        out_band_dir,
+                        f"{later_step}_step_complete.txt",
+                    )
+                ]
+
+            for step_complete_file in step_complete_files:
+                if os.path.exists(step_complete_file):
+                    log.info(f"Files changed in {step}, will rerun {later_step}")
+                    os.remove(step_complete_file)
+
+    def run_fused_steps(
+        self,
+        band_progress_dict,
+        band_dir,
+        procs=None,
+    ):
+        """Run any queued fused steps for a band
+
+        Args:
+            band_progress_dict: Progress dictionary for this band
+            band_dir: Band directory, which will be removed on failure
+            procs: Number of processes to use. Defaults to None, which
+                will use all available processes
+        """
+
+        if procs is None:
+            procs = self.procs
+
+        fused_steps = band_progress_dict["fused_steps"]
+        if len(fused_steps) == 0:
+            return True
+
+        band_progress_dict["fused_steps"] = []
+
+        step_names = [fused_step[0] for fused_step in fused_steps]
+        step_instances = [fused_step[1] for fused_step in fused_steps]
+
+        log.info(f"Beginning fused steps {', '.join(step_names)}")
+
+        if len(step_instances) == 1:
+            step_result = step_instances[0].do_step()
+        else:
+            fused = FusedStep(
+                steps=step_instances,
+                step_names=step_names,
+                in_dir=step_instances[0].in_dir,
+                step_ext=step_instances[0].step_ext,
+                procs=procs,
+                save_intermediate=self.save_fused_intermediates,
+            )
+            step_result = fused.do_step()
+
+        band_progress_dict["success"] = copy.deepcopy(step_result)
+
+        # If we're not successful here, log a warning and delete the band folder
+        if not step_result:
+            log.warning(
+                f"Failures detected in fused steps {', '.join(step_names)}. "
+                f"Removing folder and continuing"
+            )
+            shutil.rmtree(band_dir)
+            return False
+
+        log.info(f"Completed fused steps {', '.join(step_names)}")
+
+        return True
+
+    def run_all_fused_steps(
+        self,
+        target_progress_dict,
+        target_dir,
+    ):
+        """Run any queued fused steps for all bands in a target
+
+        Args:
+            target_progress_dict: Progress dictionary for this target
+            target_dir: Target directory
+        """
+
+        for band_full in target_progress_dict:
+            band_dir = os.path.join(
+                target_dir,
+                band_full,
+            )
+            self.run_fused_steps(
+                band_progress_dict=target_progress_dict[band_full],
+                band_dir=band_dir,
+            )
@@ -1,10 +1,15 @@
 import copy
 import gc
 import glob
+import hashlib
+import json
 import logging
+import multiprocessing as mp
 import os
 import shutil
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import astropy.units as u
 import matplotlib
@@ -12,6 +17,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import webbpsf
 from astropy.coordinates import SkyCoord
+from astropy.io import fits
 from astropy.stats import sigma_clipped_stats
 from astropy.wcs import WCS
 from lmfit import minimize, Parameters, fit_report
@@ -19,8 +25,10 @@ from photutils.centroids import centroid_com
 from photutils.segmentation import detect_sources
 from scipy.ndimage import shift
 from stdatamodels.jwst import datamodels
+from threadpoolctl import threadpool_limits
+from tqdm import tqdm
 
-from ..utils import get_dq_bit_mask, make_source_mask
+from ..utils import get_dq_bit_mask, make_source_mask, get_sip_header
 
 matplotlib.use("agg")
 log = logging.getLogger("stpipe")
@@ -28,6 +36,16 @@ log.addHandler(logging.NullHandler())
 
 ALLOWED_METHODS = ["replace", "subtract"]
 
+# Maximum shift (in pixels) of the source centre when fitting
+MAX_CEN_SHIFT = 5
+
+# Padding (in pixels) around PSF cutouts
+CUTOUT_PAD = 3
+
+# Header keywords that define the PSF for an observation
+PSF_CACHE_KEYWORDS = ["INSTRUME", "DETECTOR", "FILTER", "PUPIL", "APERNAME"]
+PSF_CACHE_INDEX = "index.json"
+
 
 def get_sat_mask(dq):
     """Get mask of saturated values from DQ array
@@ -44,14 +62,107 @@ def get_sat_mask(dq):
     return sat_mask
 
 
+def get_cutout_slice(
+        x_cen,
+        y_cen,
+        psf_shape,
+        psf_x_cen,
+        psf_y_cen,
+        data_shape,
+        max_shift=MAX_CEN_SHIFT,
+        pad=CUTOUT_PAD,
+):
+    """Get the slice for a cutout big enough to hold a PSF around a source
+
+    The cutout is sized so that the PSF footprint is fully included, wherever the
+    centre moves to within the allowed bounds of the fit
+
+    Args:
+        x_cen: Initial guess for the x centre of the source
+        y_cen: Initial guess for the y centre of the source
+        psf_shape: Shape of the PSF array
+        psf_x_cen: x centroid of the PSF
+        psf_y_cen: y centroid of the PSF
+        data_shape: Shape of the full data array
+        max_shift: Maximum shift of the centre in the fit. Defaults to MAX_CEN_SHIFT
+        pad: Extra padding around the cutout. Defaults to CUTOUT_PAD
+    """
+
+    y_start = int(np.floor(y_cen - max_shift - psf_y_cen)) - pad
+    y_end = int(np.ceil(y_cen + max_shift - psf_y_cen)) + psf_shape[0] + pad
+    x_start = int(np.floor(x_cen - max_shift - psf_x_cen)) - pad
+    x_end = int(np.ceil(x_cen + max_shift - psf_x_cen)) + psf_shape[1] + pad
+
+    y_start = min(max(y_start, 0), data_shape[0])
+    y_end = min(max(y_end, 0), data_shape[0])
+    x_start = min(max(x_start, 0), data_shape[1])
+    x_end = min(max(x_end, 0), data_shape[1])
+
+    return slice(y_start, y_end), slice(x_start, x_end)
+
+
+def shift_psf(
+        psf,
+        x_pos,
+        y_pos,
+        psf_x_cen,
+        psf_y_cen,
+        shape,
+        pad=CUTOUT_PAD,
+):
+    """Place a PSF into an array, with its centroid at a given position
+
+    Only the sub-pixel part of the shift is interpolated, on a (padded)
+    PSF-sized array. The integer part is done by placing the PSF into the
+    output array, so this is much cheaper than shifting the full output
+    array
+
+    Args:
+        psf: PSF array
+        x_pos: x position to move the PSF centroid to
+        y_pos: y position to move the PSF centroid to
+        psf_x_cen: x centroid of the PSF
+        psf_y_cen: y centroid of the PSF
+        shape: Shape of the output array
+        pad: Padding around the PSF before interpolating. Defaults to CUTOUT_PAD
+    """
+
+    x_shift = x_pos - psf_x_cen
+    y_shift = y_pos - psf_y_cen
+
+    x_int = int(np.floor(x_shift))
+    y_int = int(np.floor(y_shift))
+
+    psf_pad = np.pad(psf, pad)
+    psf_pad = shift(psf_pad, shift=[y_shift - y_int, x_shift - x_int])
+
+    model = np.zeros(shape)
+
+    # Position of the padded PSF in the output array, clipped to the edges
+    y_start = y_int - pad
+    x_start = x_int - pad
+    y_min = max(y_start, 0)
+    y_max = min(y_start + psf_pad.shape[0], shape[0])
+    x_min = max(x_start, 0)
+    x_max = min(x_start + psf_pad.shape[1], shape[1])
+
+    if y_max > y_min and x_max > x_min:
+        model[y_min:y_max, x_min:x_max] = psf_pad[
+            y_min - y_start:y_max - y_start,
+            x_min - x_start:x_max - x_start,
+        ]
+
+    return model
+
+
 def image_resid(
         theta,
         data=None,
         err=None,
         psf=None,
         mask=None,
-        x_cen=None,
-        y_cen=None,
+        psf_x_cen=None,
+        psf_y_cen=None,
         psf_thresh=1e-5,
 ):
     """Scale and shift PSF, calculate residual.
@@ -62,8 +173,10 @@ def image_resid(
         err: Input error
         psf: PSF to fit into the data
         mask: Optional mask to define good data
-        x_cen: Initial guess for the x centre of the saturated source
-        y_cen: Initial guess for the y centre of the saturated source
+        psf_x_cen: x centroid of the PSF. Defaults to None, which will
+            calculate this from the PSF
+        psf_y_cen: y centroid of the PSF. Defaults to None, which will
+            calculate this from the PSF
         psf_thresh: We only care about fitting in the region where
             the PSF is measurable. This defaults to 1e-5 (i.e. 0.001% of the
             maximum PSF amplitude)
@@ -74,31 +187,22 @@ def image_resid(
     if psf is None:
         raise TypeError("psf should be defined")
 
-    data = copy.deepcopy(data)
-    err = copy.deepcopy(err)
-    psf = copy.deepcopy(psf)
-
     amp = theta["amp"]
-    x_shift = theta["x_cen"]
-    y_shift = theta["y_cen"]
+    x_pos = theta["x_cen"]
+    y_pos = theta["y_cen"]
     offset = theta["offset"]
 
-    if x_cen is not None:
-        x_shift -= x_cen
-    if y_cen is not None:
-        y_shift -= y_cen
-
-    # Now put this into a model, ensuring we've centroided to shift
-    psf_x_cen, psf_y_cen = centroid_com(psf)
-
-    model = np.zeros_like(data)
-
-    model[: psf.shape[0], : psf.shape[1]] = psf
-
-    # Now shift to the new coords
-    model = shift(
-        model,
-        shift=[y_shift + y_cen - psf_y_cen, x_shift + x_cen - psf_x_cen],
+    if psf_x_cen is None or psf_y_cen is None:
+        psf_x_cen, psf_y_cen = centroid_com(psf)
+
+    # Put the PSF into a model, shifted to the new coords
+    model = shift_psf(
+        psf,
+        x_pos=x_pos,
+        y_pos=y_pos,
+        psf_x_cen=psf_x_cen,
+        psf_y_cen=psf_y_cen,
+        shape=data.shape,
     )
 
     # We mostly care in the region where the PSF is
@@ -107,13 +211,13 @@ def image_resid(
     # Scale and offset the model
     model = amp * model + offset
 
-    data[psf_mask] = 0
+    data = np.where(psf_mask, 0, data)
     model[psf_mask] = 0
 
     if mask is not None:
         data[mask] = np.nan
         if err is not None:
-            err[mask] = np.nan
+            err = np.where(mask, np.nan, err)
         model[mask] = np.nan
 
     resid = residual(
@@ -166,6 +270,11 @@ class PSFModelStep:
             psf_thresh=1e-5,
             dilate_size=7,
             nsigma=5,
+            psf_cache_dir=None,
+            psf_cache_max_size=2,
+            psf_cache_date_bucket=1,
+            mask_cache_dir=None,
+            persist_sip_headers=False,
             overwrite=False,
     ):
         """Step to model the PSF in saturated sources
@@ -183,7 +292,9 @@ class PSFModelStep:
             out_dir: Output directory
             step_ext: .fits extension for the files going
                 into the step
-            procs: Number of processes to run in parallel. Currently, does nothing
+            procs: Number of processes to run in parallel. Files are fitted in parallel,
+                and any spare processes are used to fit saturated sources within a file
+                concurrently
             method: Whether to "replace" saturated cores, or "subtract" the PSF.
                 Defaults to replace
             npixels: Minimum number of pixels to define a saturated source. Defaults
@@ -199,6 +310,20 @@ class PSFModelStep:
                 want to fit in very bright areas. Defaults to 7
             nsigma: Sigma-clipping limit for creating source mask, since we don't want to fit
                 in very bright areas. Defaults to 5
+            psf_cache_dir: Directory to cache generated PSFs in. PSFs are keyed on
+                instrument, detector, filter, pupil, aperture, date (for the OPD) and
+                psf_fov_pixels, so can be shared between bands and targets. This should be
+                outside out_dir, since that is wiped when overwriting. Defaults to None, which
+                will not cache PSFs
+            psf_cache_max_size: Maximum size of the PSF cache, in GB. Once this is exceeded,
+                the least recently used PSFs will be removed. Defaults to 2
+            psf_cache_date_bucket: Size of the date bins (in days) used to decide whether
+                observations share an OPD. Defaults to 1
+            mask_cache_dir: Directory to cache source masks in. Masks are keyed on the data and masking
+                parameters, so can be shared between steps and re-runs. Defaults to None, which will not
+                cache masks
+            persist_sip_headers: Whether to save FITS SIP approximations to the WCS as .sip.hdr sidecar files,
+                so they can be reused between processes and runs. Defaults to False
             overwrite: Whether to overwrite or not. Defaults to False
         """
 
@@ -224,6 +349,13 @@ class PSFModelStep:
         self.psf_thresh = psf_thresh
         self.dilate_size = dilate_size
         self.nsigma = nsigma
+
+        self.psf_cache_dir = psf_cache_dir
+        self.psf_cache_max_size = psf_cache_max_size
+        self.psf_cache_date_bucket = psf_cache_date_bucket
+        self.persist_sip_headers = persist_sip_headers
+        self.mask_cache_dir = mask_cache_dir
+
         self.overwrite = overwrite
 
     def do_step(self):
@@ -284,185 +416,309 @@ class PSFModelStep:
             files,
             sat_coords,
     ):
-        """Run the step, fitting PSFs to catalogue positions of saturated coordinates
+        """Wrap parallelism around fitting PSFs to catalogue positions of saturated coordinates
+
+        Files are split over processes. If there are spare processes (i.e. fewer files than
+        procs), then saturated sources within each file are also fitted concurrently
 
         Args:
             files: List of files to fit PSF for
             sat_coords: List of coordinates corresponding to saturated positions
         """
 
-        success = []
+        procs = max(1, np.nanmin([self.procs, len(files)]))
+        fit_procs = max(1, self.procs // procs)
 
-        for file in files:
+        with mp.get_context("fork").Pool(procs) as pool:
+            success = []
 
-            file_short = os.path.split(file)[-1]
-            log.info(f"Starting fit for {file_short}")
+            for result in tqdm(
+                    pool.imap_unordered(
+                        partial(
+                            self.parallel_psf_model,
+                            sat_coords=sat_coords,
+                            fit_procs=fit_procs,
+                        ),
+                        files,
+                    ),
+                    ascii=True,
+                    desc="Fitting PSF models",
+                    total=len(files),
+            ):
+                success.append(result)
+
+            pool.close()
+            pool.join()
+            gc.collect()
 
-            file_out = os.path.join(self.out_dir,
-                                    file_short,
-                                    )
+        return success
 
-            with datamodels.open(file) as im:
+    def parallel_psf_model(
+            self,
+            file,
+            sat_coords,
+            fit_procs=1,
+    ):
+        """Parallel-wrapped function to fit PSFs for a single file
 
-                # If we don't have anything to mask, just save and continue
-                if len(sat_coords) == 0:
-                    im.save(file_out)
-                    del im
-                    success.append(True)
-                    continue
+        Args:
+            file: File to fit PSF for
+            sat_coords: List of coordinates corresponding to saturated positions
+            fit_procs: Number of saturated sources to fit concurrently. Defaults to 1
+        """
 
-                # Mask data we don't want to include
-                dq_bit_mask = get_dq_bit_mask(
-                    im.dq,
-                )
-                sat_mask = get_sat_mask(
-                    im.dq,
+        file_short = os.path.split(file)[-1]
+        log.info(f"Starting fit for {file_short}")
+
+        file_out = os.path.join(self.out_dir,
+                                file_short,
+                                )
+
+        # Limit BLAS threads, since we're already running in parallel
+        with threadpool_limits(limits=1, user_api=None), datamodels.open(file) as im:
+
+            # If we don't have anything to mask, just save and continue
+            if len(sat_coords) == 0:
+                im.save(file_out)
+                del im
+                return True
+
+            # Mask data we don't want to include
+            dq_bit_mask = get_dq_bit_mask(
+                im.dq,
+            )
+            sat_mask = get_sat_mask(
+                im.dq,
+            )
+
+            data_masked = copy.deepcopy(im.data)
+            data_masked[dq_bit_mask == 1] = np.nan
+            err_masked = copy.deepcopy(im.err)
+            err_masked[dq_bit_mask == 1] = np.nan
+
+            # Get an array to put all the PSF models into
+            full_psf_model = np.zeros_like(im.data)
+
+            # Get PSF and its centroid
+            psf = self.get_psf(file)
+            psf_x_cen, psf_y_cen = centroid_com(psf)
+
+            # Get average background level as an offset
+            offset = sigma_clipped_stats(
+                im.data,
+                mask=dq_bit_mask,
+                maxiters=None,
+            )[1]
+            offset_fit = copy.deepcopy(offset)
+
+            # We want a source mask, so we primarily fit to the low brightness outskirts
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                mask = make_source_mask(
+                    data_masked,
+                    dilate_size=self.dilate_size,
+                    nsigma=self.nsigma,
+                    cache_dir=self.mask_cache_dir,
                 )
 
-                data_masked = copy.deepcopy(im.data)
-                data_masked[dq_bit_mask == 1] = np.nan
-                err_masked = copy.deepcopy(im.err)
-                err_masked[dq_bit_mask == 1] = np.nan
+            # Convert the RA/Decs into x/y
+            sat_pix = [im.meta.wcs.invert(sat_coord.ra, sat_coord.dec) for sat_coord in sat_coords]
+
+            fit_func = partial(
+                self.fit_sat_source,
+                data=data_masked,
+                err=err_masked,
+                mask=mask,
+                psf=psf,
+                psf_x_cen=psf_x_cen,
+                psf_y_cen=psf_y_cen,
+                offset=offset,
+            )
 
-                # Get an array to put all the PSF models into
-                full_psf_model = np.zeros_like(im.data)
+            # Fit the sources, concurrently if we have the spare processes. Results come back
+            # in order, so the final offset is the same as fitting serially
+            if fit_procs > 1 and len(sat_pix) > 1:
+                with ThreadPoolExecutor(max_workers=fit_procs) as executor:
+                    fit_results = list(executor.map(lambda pix: fit_func(*pix), sat_pix))
+            else:
+                fit_results = [fit_func(*pix) for pix in sat_pix]
 
-                # Get PSF and shape
-                psf = self.get_psf(file)
-                psf_y_cen, psf_x_cen = centroid_com(psf)
+            for fit_result in fit_results:
 
-                # Get average background level as an offset
-                offset = sigma_clipped_stats(
-                    im.data,
-                    mask=dq_bit_mask,
-                    maxiters=None,
-                )[1]
+                if fit_result is None:
+                    continue
 
-                # We want a source mask, so we primarily fit to the low brightness outskirts
-                with warnings.catch_warnings():
-                    warnings.simplefilter("ignore")
-                    mask = make_source_mask(
-                        data_masked,
-                        dilate_size=self.dilate_size,
-                        nsigma=self.nsigma,
-                    )
+                x_fit, y_fit, amp_fit, offset_fit = fit_result
 
-                for sat_coord in sat_coords:
-                    sat_coord_string = sat_coord.to_string(style="hmsdms", precision=2)
-                    log.info(f"Fitting for saturated region at {sat_coord_string}")
-
-                    # Convert the RA/Dec into x/y
-                    x_cen, y_cen = im.meta.wcs.invert(sat_coord.ra, sat_coord.dec)
-
-                    # Get initial guess of the amplitude
-                    init_amp = self.get_initial_amp(
-                        data=data_masked - offset,
-                        psf=psf,
-                        x_cen=x_cen,
-                        y_cen=y_cen,
-                        psf_x_cen=psf_x_cen,
-                        psf_y_cen=psf_y_cen,
-                    )
+                # Get this into the full PSF model
+                psf_model = shift_psf(
+                    psf,
+                    x_pos=x_fit,
+                    y_pos=y_fit,
+                    psf_x_cen=psf_x_cen,
+                    psf_y_cen=psf_y_cen,
+                    shape=im.data.shape,
+                )
+                full_psf_model += amp_fit * psf_model
 
-                    if np.isnan(init_amp):
-                        log.warning("Initial amplitude is NaN! Will skip fitting")
-                        continue
+            plot_name = os.path.join(self.plot_dir,
+                                     file_short.replace(".fits", "")
+                                     )
 
-                    pars = Parameters()
+            if self.method == "replace":
+                mask = None
+            elif self.method == "subtract":
+                mask = dq_bit_mask
 
-                    pars.add(
-                        "amp",
-                        value=init_amp,
-                        min=0.1 * init_amp,
-                        max=10 * init_amp,
-                    )
-                    pars.add(
-                        "offset",
-                        value=offset,
-                        # vary=False,
-                    )
+            plot_success = self.make_diagnostic_plot(data=data_masked,
+                                                     psf_model=full_psf_model + offset_fit,
+                                                     plot_name=plot_name,
+                                                     mask=mask,
+                                                     )
+            if not plot_success:
+                raise Warning(f"Issue with diagnostic plot for {file_short}")
 
-                    # Here, x_cen and y_cen are offsets around 0, since we've already shuffled
-                    pars.add(
-                        "x_cen",
-                        value=x_cen,
-                        min=x_cen - 5,
-                        max=x_cen + 5,
-                    )
-                    pars.add(
-                        "y_cen",
-                        value=y_cen,
-                        min=y_cen - 5,
-                        max=y_cen + 5,
-                    )
+            # Finally, either replace or subtract
+            if self.method == "replace":
 
-                    result = minimize(
-                        image_resid,
-                        pars,
-                        args=(
-                            data_masked,
-                            err_masked,
-                            psf,
-                            mask,
-                            x_cen,
-                            y_cen,
-                            self.psf_thresh,
-                        ),
-                    )
+                # Here, replace the saturated pixels and alter the DQ array appropriately
+                im.data[sat_mask] = full_psf_model[sat_mask] + offset_fit
+                im.dq[sat_mask] = 0
+
+            elif self.method == "subtract":
+
+                # Here, subtract the full PSF model from the whole data array, but maintain overall
+                # flux level
+                im.data -= full_psf_model
+
+            im.save(file_out)
+            del im
 
-                    log.info("Fit complete! Fit report:")
-                    log.info(fit_report(result))
+        gc.collect()
 
-                    # Pull out best fit parameters and get this into the full PSF model
-                    x_fit = result.params["x_cen"].value
-                    y_fit = result.params["y_cen"].value
-                    amp_fit = result.params["amp"].value
-                    offset_fit = result.params["offset"].value
+        return True
 
-                    psf_model = np.zeros_like(im.data)
-                    psf_model[: psf.shape[0], : psf.shape[1]] = copy.deepcopy(psf)
-                    psf_model = shift(psf_model, [y_fit - psf_y_cen, x_fit - psf_x_cen])
-                    full_psf_model += psf_model
-                    full_psf_model *= amp_fit
+    def fit_sat_source(
+            self,
+            x_cen,
+            y_cen,
+            data,
+            err,
+            mask,
+            psf,
+            psf_x_cen,
+            psf_y_cen,
+            offset,
+    ):
+        """Fit a PSF to a single saturated source
 
-                plot_name = os.path.join(self.plot_dir,
-                                         file_short.replace(".fits", "")
-                                         )
+        Will return the best-fit x and y centre, amplitude and offset, or None if
+        the fit can't be done
 
-                if self.method == "replace":
-                    mask = None
-                elif self.method == "subtract":
-                    mask = dq_bit_mask
+        Args:
+            x_cen: Initial guess for x centre of saturated source
+            y_cen: Initial guess for y centre of saturated source
+            data: Input (masked) data
+            err: Input (masked) error
+            mask: Source mask, for areas we don't want to fit
+            psf: Input PSF
+            psf_x_cen: x centre of the PSF
+            psf_y_cen: y centre of the PSF
+            offset: Initial guess for the background offset
+        """
 
-                plot_success = self.make_diagnostic_plot(data=data_masked,
-                                                         psf_model=full_psf_model + offset_fit,
-                                                         plot_name=plot_name,
-                                                         mask=mask,
-                                                         )
-                if not plot_success:
-                    raise Warning(f"Issue with diagnostic plot for {file_short}")
+        log.info(f"Fitting for saturated region at ({x_cen:.1f}, {y_cen:.1f})")
 
-                # Finally, either replace or subtract
-                if self.method == "replace":
+        # Fit in a cutout around the source, big enough to contain the PSF
+        cutout_slice = get_cutout_slice(
+            x_cen=x_cen,
+            y_cen=y_cen,
+            psf_shape=psf.shape,
+            psf_x_cen=psf_x_cen,
+            psf_y_cen=psf_y_cen,
+            data_shape=data.shape,
+        )
+        y_start = cutout_slice[0].start
+        x_start = cutout_slice[1].start
+
+        data_cutout = data[cutout_slice]
+        err_cutout = err[cutout_slice]
+        mask_cutout = mask[cutout_slice]
+
+        if data_cutout.size == 0:
+            log.warning("Saturated region is off the image! Will skip fitting")
+            return None
+
+        # Positions relative to the cutout
+        x_cen_cutout = x_cen - x_start
+        y_cen_cutout = y_cen - y_start
+
+        # Get initial guess of the amplitude
+        init_amp = self.get_initial_amp(
+            data=data_cutout - offset,
+            psf=psf,
+            x_cen=x_cen_cutout,
+            y_cen=y_cen_cutout,
+            psf_x_cen=psf_x_cen,
+            psf_y_cen=psf_y_cen,
+        )
 
-                    # Here, replace the saturated pixels and alter the DQ array appropriately
-                    im.data[sat_mask] = full_psf_model[sat_mask] + offset_fit
-                    im.dq[sat_mask] = 0
+        if np.isnan(init_amp):
+            log.warning("Initial amplitude is NaN! Will skip fitting")
+            return None
 
-                elif self.method == "subtract":
+        pars = Parameters()
 
-                    # Here, subtract the full PSF model from the whole data array, but maintain overall
-                    # flux level
-                    im.data -= full_psf_model
+        pars.add(
+            "amp",
+            value=init_amp,
+            min=0.1 * init_amp,
+            max=10 * init_amp,
+        )
+        pars.add(
+            "offset",
+            value=offset,
+            # vary=False,
+        )
 
-                im.save(file_out)
-                del im
+        # Here, x_cen and y_cen are positions within the cutout
+        pars.add(
+            "x_cen",
+            value=x_cen_cutout,
+            min=x_cen_cutout - MAX_CEN_SHIFT,
+            max=x_cen_cutout + MAX_CEN_SHIFT,
+        )
+        pars.add(
+            "y_cen",
+            value=y_cen_cutout,
+            min=y_cen_cutout - MAX_CEN_SHIFT,
+            max=y_cen_cutout + MAX_CEN_SHIFT,
+        )
 
-                success.append(True)
+        result = minimize(
+            image_resid,
+            pars,
+            kws={
+                "data": data_cutout,
+                "err": err_cutout,
+                "psf": psf,
+                "mask": mask_cutout,
+                "psf_x_cen": psf_x_cen,
+                "psf_y_cen": psf_y_cen,
+                "psf_thresh": self.psf_thresh,
+            },
+        )
 
-            gc.collect()
+        log.info("Fit complete! Fit report:")
+        log.info(fit_report(result))
 
-        return success
+        # Pull out best fit parameters, back in full image coordinates
+        x_fit = result.params["x_cen"].value + x_start
+        y_fit = result.params["y_cen"].value + y_start
+        amp_fit = result.params["amp"].value
+        offset_fit = result.params["offset"].value
+
+        return x_fit, y_fit, amp_fit, offset_fit
 
     def get_sat_coords(self, files):
         """Get RA/Dec for the centres of saturated sources in each image
@@ -482,7 +738,11 @@ class PSFModelStep:
         # Get a mask of saturated pixels
         for input_file in files:
             with datamodels.open(input_file) as im:
-                wcs = im.meta.wcs.to_fits_sip()
+                wcs = get_sip_header(
+                    im,
+                    file=input_file,
+                    persist=self.persist_sip_headers,
+                )
                 w = WCS(wcs)
 
                 # Get saturation mask
@@ -537,6 +797,23 @@ class PSFModelStep:
             file: Input file to get PSF for
         """
 
+        # See if we've already generated this PSF
+        cache_key = cache_params = cache_file = None
+        if self.psf_cache_dir is not None:
+            cache_key, cache_params = self.get_psf_cache_key(file)
+            cache_file = os.path.join(self.psf_cache_dir, f"psf_{cache_key}.fits")
+
+        if cache_file is not None and os.path.exists(cache_file):
+            try:
+                # FITS data are big-endian, so convert back to a native float
+                psf_data = fits.getdata(cache_file).astype(float)
+                # Touch the file, so we know it's recently used
+                os.utime(cache_file)
+                log.info("Using cached PSF")
+                return psf_data
+            except OSError:
+                log.warning("Cached PSF could not be read. Will regenerate")
+
         log.info("Generating PSF")
 
         inst = webbpsf.setup_sim_to_match_file(
@@ -553,8 +830,142 @@ class PSFModelStep:
         # Normalise to peak of 1
         psf_data /= np.nanmax(psf_data)
 
+        if self.psf_cache_dir is not None:
+            self.save_psf_to_cache(
+                psf_data,
+                cache_key=cache_key,
+                cache_params=cache_params,
+            )
+
         return psf_data
 
+    def get_psf_cache_key(
+            self,
+            file,
+    ):
+        """Get the key for the PSF cache from the file header
+
+        Args:
+            file: Input file to get the cache key for
+        """
+
+        hdr = fits.getheader(file)
+
+        cache_params = {kw: str(hdr.get(kw, "NONE")) for kw in PSF_CACHE_KEYWORDS}
+
+        # The OPD is chosen by date, so bin the start time up
+        cache_params["DATE_BUCKET"] = int(
+            np.floor(hdr["EXPSTART"] / self.psf_cache_date_bucket)
+        )
+        cache_params["DATE_BUCKET_SIZE"] = self.psf_cache_date_bucket
+        cache_params["FOV_PIXELS"] = self.psf_fov_pixels
+        cache_params["WEBBPSF_VERSION"] = webbpsf.__version__
+
+        cache_key = hashlib.sha1(
+            json.dumps(cache_params, sort_keys=True).encode()
+        ).hexdigest()
+
+        return cache_key, cache_params
+
+    def save_psf_to_cache(
+            self,
+            psf_data,
+            cache_key,
+            cache_params,
+    ):
+        """Save a PSF into the cache, and update the index
+
+        Files are written to a temporary name and then moved, so other processes
+        never see partial files
+
+        Args:
+            psf_data: PSF array to save
+            cache_key: Key for the PSF
+            cache_params: Dictionary of parameters defining the PSF
+        """
+
+        if not os.path.exists(self.psf_cache_dir):
+            os.makedirs(self.psf_cache_dir, exist_ok=True)
+
+        cache_file = os.path.join(self.psf_cache_dir, f"psf_{cache_key}.fits")
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+
+        # Keep the native precision, so cached PSFs are identical to freshly generated ones
+        hdu = fits.PrimaryHDU(psf_data)
+        for key, val in cache_params.items():
+            hdu.header[f"HIERARCH {key}"] = val
+        hdu.writeto(tmp_file, overwrite=True)
+        os.replace(tmp_file, cache_file)
+
+        index = self.load_psf_cache_index()
+        index[cache_key] = {
+            "file": os.path.split(cache_file)[-1],
+            "params": cache_params,
+        }
+
+        # Remove the least recently used PSFs if we're over the size limit
+        cache_files = glob.glob(os.path.join(self.psf_cache_dir, "psf_*.fits"))
+        cache_files.sort(key=os.path.getmtime)
+
+        cache_size = sum(os.path.getsize(f) for f in cache_files)
+        max_size = self.psf_cache_max_size * 1024 ** 3
+
+        for old_file in cache_files:
+            if cache_size <= max_size or old_file == cache_file:
+                break
+            cache_size -= os.path.getsize(old_file)
+            os.remove(old_file)
+
+            old_key = os.path.split(old_file)[-1].replace("psf_", "").replace(".fits", "")
+            index.pop(old_key, None)
+            log.info(f"Removed {os.path.split(old_file)[-1]} from PSF cache")
+
+        self.save_psf_cache_index(index)
+
+        return True
+
+    def load_psf_cache_index(self):
+        """Load the PSF cache index, dropping any entries without files"""
+
+        index_file = os.path.join(self.psf_cache_dir, PSF_CACHE_INDEX)
+
+        if not os.path.exists(index_file):
+            return {}
+
+        try:
+            with open(index_file, "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            log.warning("PSF cache index could not be read. Will rebuild")
+            return {}
+
+        index = {
+            key: val
+            for key, val in index.items()
+            if os.path.exists(os.path.join(self.psf_cache_dir, val["file"]))
+        }
+
+        return index
+
+    def save_psf_cache_index(
+            self,
+            index,
+    ):
+        """Write out the PSF cache index
+
+        Args:
+            index: Dictionary of cache entries
+        """
+
+        index_file = os.path.join(self.psf_cache_dir, PSF_CACHE_INDEX)
+        tmp_file = f"{index_file}.{os.getpid()}.tmp"
+
+        with open(tmp_file, "w") as f:
+            json.dump(index, f, indent=4, sort_keys=True)
+        os.replace(tmp_file, index_file)
+
+        return True
+
     def get_initial_amp(
             self,
             data,
@@ -580,9 +991,14 @@ class PSFModelStep:
             psf_y_cen: y centre of the PSF
         """
 
-        psf_model = np.zeros_like(data)
-        psf_model[: psf.shape[0], : psf.shape[1]] = copy.deepcopy(psf)
-        psf_model = shift(psf_model, [y_cen - psf_y_cen, x_cen - psf_x_cen])
+        psf_model = shift_psf(
+            psf,
+            x_pos=x_cen,
+            y_pos=y_cen,
+            psf_x_cen=psf_x_cen,
+            psf_y_cen=psf_y_cen,
+            shape=data.shape,
+        )
 
         # We want to isolate the region where the PSF is at least a little important
         psf_model[psf_model < self.psf_thresh * np.nanmax(psf)] = np.nan
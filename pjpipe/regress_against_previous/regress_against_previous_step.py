@@ -1,17 +1,22 @@
 import copy
+import gc
 import glob
 import logging
+import multiprocessing as mp
 import os
 import warnings
+from functools import partial
 
 import cmocean
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 from astropy.io import fits
+from astropy.wcs import WCS
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from pypdf import PdfWriter
 from reproject import reproject_interp, reproject_adaptive, reproject_exact
+from tqdm import tqdm
 
 ALLOWED_REPROJECT_FUNCS = [
     "interp",
@@ -28,6 +33,67 @@ log = logging.getLogger("stpipe")
 log.addHandler(logging.NullHandler())
 
 
+def block_average(
+    data,
+    factor,
+):
+    """Block-average an image, ignoring NaNs
+
+    The image is padded with NaNs up to a multiple of the block size
+
+    Args:
+        data: Input image
+        factor: Block size, in pixels
+    """
+
+    if factor <= 1:
+        return data
+
+    ny, nx = data.shape
+    ny_pad = int(np.ceil(ny / factor)) * factor
+    nx_pad = int(np.ceil(nx / factor)) * factor
+
+    data_pad = np.full((ny_pad, nx_pad), np.nan, dtype=float)
+    data_pad[:ny, :nx] = data
+
+    data_pad = data_pad.reshape(ny_pad // factor, factor, nx_pad // factor, factor)
+
+    # All-NaN blocks will just stay NaN
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        data_avg = np.nanmean(data_pad, axis=(1, 3))
+
+    return data_avg
+
+
+def block_average_hdu(
+    hdu,
+    factor,
+):
+    """Block-average an image HDU, with a matching WCS
+
+    Args:
+        hdu: Input image HDU
+        factor: Block size, in pixels
+    """
+
+    if factor <= 1:
+        return hdu
+
+    data = block_average(hdu.data, factor)
+
+    # Slicing with a step bins the WCS to match the block-averaged pixels
+    w = WCS(hdu.header).celestial
+    w = w.slice((slice(None, None, factor), slice(None, None, factor)))
+
+    header = w.to_header()
+    header["NAXIS"] = 2
+    header["NAXIS1"] = data.shape[1]
+    header["NAXIS2"] = data.shape[0]
+
+    return fits.ImageHDU(data=data, header=header)
+
+
 def get_diff_image(
     filename,
     v_curr,
@@ -36,6 +102,8 @@ def get_diff_image(
     reproject_func="interp",
     percentiles=None,
     file_exts=None,
+    preview_size=None,
+    percentile_samples=None,
 ):
     """Reproject images to get a difference image
 
@@ -51,6 +119,11 @@ def get_diff_image(
         file_exts: List of file extensions to search for the previous
             file in priority order. Defaults to None, which will go
             anchor->align->pipeline.
+        preview_size: If set, will block-average both images down so the current
+            image is at most this many pixels on a side before reprojecting.
+            Defaults to None, which will use the full resolution
+        percentile_samples: If set, will estimate percentiles from (at most) this
+            many evenly spaced pixels. Defaults to None, which will use every pixel
     """
     if percentiles is None:
         percentiles = [1, 99]
@@ -86,24 +159,42 @@ def get_diff_image(
             raise ValueError(f"reproject_func should be one of {ALLOWED_REPROJECT_FUNCS}")
 
         with fits.open(prev_filename) as hdu2:
-            # Reproject both HDUs, just to be sure
             hdu2["SCI"].data[hdu2["SCI"].data == 0] = np.nan
+
+            hdu1_sci = hdu1["SCI"]
+            hdu2_sci = hdu2["SCI"]
+
+            if preview_size is not None:
+                # Block-average the previous image by the same amount, accounting
+                # for any differences in pixel scale
+                factor1 = int(np.ceil(np.max(hdu1_sci.data.shape) / preview_size))
+                pix_scale1 = WCS(hdu1_sci.header).celestial.proj_plane_pixel_scales()[0].value
+                pix_scale2 = WCS(hdu2_sci.header).celestial.proj_plane_pixel_scales()[0].value
+                factor2 = max(int(np.round(factor1 * pix_scale1 / pix_scale2)), 1)
+
+                hdu1_sci = block_average_hdu(hdu1_sci, factor1)
+                hdu2_sci = block_average_hdu(hdu2_sci, factor2)
+
+            # The current image is already on its own grid, so only the previous
+            # image needs reprojecting
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
-                data1 = r_func(
-                    hdu1["SCI"],
-                    hdu1["SCI"].header,
-                    return_footprint=False,
-                )
+                data1 = hdu1_sci.data
                 data2 = r_func(
-                    hdu2["SCI"],
-                    hdu1["SCI"].header,
+                    hdu2_sci,
+                    hdu1_sci.header,
+                    shape_out=data1.shape,
                     return_footprint=False,
                 )
 
             diff = data1 - data2
 
-            v = np.nanmax(np.abs(np.nanpercentile(diff, percentiles)))
+            diff_sample = diff[np.isfinite(diff)]
+            if percentile_samples is not None and diff_sample.size > percentile_samples:
+                step = int(np.ceil(diff_sample.size / percentile_samples))
+                diff_sample = diff_sample[::step]
+
+            v = np.nanmax(np.abs(np.nanpercentile(diff_sample, percentiles)))
 
     return diff, v
 
@@ -117,6 +208,10 @@ class RegressAgainstPreviousStep:
         prev_version=None,
         file_exts=None,
         reproject_func="interp",
+        preview=False,
+        preview_size=512,
+        percentile_samples=100000,
+        procs=1,
         overwrite=False,
     ):
         """Create diagnostic plots to regress against previous versions
@@ -129,6 +224,14 @@ class RegressAgainstPreviousStep:
             file_exts: File extensions (in priority order) to search for
             reproject_func: Which reproject function to use. Defaults to 'interp',
                 but can also be 'exact' or 'adaptive'
+            preview: If True, will make quick-look comparisons, block-averaging the
+                images down to thumbnail size before reprojecting, and estimating
+                colour scales from a subsample of pixels. Defaults to False
+            preview_size: In preview mode, the maximum size of the thumbnails in
+                pixels. Defaults to 512
+            percentile_samples: In preview mode, the maximum number of pixels used to
+                estimate colour scales. Defaults to 100000
+            procs: Number of processes to run in parallel. Defaults to 1
             overwrite: Whether to overwrite or not. Defaults to
                 False
         """
@@ -152,6 +255,10 @@ class RegressAgainstPreviousStep:
         self.prev_version = prev_version
         self.file_exts = file_exts
         self.reproject_func = reproject_func
+        self.preview = preview
+        self.preview_size = preview_size
+        self.percentile_samples = percentile_samples
+        self.procs = procs
         self.overwrite = overwrite
 
         self.out_dir = os.path.join(
@@ -305,6 +412,11 @@ class RegressAgainstPreviousStep:
             bgr_offset = copy.deepcopy(ncols) + 1
             sci_offset = 1
 
+            diffs = self.get_diff_images(
+                files=files,
+                file_exts=file_exts,
+            )
+
             for i, file in enumerate(files):
                 file_short = os.path.split(file)[-1]
 
@@ -315,16 +427,8 @@ class RegressAgainstPreviousStep:
                     is_bgr = False
 
                 band = file_short.split("_")[3]
-                file_ext = file_exts[i]
-
-                diff, v = get_diff_image(
-                    file,
-                    v_curr=self.curr_version,
-                    v_prev=self.prev_version,
-                    curr_file_ext=file_ext,
-                    file_exts=self.file_exts,
-                    reproject_func=self.reproject_func,
-                )
+
+                diff, v = diffs[i]
 
                 if not is_bgr:
                     ax = plt.subplot(nrows, ncols, sci_offset)
@@ -388,3 +492,75 @@ class RegressAgainstPreviousStep:
             plt.close()
 
         return True
+
+    def get_diff_images(
+        self,
+        files,
+        file_exts,
+    ):
+        """Get difference images for a list of files, in parallel
+
+        Args:
+            files: List of files
+            file_exts: List of file extensions for each file
+
+        Returns:
+            List of (diff, v) for each file
+        """
+
+        # Ensure we're not wasting processes
+        procs = max(min(self.procs, len(files)), 1)
+
+        diffs = [None] * len(files)
+
+        with mp.get_context("fork").Pool(procs) as pool:
+            for i, diff, v in tqdm(
+                pool.imap_unordered(
+                    partial(
+                        self.parallel_get_diff_image,
+                    ),
+                    enumerate(zip(files, file_exts)),
+                ),
+                ascii=True,
+                desc="Getting diff images",
+                total=len(files),
+            ):
+                diffs[i] = (diff, v)
+
+            pool.close()
+            pool.join()
+            gc.collect()
+
+        return diffs
+
+    def parallel_get_diff_image(
+        self,
+        file_info,
+    ):
+        """Parallelise getting difference images
+
+        Args:
+            file_info: Tuple of index, and (file, file extension)
+        """
+
+        i, (file, file_ext) = file_info
+
+        if self.preview:
+            preview_size = self.preview_size
+            percentile_samples = self.percentile_samples
+        else:
+            preview_size = None
+            percentile_samples = None
+
+        diff, v = get_diff_image(
+            file,
+            v_curr=self.curr_version,
+            v_prev=self.prev_version,
+            curr_file_ext=file_ext,
+            file_exts=self.file_exts,
+            reproject_func=self.reproject_func,
+            preview_size=preview_size,
+            percentile_samples=percentile_samples,
+        )
+
+        return i, diff, v
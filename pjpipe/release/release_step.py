@@ -1,11 +1,18 @@
+import gc
 import logging
+import multiprocessing as mp
 import os
 import shutil
 import glob
+import tarfile
+from functools import partial
 
-from astropy.io import fits
+import numpy as np
 from tqdm import tqdm
 
+from ..utils import archive_directory, prune_fits_file, stage_files
+from ..utils.staging import ALLOWED_PRUNE_COMPRESSIONS
+
 log = logging.getLogger("stpipe")
 log.addHandler(logging.NullHandler())
 
@@ -19,6 +26,7 @@ class ReleaseStep:
         bands,
         file_exts=None,
         remove_bloat=False,
+        compression=None,
         move_tweakback=False,
         move_backgrounds=False,
         move_individual_fields=False,
@@ -33,6 +41,8 @@ class ReleaseStep:
         individual_fields_dir="mosaic_individual_fields",
         psf_matched_dir="psf_matching",
         diagnostic_plot_dir="plots",
+        stage_strategy="copy",
+        procs=1,
         overwrite=False,
     ):
         """Tidies up files, moves to a single directory for release
@@ -49,7 +59,12 @@ class ReleaseStep:
             file_exts: List of filetypes to move. Defaults to moving fits
                 files, plus any generated catalogues and segmentation maps
             remove_bloat: Will remove generally un-needed extensions from
-                fits files. Defaults to False
+                fits files. These are streamed straight from disk, so the images
+                are never loaded into memory. Defaults to False
+            compression: Optional compression for mosaics and PSF matched images. Can be
+                'gzip', which will gzip the whole file, or 'rice', which Rice tile-compresses
+                the image extensions (quantizing floating point data). Defaults to None,
+                which will not compress
             move_tweakback: Whether to move tweakback'd crf files or not.
                 Defaults to False
             move_backgrounds: Whether to move combined background files or not.
@@ -75,6 +90,12 @@ class ReleaseStep:
             individual_fields_dir: Where individual field mosaics are located,
                 relative to the target directory structure. Defaults to
                 "mosaic_individual_fields"
+            stage_strategy: How to stage files into the release directory. Options are
+                'copy', 'hardlink' (which shares data with the original files), or
+                'reflink' (a copy-on-write clone, if the filesystem supports it). Falls back
+                to copying if the strategy isn't possible. Defaults to 'copy'
+            procs: Number of processes to use. Bands will be released in parallel, with
+                any left over used as threads when staging files. Defaults to 1
             overwrite: Whether to overwrite or not. Defaults to False
         """
 
@@ -82,7 +103,13 @@ class ReleaseStep:
         self.out_dir = out_dir
         self.target = target
         self.bands = bands
+        if compression not in ALLOWED_PRUNE_COMPRESSIONS:
+            raise ValueError(
+                f"compression should be one of {ALLOWED_PRUNE_COMPRESSIONS}, not {compression}"
+            )
+
         self.remove_bloat = remove_bloat
+        self.compression = compression
         self.move_tweakback = move_tweakback
         self.move_backgrounds = move_backgrounds
         self.move_individual_fields = move_individual_fields
@@ -119,6 +146,11 @@ class ReleaseStep:
         self.individual_fields_dir = individual_fields_dir
         self.psf_matched_dir = psf_matched_dir
         self.diagnostic_plot_dir = diagnostic_plot_dir
+        self.stage_strategy = stage_strategy
+        self.procs = procs
+
+        # Threads to use when staging files. This will be updated if running bands in parallel
+        self.stage_procs = procs
 
     def do_step(self):
         """Run the release step"""
@@ -151,57 +183,105 @@ class ReleaseStep:
                 f"*_anchor_tab.fits",
             )
         )
-        for anchor_tab in anchor_tabs:
-            out_name = os.path.join(
-                out_dir,
-                os.path.split(anchor_tab)[-1],
-            )
-            os.system(f"cp {anchor_tab} {out_name}")
+        stage_files(
+            anchor_tabs,
+            [out_dir] * len(anchor_tabs),
+            strategy=self.stage_strategy,
+            procs=self.stage_procs,
+            desc="Anchor tables",
+            leave=False,
+        )
 
-        for band in tqdm(
-            self.bands,
-            ascii=True,
-            desc="Looping over bands",
-        ):
-            for file_ext in tqdm(
-                self.file_exts,
+        # Ensure we're not wasting processes, and split any leftovers between the bands
+        procs = max(min(self.procs, len(self.bands)), 1)
+        self.stage_procs = max(self.procs // procs, 1)
+
+        with mp.get_context("fork").Pool(procs) as pool:
+            successes = []
+
+            for success in tqdm(
+                pool.imap_unordered(
+                    partial(
+                        self.parallel_release_band,
+                    ),
+                    self.bands,
+                ),
                 ascii=True,
-                desc="Looping over file types",
-                leave=False,
+                desc="Looping over bands",
+                total=len(self.bands),
             ):
-                self.move_files(
-                    band=band,
-                    file_ext=file_ext,
-                )
-            if self.move_tweakback:
-                self.do_move_tweakback(
-                    band=band,
-                )
-            if self.move_backgrounds:
-                self.do_move_backgrounds(
-                    band=band,
-                )
-            if self.move_individual_fields:
-                self.do_move_individual_fields(
-                    band=band,
-                )
-            if self.move_psf_matched:
-                self.do_move_psf_matched(
-                    band=band,
-                )
-            if self.move_diagnostic_plots:
-                self.do_move_diagnostic_plots(
-                    band=band,
-                )
+                successes.append(success)
+
+            pool.close()
+            pool.join()
+            gc.collect()
+
+        if not np.all(successes):
+            log.warning("Failures detected in releasing bands")
+            return False
 
         if self.move_diagnostic_plots and self.compress_diagnostic_plots:
-            self.do_compress_diagnostic_plots()
+            success = self.do_compress_diagnostic_plots()
+            if not success:
+                log.warning("Failures detected in compressing diagnostic plots")
+                return False
 
         with open(step_complete_file, "w+") as f:
             f.close()
 
         return True
 
+    def parallel_release_band(
+        self,
+        band,
+    ):
+        """Parallelise releasing files for each band
+
+        Args:
+            band: Band to consider
+        """
+
+        successes = []
+
+        for file_ext in tqdm(
+            self.file_exts,
+            ascii=True,
+            desc="Looping over file types",
+            leave=False,
+        ):
+            success = self.move_files(
+                band=band,
+                file_ext=file_ext,
+            )
+            successes.append(success)
+        if self.move_tweakback:
+            success = self.do_move_tweakback(
+                band=band,
+            )
+            successes.append(success)
+        if self.move_backgrounds:
+            success = self.do_move_backgrounds(
+                band=band,
+            )
+            successes.append(success)
+        if self.move_individual_fields:
+            success = self.do_move_individual_fields(
+                band=band,
+            )
+            successes.append(success)
+        if self.move_psf_matched:
+            success = self.do_move_psf_matched(
+                band=band,
+            )
+            successes.append(success)
+        if self.move_diagnostic_plots:
+            success = self.do_move_diagnostic_plots(
+                band=band,
+            )
+            successes.append(success)
+
+        return np.all(successes)
+
     def move_files(
         self,
         band,
@@ -230,7 +310,9 @@ class ReleaseStep:
 
         out_dir = os.path.join(self.out_dir, self.target)
         if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
+            os.makedirs(out_dir, exist_ok=True)
+
+        files_to_stage = []
 
         for file in files:
             out_name = os.path.join(
@@ -240,19 +322,52 @@ class ReleaseStep:
 
             if (
                 file_ext in ["i2d.fits", "i2d_align.fits", "i2d_anchor.fits"]
-                and self.remove_bloat
+                and (self.remove_bloat or self.compression is not None)
             ):
-                # For these, we want to pull out only the data and error extensions. Everything else
-                # is just bloat
-                with fits.open(file, memmap=False) as hdu:
-                    for hdu_ext in self.hdu_ext_to_delete:
-                        del hdu[hdu_ext]
-
-                    hdu.writeto(out_name, overwrite=True)
-                    del hdu
+                self.prune_file(
+                    file=file,
+                    out_name=out_name,
+                )
 
             else:
-                os.system(f"cp {file} {out_name}")
+                files_to_stage.append(file)
+
+        stage_files(
+            files_to_stage,
+            [out_dir] * len(files_to_stage),
+            strategy=self.stage_strategy,
+            procs=self.stage_procs,
+            desc=file_ext,
+            leave=False,
+        )
+
+        return True
+
+    def prune_file(
+        self,
+        file,
+        out_name,
+    ):
+        """Write out a file, removing bloat and compressing if requested
+
+        Args:
+            file: File to consider
+            out_name: Output filename
+        """
+
+        # We want to pull out only the data and error extensions. Everything else
+        # is just bloat
+        if self.remove_bloat:
+            hdu_ext_to_delete = self.hdu_ext_to_delete
+        else:
+            hdu_ext_to_delete = []
+
+        prune_fits_file(
+            file,
+            out_name,
+            hdu_ext_to_delete=hdu_ext_to_delete,
+            compression=self.compression,
+        )
 
         return True
 
@@ -288,13 +403,14 @@ class ReleaseStep:
         if not os.path.exists(out_dir):
             os.makedirs(out_dir)
 
-        for file in tqdm(
+        stage_files(
             files,
-            ascii=True,
+            [out_dir] * len(files),
+            strategy=self.stage_strategy,
+            procs=self.stage_procs,
             desc="tweakback",
             leave=False,
-        ):
-            os.system(f"cp {file} {out_dir}")
+        )
 
         return True
 
@@ -330,13 +446,14 @@ class ReleaseStep:
         if not os.path.exists(out_dir):
             os.makedirs(out_dir)
 
-        for file in tqdm(
+        stage_files(
             files,
-            ascii=True,
+            [out_dir] * len(files),
+            strategy=self.stage_strategy,
+            procs=self.stage_procs,
             desc="background",
             leave=False,
-        ):
-            os.system(f"cp {file} {out_dir}")
+        )
 
         return True
 
@@ -372,13 +489,14 @@ class ReleaseStep:
         if not os.path.exists(out_dir):
             os.makedirs(out_dir)
 
-        for file in tqdm(
+        stage_files(
             files,
-            ascii=True,
+            [out_dir] * len(files),
+            strategy=self.stage_strategy,
+            procs=self.stage_procs,
             desc="Individual fields",
             leave=False,
-        ):
-            os.system(f"cp {file} {out_dir}")
+        )
 
         return True
 
@@ -414,28 +532,30 @@ class ReleaseStep:
         if not os.path.exists(out_dir):
             os.makedirs(out_dir)
 
-        for file in tqdm(
-            files,
-            ascii=True,
-            desc="PSF Matched",
-            leave=False,
-        ):
+        files_to_stage = []
+
+        for file in files:
             out_name = os.path.join(
                 out_dir,
                 os.path.split(file)[-1],
             )
 
-            if self.remove_bloat:
-                # For these, we want to pull out only the data and error extensions. Everything else
-                # is just bloat
-                with fits.open(file, memmap=False) as hdu:
-                    for hdu_ext in self.hdu_ext_to_delete:
-                        del hdu[hdu_ext]
-
-                    hdu.writeto(out_name, overwrite=True)
-                    del hdu
+            if self.remove_bloat or self.compression is not None:
+                self.prune_file(
+                    file=file,
+                    out_name=out_name,
+                )
             else:
-                os.system(f"cp {file} {out_name}")
+                files_to_stage.append(file)
+
+        stage_files(
+            files_to_stage,
+            [out_dir] * len(files_to_stage),
+            strategy=self.stage_strategy,
+            procs=self.stage_procs,
+            desc="PSF Matched",
+            leave=False,
+        )
 
         return True
 
@@ -501,7 +621,7 @@ class ReleaseStep:
             f"anchoring_diagnostic_plots",
         )
         if not os.path.exists(out_anchoring_dir):
-            os.makedirs(out_anchoring_dir)
+            os.makedirs(out_anchoring_dir, exist_ok=True)
 
         out_dir = os.path.join(
             self.out_dir,
@@ -511,12 +631,9 @@ class ReleaseStep:
         if not os.path.exists(out_dir):
             os.makedirs(out_dir)
 
-        for file in tqdm(
-                files,
-                ascii=True,
-                desc="Diagnostic plots",
-                leave=False,
-        ):
+        out_names = []
+
+        for file in files:
             # Split this out by step so the folders aren't crazy
             file_split = file.split(os.path.sep)
             if "anchoring" in file_split:
@@ -530,30 +647,87 @@ class ReleaseStep:
                 full_out_dir,
                 file_split[-1],
             )
-            os.system(f"cp {file} {out_name}")
+            out_names.append(out_name)
+
+        stage_files(
+            files,
+            out_names,
+            strategy=self.stage_strategy,
+            procs=self.stage_procs,
+            desc="Diagnostic plots",
+            leave=False,
+        )
 
         return True
 
     def do_compress_diagnostic_plots(self):
-        """Compress diagnostic plot directories"""
+        """Compress diagnostic plot directories
 
-        orig_dir = os.getcwd()
+        Each directory is archived in a separate process. Archives whose contents
+        haven't changed will not be rewritten
+        """
 
         out_dir = os.path.join(self.out_dir, self.target)
 
-        os.chdir(out_dir)
+        plot_dirs = glob.glob(
+            os.path.join(
+                out_dir,
+                "*_diagnostic_plots",
+            )
+        )
+        plot_dirs = [plot_dir for plot_dir in plot_dirs if os.path.isdir(plot_dir)]
+
+        if len(plot_dirs) == 0:
+            return True
+
+        plot_dirs.sort()
 
-        plot_dirs = glob.glob("*_diagnostic_plots")
+        # Ensure we're not wasting processes
+        procs = max(min(self.procs, len(plot_dirs)), 1)
 
-        for plot_dir in tqdm(
-                plot_dirs,
+        with mp.get_context("fork").Pool(procs) as pool:
+            successes = []
+
+            for success in tqdm(
+                pool.imap_unordered(
+                    partial(
+                        self.parallel_compress_diagnostic_plots,
+                    ),
+                    plot_dirs,
+                ),
                 ascii=True,
                 desc="Compressing diagnostic plots",
+                total=len(plot_dirs),
                 leave=False,
-        ):
-            os.system(f"tar -czf {plot_dir}.tar.gz {plot_dir}")
-            os.system(f"rm -rf {plot_dir}")
+            ):
+                successes.append(success)
+
+            pool.close()
+            pool.join()
+            gc.collect()
+
+        return np.all(successes)
+
+    def parallel_compress_diagnostic_plots(
+        self,
+        plot_dir,
+    ):
+        """Parallelise compressing diagnostic plot directories
+
+        Args:
+            plot_dir: Diagnostic plot directory to compress
+        """
+
+        try:
+            written = archive_directory(plot_dir)
+        except (OSError, tarfile.TarError) as e:
+            # Keep the uncompressed plots around if we can't archive them
+            log.warning(f"Failed to archive {os.path.split(plot_dir)[-1]}: {e}")
+            return False
+
+        if not written:
+            log.info(f"{os.path.split(plot_dir)[-1]} unchanged, will not re-archive")
 
-        os.chdir(orig_dir)
+        shutil.rmtree(plot_dir)
 
         return True
@@ -14,7 +14,6 @@ import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 from astropy.convolution import convolve
-from astropy.stats import sigma_clipped_stats
 from jwst.flatfield.flat_field import do_correction
 from jwst.pipeline import calwebb_image2
 from mpl_toolkits.axes_grid1 import make_axes_locatable
@@ -26,7 +25,7 @@ from tqdm import tqdm
 
 from . import vwpca as vw
 from . import vwpca_normgappy as gappy
-from ..utils import make_source_mask, get_dq_bit_mask, level_data
+from ..utils import make_source_mask, get_dq_bit_mask, level_data, sigma_clipped_stats, BuildManifest
 
 matplotlib.use("agg")
 matplotlib.rcParams['mathtext.fontset'] = 'stix'
@@ -190,6 +189,10 @@ class SingleTileDestripeStep:
             filter_extend_mode="reflect",
             pca_components=50,
             pca_reconstruct_components=10,
+            pca_batch_size=None,
+            use_fast_stats=False,
+            mask_cache_dir=None,
+            incremental=False,
             overwrite=False,
     ):
         """NIRCAM Destriping routines
@@ -222,6 +225,15 @@ class SingleTileDestripeStep:
                 array edge. Default is "reflect". See the specific docs for more info
             pca_components: Number of PCA components to model. Defaults to 50
             pca_reconstruct_components: Number of PCA components to use in reconstruction. Defaults to 10
+            pca_batch_size: Number of rows to update the robust PCA with at once. Defaults to None, which
+                will update one row at a time
+            use_fast_stats: Whether to use the fast sigma-clipped statistics (see
+                pjpipe.utils.fast_sigma_clipped_stats) rather than astropy's. Defaults to False
+            mask_cache_dir: Directory to cache source masks in. Masks are keyed on the data and masking
+                parameters, so can be shared between steps and re-runs. Defaults to None, which will not
+                cache masks
+            incremental: Whether to only rerun files that are new or have changed since the last run, tracked
+                with a build manifest in the output directory. Defaults to False
             overwrite: Whether to overwrite or not. Defaults to False
         """
 
@@ -260,8 +272,15 @@ class SingleTileDestripeStep:
         self.filter_extend_mode = filter_extend_mode
         self.pca_components = pca_components
         self.pca_reconstruct_components = pca_reconstruct_components
+        self.pca_batch_size = pca_batch_size
+        self.use_fast_stats = use_fast_stats
+        self.mask_cache_dir = mask_cache_dir
+        self.incremental = incremental
         self.overwrite = overwrite
 
+        # Whether an incremental run has changed any outputs, so later steps need rerunning
+        self.files_changed = False
+
         # To keep track of whether we're applying flat-fielding or not
         self.are_rate_files = False
 
@@ -282,7 +301,7 @@ class SingleTileDestripeStep:
             self.out_dir,
             "single_tile_destripe_step_complete.txt",
         )
-        if os.path.exists(step_complete_file):
+        if os.path.exists(step_complete_file) and not self.incremental:
             log.info("Step already run")
             return True
 
@@ -294,21 +313,27 @@ class SingleTileDestripeStep:
         )
         files.sort()
 
-        are_rate_files = False
-        for file in files:
-            if "rate.fits" in file:
-                are_rate_files = True
+        # Only rerun new or changed files, if requested
+        manifest = None
+        if self.incremental:
+            manifest = BuildManifest(
+                out_dir=self.out_dir,
+                step_name="single_tile_destripe",
+                parameters=vars(self),
+            )
+            all_files = copy.deepcopy(files)
+            removed_files = manifest.remove_missing_files(all_files)
+            files = manifest.get_stale_files(files)
 
-        if are_rate_files:
-            log.info("Rate files detected. Will apply flats before measuring striping")
-            # Prefetch references so things don't break with parallelism
-            for file in files:
-                config = calwebb_image2.Image2Pipeline.get_config_from_reference(file)
-                im2 = calwebb_image2.Image2Pipeline.from_config_section(config)
-                im2._precache_references(file)
-                del im2
+            self.files_changed = len(files) > 0 or len(removed_files) > 0
 
-        self.are_rate_files = are_rate_files
+            if len(files) == 0:
+                log.info("Step already run")
+                return True
+
+            log.info(f"Rerunning {len(files)} of {len(all_files)} files")
+
+        self.prepare_files(files)
 
         # Ensure we're not wasting processes
         procs = np.nanmin([self.procs, len(files)])
@@ -323,11 +348,40 @@ class SingleTileDestripeStep:
             log.warning("Failures detected in destriping")
             return False
 
+        if manifest is not None:
+            manifest.update(files)
+
         with open(step_complete_file, "w+") as f:
             f.close()
 
         return True
 
+    def prepare_files(
+            self,
+            files,
+    ):
+        """Check whether we're destriping rate files, and if so prefetch the flat references
+
+        Args:
+            files: List of files to destripe
+        """
+
+        are_rate_files = False
+        for file in files:
+            if "rate.fits" in file:
+                are_rate_files = True
+
+        if are_rate_files:
+            log.info("Rate files detected. Will apply flats before measuring striping")
+            # Prefetch references so things don't break with parallelism
+            for file in files:
+                config = calwebb_image2.Image2Pipeline.get_config_from_reference(file)
+                im2 = calwebb_image2.Image2Pipeline.from_config_section(config)
+                im2._precache_references(file)
+                del im2
+
+        self.are_rate_files = are_rate_files
+
     def run_step(
             self,
             files,
@@ -379,109 +433,133 @@ class SingleTileDestripeStep:
             im = datamodels.open(file)
 
             short_name = os.path.split(file)[-1]
-            out_name = os.path.join(
-                self.out_dir,
-                short_name,
-            )
-
-            # Check if this is a subarray
-            is_subarray = "sub" in im.meta.subarray.name.lower()
 
-            quadrants = copy.deepcopy(self.quadrants)
-            if is_subarray:
-                # Force off quadrants if we're in subarray mode
-                quadrants = False
-
-            # Only level if we're not doing vertical subtraction, otherwise this should
-            # be taken care of
-            if quadrants and not self.vertical_subtraction:
-                im.data = level_data(im)
-
-            full_noise_model = np.zeros_like(im.data)
-
-            # Do vertical subtraction, if requested
-            if self.vertical_subtraction:
-                full_noise_model += self.run_vertical_subtraction(
-                    im=im,
-                    prev_noise_model=full_noise_model,
-                    is_subarray=is_subarray,
+            for out_short_name, out_im in self.process_model(im, short_name):
+                out_im.save(
+                    os.path.join(
+                        self.out_dir,
+                        out_short_name,
+                    )
                 )
 
-            if self.destriping_method == "row_median":
-                full_noise_model += self.run_row_median(
-                    im=im,
-                    prev_noise_model=full_noise_model,
-                    out_name=out_name,
-                    quadrants=quadrants,
-                )
-            elif self.destriping_method == "median_filter":
-                full_noise_model += self.run_median_filter(
-                    im=im,
-                    prev_noise_model=full_noise_model,
-                    out_name=out_name,
-                    quadrants=quadrants,
-                )
-            elif self.destriping_method == "remstripe":
-                full_noise_model += self.run_remstriping(
-                    im=im,
-                    prev_noise_model=full_noise_model,
-                    out_name=out_name,
-                    is_subarray=is_subarray,
-                    quadrants=quadrants,
-                )
-            elif self.destriping_method == "smooth":
-                full_noise_model += self.run_smooth(
-                    im=im,
-                    prev_noise_model=full_noise_model,
-                    out_name=out_name,
-                    is_subarray=is_subarray,
-                    quadrants=quadrants,
-                )
-            elif self.destriping_method == "pca":
-                pca_dir = os.path.join(
-                    self.out_dir,
-                    "pca",
-                )
-                if not os.path.exists(pca_dir):
-                    os.makedirs(pca_dir)
-                pca_file = os.path.join(
-                    pca_dir,
-                    short_name.replace(".fits", ".pkl"),
-                )
+            del im
 
-                full_noise_model += self.run_pca_denoise(
-                    im=im,
-                    prev_noise_model=full_noise_model,
-                    pca_file=pca_file,
-                    out_name=out_name,
-                    is_subarray=is_subarray,
-                    quadrants=quadrants,
-                )
-            else:
-                raise NotImplementedError(
-                    f"Destriping method {self.destriping_method} not implemented"
-                )
+            return True
+
+    def process_model(
+            self,
+            im,
+            short_name,
+    ):
+        """Destripe an open datamodel
+
+        Args:
+            im: Input datamodel
+            short_name: Filename (without directory) of the datamodel
 
-            zero_idx = np.where(im.data == 0)
-            nan_idx = np.where(np.isnan(im.data))
+        Returns:
+            List of (filename, datamodel) tuples to write out
+        """
 
-            im.data -= full_noise_model
+        out_name = os.path.join(
+            self.out_dir,
+            short_name,
+        )
 
-            im.data[zero_idx] = 0
-            im.data[nan_idx] = np.nan
+        # Check if this is a subarray
+        is_subarray = "sub" in im.meta.subarray.name.lower()
 
-            if self.plot_dir is not None:
-                self.make_destripe_plot(
-                    in_im=im,
-                    noise_model=full_noise_model,
-                    out_name=out_name,
-                )
+        quadrants = copy.deepcopy(self.quadrants)
+        if is_subarray:
+            # Force off quadrants if we're in subarray mode
+            quadrants = False
 
-            im.save(out_name)
+        # Only level if we're not doing vertical subtraction, otherwise this should
+        # be taken care of
+        if quadrants and not self.vertical_subtraction:
+            im.data = level_data(im, use_fast_stats=self.use_fast_stats)
 
-            del im
+        full_noise_model = np.zeros_like(im.data)
 
-            return True
+        # Do vertical subtraction, if requested
+        if self.vertical_subtraction:
+            full_noise_model += self.run_vertical_subtraction(
+                im=im,
+                prev_noise_model=full_noise_model,
+                is_subarray=is_subarray,
+            )
+
+        if self.destriping_method == "row_median":
+            full_noise_model += self.run_row_median(
+                im=im,
+                prev_noise_model=full_noise_model,
+                out_name=out_name,
+                quadrants=quadrants,
+            )
+        elif self.destriping_method == "median_filter":
+            full_noise_model += self.run_median_filter(
+                im=im,
+                prev_noise_model=full_noise_model,
+                out_name=out_name,
+                quadrants=quadrants,
+            )
+        elif self.destriping_method == "remstripe":
+            full_noise_model += self.run_remstriping(
+                im=im,
+                prev_noise_model=full_noise_model,
+                out_name=out_name,
+                is_subarray=is_subarray,
+                quadrants=quadrants,
+            )
+        elif self.destriping_method == "smooth":
+            full_noise_model += self.run_smooth(
+                im=im,
+                prev_noise_model=full_noise_model,
+                out_name=out_name,
+                is_subarray=is_subarray,
+                quadrants=quadrants,
+            )
+        elif self.destriping_method == "pca":
+            pca_dir = os.path.join(
+                self.out_dir,
+                "pca",
+            )
+            if not os.path.exists(pca_dir):
+                os.makedirs(pca_dir)
+            pca_file = os.path.join(
+                pca_dir,
+                short_name.replace(".fits", ".pkl"),
+            )
+
+            full_noise_model += self.run_pca_denoise(
+                im=im,
+                prev_noise_model=full_noise_model,
+                pca_file=pca_file,
+                out_name=out_name,
+                is_subarray=is_subarray,
+                quadrants=quadrants,
+            )
+        else:
+            raise NotImplementedError(
+                f"Destriping method {self.destriping_method} not implemented"
+            )
+
+        zero_idx = np.where(im.data == 0)
+        nan_idx = np.where(np.isnan(im.data))
+
+        im.data -= full_noise_model
+
+        im.data[zero_idx] = 0
+        im.data[nan_idx] = np.nan
+
+        if self.plot_dir is not None:
+            self.make_destripe_plot(
+                in_im=im,
+                noise_model=full_noise_model,
+                out_name=out_name,
+            )
+
+        return [(short_name, im)]
 
     def run_vertical_subtraction(
             self,
@@ -517,6 +595,7 @@ class SingleTileDestripeStep:
             npixels=self.npixels,
             dilate_size=self.dilate_size,
             sigclip_iters=self.max_iters,
+            cache_dir=self.mask_cache_dir,
         )
 
         dq_mask = get_dq_mask(
@@ -640,6 +719,7 @@ class SingleTileDestripeStep:
             npixels=self.npixels,
             dilate_size=self.dilate_size,
             sigclip_iters=self.max_iters,
+            cache_dir=self.mask_cache_dir,
         )
 
         dq_mask = get_dq_mask(
@@ -692,6 +772,7 @@ class SingleTileDestripeStep:
                     mask=mask_quadrants,
                     sigma=self.sigma,
                     maxiters=self.max_iters,
+                    use_fast_stats=self.use_fast_stats,
                     axis=1,
                 )[1]
 
@@ -709,6 +790,7 @@ class SingleTileDestripeStep:
                     mask=mask_quadrants,
                     sigma=self.sigma,
                     maxiters=self.max_iters,
+                    use_fast_stats=self.use_fast_stats,
                     axis=0,
                 )[1]
 
@@ -724,6 +806,7 @@ class SingleTileDestripeStep:
                 mask=mask,
                 sigma=self.sigma,
                 maxiters=self.max_iters,
+                use_fast_stats=self.use_fast_stats,
                 axis=1,
             )[1]
 
@@ -790,6 +873,7 @@ class SingleTileDestripeStep:
             npixels=self.npixels,
             dilate_size=self.dilate_size,
             sigclip_iters=self.max_iters,
+            cache_dir=self.mask_cache_dir,
         )
 
         dq_mask = get_dq_mask(
@@ -843,6 +927,7 @@ class SingleTileDestripeStep:
                         mask=mask_quadrants,
                         sigma=self.sigma,
                         maxiters=self.max_iters,
+                        use_fast_stats=self.use_fast_stats,
                         axis=1,
                     )
 
@@ -866,6 +951,7 @@ class SingleTileDestripeStep:
                     mask=mask,
                     sigma=self.sigma,
                     maxiters=self.max_iters,
+                    use_fast_stats=self.use_fast_stats,
                     axis=1,
                 )
 
@@ -936,6 +1022,7 @@ class SingleTileDestripeStep:
             npixels=self.npixels,
             dilate_size=self.dilate_size,
             sigclip_iters=self.max_iters,
+            cache_dir=self.mask_cache_dir,
         )
 
         dq_mask = get_dq_mask(data=im_data, err=im.err, dq=im.dq)
@@ -959,6 +1046,7 @@ class SingleTileDestripeStep:
             mask=mask,
             sigma=self.sigma,
             maxiters=self.max_iters,
+            use_fast_stats=self.use_fast_stats,
         )
 
         data -= data_med
@@ -1120,6 +1208,7 @@ class SingleTileDestripeStep:
             mask=original_mask,
             sigma=self.sigma,
             maxiters=self.max_iters,
+            use_fast_stats=self.use_fast_stats,
         )[1]
         full_noise_model -= noise_med
 
@@ -1176,6 +1265,7 @@ class SingleTileDestripeStep:
             save_extra_param=False,
             number_of_iterations=3,
             c_sq=0.787 ** 2,
+            batch_size=self.pca_batch_size,
         )
 
         return eigen_system_dict
@@ -1241,6 +1331,7 @@ class SingleTileDestripeStep:
             nsigma=self.sigma,
             npixels=self.npixels,
             dilate_size=self.dilate_size,
+            cache_dir=self.mask_cache_dir,
         )
 
         dq_mask = get_dq_mask(
@@ -1275,6 +1366,7 @@ class SingleTileDestripeStep:
                     mask=mask_quadrants,
                     sigma=self.sigma,
                     maxiters=self.max_iters,
+                    use_fast_stats=self.use_fast_stats,
                     axis=1,
                 )[1]
 
@@ -1291,6 +1383,7 @@ class SingleTileDestripeStep:
                 mask=mask,
                 sigma=self.sigma,
                 maxiters=self.max_iters,
+                use_fast_stats=self.use_fast_stats,
                 axis=1,
             )[1]
 
@@ -1343,6 +1436,7 @@ class SingleTileDestripeStep:
             nsigma=self.sigma,
             npixels=self.npixels,
             dilate_size=self.dilate_size,
+            cache_dir=self.mask_cache_dir,
         )
         dq_mask = get_dq_mask(
             data=im_data,
@@ -1465,6 +1559,7 @@ class SingleTileDestripeStep:
             mask=mask,
             sigma=self.sigma,
             maxiters=self.max_iters,
+            use_fast_stats=self.use_fast_stats,
         )
 
         data_filter, high_sn_mask = butterworth_filter(
@@ -1483,6 +1578,7 @@ class SingleTileDestripeStep:
             npixels=10,
             dilate_size=self.dilate_size,
             sigclip_iters=self.max_iters,
+            cache_dir=self.mask_cache_dir,
         )
 
         # Create a negative mask with relatively strong
@@ -1493,6 +1589,7 @@ class SingleTileDestripeStep:
             nsigma=self.sigma,
             npixels=self.npixels,
             sigclip_iters=self.max_iters,
+            cache_dir=self.mask_cache_dir,
         )
 
         mask = mask_pos | mask_neg | dq_mask
@@ -19,6 +19,8 @@ NOTES:
     rather than the initalise amount
 """
 
+import time
+
 import numpy as np
 from . import vwpca_inc as vwpca
 
@@ -71,7 +73,9 @@ def do_initial_SVD(data):
         Singular values of the SVD decomposition
 
     """
-    singular_values, eigen_vectors_T = np.linalg.svd(data)[1:]
+    # We only need the right singular vectors, so avoid building the full
+    # [number of spectra, number of spectra] left matrix
+    singular_values, eigen_vectors_T = np.linalg.svd(data, full_matrices=False)[1:]
     return eigen_vectors_T, singular_values
 
 
@@ -496,6 +500,7 @@ def run_robust_pca(
     memory=1,
     save_extra_param=False,
     c_sq=1,
+    batch_size=None,
 ):
     """
     Main wrapper to perform the robust pca method on an entire dataset.
@@ -531,6 +536,12 @@ def run_robust_pca(
         the eigen system is return. When true extra parameters to track
         how the robust PCA changes for each incriment is returned.
         The default is False.
+    c_sq : float, optional
+        Parameter for setting when the robust function downweights
+        outliers. The default is 1.
+    batch_size : None type or int, optional
+        Number of spectra to update the eigen system with at once. If None
+        or 1, will update one spectrum at a time. The default is None.
 
     Returns
     -------
@@ -558,31 +569,49 @@ def run_robust_pca(
         breakdown_point=breakdown_point,
     )
 
-    if errors is not None:
+    if batch_size is None:
+        batch_size = 1
+
+    if batch_size > 1:
+        pca_function = vwpca.iterate_PCA_batch
+    elif errors is not None:
         pca_function = vwpca.iterate_PCA_with_data_gaps
     else:
         pca_function = vwpca.iterate_PCA
-        # Makes a None list of length `amount_of_spectra`
-        errors = [None] * amount_of_spectra
 
     counter = 0
-    save_amount = amount_of_spectra * number_of_iterations - amount_to_initalise + 1
+    save_amount = (
+        len(range(amount_to_initalise, amount_of_spectra, batch_size))
+        + (number_of_iterations - 1) * len(range(0, amount_of_spectra, batch_size))
+        + 1
+    )
     tracked_eigen_system_dict = {}
 
     # Need to skip the data we used to initalise the eigenbasis
     start = amount_to_initalise
 
     for k in range(number_of_iterations):
-        for sp in range(start, amount_of_spectra):
+        for sp in range(start, amount_of_spectra, batch_size):
             tracked_eigen_system_dict, counter = track_eigensystem_updates(
                 counter, eigen_system_dict, tracked_eigen_system_dict, save_amount
             )
 
+            if batch_size > 1:
+                new_spectra = data[sp: sp + batch_size]
+                error_array = None
+                if errors is not None:
+                    error_array = errors[sp: sp + batch_size]
+            else:
+                new_spectra = data[sp]
+                error_array = None
+                if errors is not None:
+                    error_array = errors[sp]
+
             eigen_system_dict = pca_function(
                 eigen_system_dict=eigen_system_dict,
-                new_spectra=data[sp],
+                new_spectra=new_spectra,
                 alpha=forget_param,
-                error_array=errors[sp],
+                error_array=error_array,
                 delta=breakdown_point,
                 c_sq=c_sq,
             )
@@ -671,8 +700,107 @@ def initialise_tracked_eigen_updates(save_amount, amount_of_eigen):
     return tracked_eigen_system
 
 
+def compare_batch_robust_pca(
+    data,
+    errors=None,
+    batch_size=64,
+    amount_of_eigen=50,
+    number_of_iterations=3,
+    c_sq=0.787**2,
+):
+    """
+    Benchmark the batch robust PCA against the per-spectrum algorithm.
+
+    Runs both on the same data, and compares the runtime and the
+    eigenvectors. Since eigenvectors are only defined up to a sign (and
+    near-degenerate ones can mix), these are compared using the cosines
+    of the principal angles between the two eigenbases. The defaults
+    match those used in single_tile_destripe.
+
+    Parameters
+    ----------
+    data : array_like
+        Unordered data matrix
+        Dimensions:  [Number of spectra, length of spectra]
+    errors : None type or array_like, optional
+        Array containing the data errors, where zero indicates where the
+        data is bad and needs replacing. If None, assumes all the data is valid
+        The default is None.
+    batch_size : int, optional
+        Number of spectra to update the eigen system with at once in the
+        batch algorithm. The default is 64.
+    amount_of_eigen : int, optional
+        Number of eigen vectors to keep. The default is 50.
+    number_of_iterations : int, optional
+        Number of times to run the robust pca method. The default is 3.
+    c_sq : float, optional
+        Parameter for setting when the robust function downweights
+        outliers. The default is 0.787**2.
+
+    Returns
+    -------
+    comparison_dict : dict
+        Dictionary containing the runtimes of each algorithm ("time_single",
+        "time_batch"), and the cosines of the principal angles between
+        the eigenbases ("cos_angles")
+
+    """
+    eigen_systems = {}
+    times = {}
+
+    for name, size in zip(["single", "batch"], [None, batch_size]):
+        start_time = time.perf_counter()
+        eigen_systems[name] = run_robust_pca(
+            data,
+            errors=errors,
+            amount_of_eigen=amount_of_eigen,
+            number_of_iterations=number_of_iterations,
+            c_sq=c_sq,
+            batch_size=size,
+        )
+        times[name] = time.perf_counter() - start_time
+
+    cos_angles = np.linalg.svd(
+        np.matmul(eigen_systems["single"]["U"].T, eigen_systems["batch"]["U"]),
+        compute_uv=False,
+    )
+
+    comparison_dict = {
+        "time_single": times["single"],
+        "time_batch": times["batch"],
+        "cos_angles": cos_angles,
+    }
+
+    return comparison_dict
+
+
 def main():
-    pass
+    # Benchmark the batch robust PCA on synthetic data shaped like a
+    # single_tile_destripe quadrant. The quadrant has 2048 rows, and the
+    # PCA is fit to its columns (plus rolled copies), so each "spectrum"
+    # is 2048 long
+    rng = np.random.default_rng(42)
+
+    n_spectra, n_pixels, n_components = 1024, 2048, 50
+    components = rng.normal(size=[n_components, n_pixels])
+    scores = rng.normal(size=[n_spectra, n_components]) * np.linspace(5, 1, n_components)
+    data = np.matmul(scores, components) + 0.1 * rng.normal(size=[n_spectra, n_pixels])
+
+    # Mask out a few pixels, like sources in the destriping
+    errors = np.ones_like(data)
+    errors[rng.random(size=data.shape) < 0.05] = 0
+    data[errors == 0] = 0
+
+    comparison_dict = compare_batch_robust_pca(
+        data,
+        errors=errors,
+        amount_of_eigen=n_components,
+    )
+
+    print(f"Per-spectrum runtime: {comparison_dict['time_single']:.2f}s")
+    print(f"Batch runtime: {comparison_dict['time_batch']:.2f}s")
+    print(f"Speedup: {comparison_dict['time_single'] / comparison_dict['time_batch']:.1f}x")
+    print(f"Minimum eigenbasis principal angle cosine: {np.min(comparison_dict['cos_angles']):.4f}")
 
 
 if __name__ == "__main__":
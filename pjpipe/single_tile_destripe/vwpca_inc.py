@@ -727,6 +727,65 @@ def get_filled_observation_vector(new_spectra, eigen_vectors, mean_prev, error_a
     return observation_vector, reconstructed_spectra
 
 
+def get_filled_observation_vectors(
+    new_spectra, eigen_vectors, mean_prev, error_array
+):
+    """
+    Vectorised version of get_filled_observation_vector, for a batch of
+    spectra at once. None of the spectra should be entirely bad data.
+
+    Parameters
+    ----------
+    new_spectra : array_like
+        Origional data spectra
+        Dimensions: [number of spectra, length of spectra]
+    eigen_vectors : 2d array_like matrix
+        Matrix containing the final eigen vectors
+    mean_prev : array_like
+        Location estimate
+    error_array : array_like
+        Error estimates of the data, where zeros represent bad pixels in the
+        spectra
+        Dimensions: [number of spectra, length of spectra]
+    Returns
+    -------
+    observation_vectors: array_like
+        array containing the data - mean
+        Dimensions: [number of spectra, length of spectra]
+    reconstructed_data : array_like
+        Array conaining the reconstructed data
+        Dimensions: [number of spectra, length of spectra]
+    """
+    where_bad = bool_mask_of_bad_data(error_array)
+    # Copy to ensure we have a new memory reference
+    binary_error_array = np.copy(error_array)
+    binary_error_array[~where_bad] = 1
+
+    principle_component_scores, normalisation = gappy.run_normgappy(
+        error_array=binary_error_array,
+        data=new_spectra,
+        mean_array=mean_prev,
+        eigen_vectors=eigen_vectors,
+    )
+
+    reconstructed_spectra = reconstruct_observation_with_scores(
+        principle_component_scores, eigen_vectors
+    )
+
+    # Bad values are filled from the reconstruction, good values renormalised
+    filled_spectra = np.where(
+        where_bad,
+        reconstructed_spectra + mean_prev,
+        new_spectra / normalisation,
+    )
+
+    observation_vectors = get_observation_vector(
+        new_spectra=filled_spectra, previous_mean_spectra=mean_prev
+    )
+
+    return observation_vectors, reconstructed_spectra
+
+
 def iterate_PCA_with_data_gaps(
     eigen_system_dict,
     new_spectra,
@@ -982,6 +1041,221 @@ def PCA_from_residuals(
     return eigen_system_dict
 
 
+def iterate_PCA_batch(
+    eigen_system_dict,
+    new_spectra,
+    alpha,
+    error_array=None,
+    delta=0.5,
+    robust_function=cauchy_like_function,
+    robust_derivative=derivate_of_cauchy_like_function,
+    c_sq=1,
+):
+    """
+    Main wrapper function for calculating robust pca from a batch of spectra
+    at once. The residuals for the whole batch are calculated from the current
+    eigen system, and then the eigen system is updated with a single SVD. If
+    an error array is given, gaps should be entered as zeros.
+
+    Parameters
+    ----------
+    eigen_system_dict : dictionary
+        Dictionary containing the eigenbasis, location (i.e., mean),
+        scale squared (sigma squared) and robust weights (vqu).
+    new_spectra : array_like
+        Current spectra to iterate the PCA with
+        Dimensions: [number of spectra, length of spectra]
+    alpha : float
+        'The forget' parameter. Value between 0 to 1. Contols how long
+        previous solutions influence the current solution
+    error_array : None type or array_like, optional
+        Error estimates of the data, where zeros represent bad pixels in the
+        spectra. If None, assumes all the data is valid. The default is None.
+    delta : float, optional
+        Delta is the breakdown point (between 0 to 0.5). The default is 0.5.
+    robust_function : function, optional
+        Function used to downweight outliers. The default is cauchy_like_function.
+    robust_derivative : function, optional
+        Derivative of the function used to downweight outliers.
+        The default is derivate_of_cauchy_like_function.
+    c_sq : float, optional
+        Parameter for setting when the robust function downweights
+        outliers. The default is 1.
+
+    Returns
+    -------
+    eigen_system_dict : dictionary
+        Dictionary containing the updated eigenbasis, location (i.e., mean),
+        scale squared (sigma squared) and robust weights (vqu).
+    """
+    eigen_vectors = eigen_system_dict["U"]
+    mean_prev = eigen_system_dict["m"]
+
+    if error_array is not None:
+        # Spectra that are entirely bad data can't be filled, so drop them
+        good_spectra = gappy.where_data_all_good(error_array)
+        if len(good_spectra) == 0:
+            return eigen_system_dict
+
+        observation_vectors, reconstructed_spectra = get_filled_observation_vectors(
+            new_spectra[good_spectra],
+            eigen_vectors,
+            mean_prev,
+            error_array[good_spectra],
+        )
+        residuals = observation_vectors - reconstructed_spectra
+    else:
+        observation_vectors = get_observation_vector(
+            new_spectra=new_spectra, previous_mean_spectra=mean_prev
+        )
+        residuals = get_residual(
+            observation_vector=observation_vectors, eigen_vector_matrix=eigen_vectors
+        )
+
+    eigen_system_dict = PCA_from_residuals_batch(
+        eigen_system_dict,
+        residuals,
+        observation_vectors,
+        alpha,
+        delta=delta,
+        robust_function=robust_function,
+        robust_derivative=robust_derivative,
+        c_sq=c_sq,
+    )
+
+    return eigen_system_dict
+
+
+def PCA_from_residuals_batch(
+    eigen_system_dict,
+    residuals,
+    observation_vectors,
+    alpha,
+    delta=0.5,
+    robust_function=cauchy_like_function,
+    robust_derivative=derivate_of_cauchy_like_function,
+    c_sq=1,
+):
+    """
+    Wrapper function to calculate one batch iteration of robust PCA.
+
+    The running weights, mean and scale are updated spectrum by spectrum as
+    in PCA_from_residuals (these are cheap scalar updates). Rather than
+    doing an SVD per spectrum, each new vector a is appended to the summary
+    of the eigensystem, scaled by the forgetting of all the later updates
+    in the batch, and the new eigensystem is found with a single SVD.
+
+    Parameters
+    ----------
+    eigen_system_dict : dictionary
+        Dictionary containing the eigenbasis, location (i.e., mean),
+        scale squared (sigma squared) and robust weights (vqu).
+    residuals : array_like
+        The residuals of the data to the pca reconstructed data
+        Dimensions: [number of spectra, length of spectra]
+    observation_vectors: array_like
+        array containing the data - mean
+        Dimensions: [number of spectra, length of spectra]
+    alpha : float
+        'The forget' parameter. Value between 0 to 1. Contols how long
+        previous solutions influence the current solution
+    delta : float, optional
+        Delta is the breakdown point (between 0 to 0.5). The default is 0.5.
+    robust_function : function, optional
+        Function used to downweight outliers. The default is cauchy_like_function.
+    robust_derivative : function, optional
+        Derivative of the function used to downweight outliers.
+        The default is derivate_of_cauchy_like_function.
+    c_sq : float, optional
+        Parameter for setting when the robust function downweights
+        outliers. The default is 1.
+
+    Returns
+    -------
+    eigen_system_dict : dictionary
+        Dictionary containing the updated eigenbasis, location (i.e., mean),
+        scale squared (sigma squared) and robust weights (vqu).
+    """
+    eigen_vectors = eigen_system_dict["U"]  # eigenvectors as (nbin,nvec) array
+    eigen_values = eigen_system_dict["W"]  # eigenvalues (nvec) vector
+    mean_prev = eigen_system_dict["m"]  # mean (nbin) vector
+    vqu_prev = eigen_system_dict["vqu"]  # running weights 1x3 array
+    sigma_sq = eigen_system_dict["sig2"]  # scale float
+
+    mag_residuals_sq = np.nansum(residuals**2, axis=1)
+    amount_of_spectra = len(mag_residuals_sq)
+
+    mean_weights = np.zeros(amount_of_spectra)
+    a_scales = np.zeros(amount_of_spectra)
+    gamma2s = np.zeros(amount_of_spectra)
+
+    for sp in range(amount_of_spectra):
+        weight1 = robust_derivative(t=mag_residuals_sq[sp] / sigma_sq, c_sq=c_sq)
+
+        weight_coefficants = get_vqu_coeficents(
+            robust_derivative=weight1, mag_residuals_sq=mag_residuals_sq[sp]
+        )
+
+        vqu_new = update_vqu(vqu_prev=vqu_prev, weights=weight_coefficants, alpha=alpha)
+
+        gammas123 = get_gammas(vqu=vqu_new, vqu_prev=vqu_prev, alpha=alpha)
+
+        # Must update scale BEFORE calculating the new a vector
+        sigma_sq = update_scale_sq(
+            scale_sq_prev=sigma_sq,
+            mag_residuals_sq=mag_residuals_sq[sp],
+            gamma3=gammas123[2],
+            delta=delta,
+            c_sq=c_sq,
+            robust_function=robust_function,
+        )
+
+        mean_weights[sp] = 1 - gammas123[0]
+        a_scales[sp] = np.sqrt(
+            (1 - gammas123[1]) * sigma_sq / mag_residuals_sq[sp]
+        )
+        gamma2s[sp] = gammas123[1]
+
+        vqu_prev = vqu_new
+
+    eigen_system_dict["vqu"] = vqu_prev
+    eigen_system_dict["sig2"] = sigma_sq
+    eigen_system_dict["m"] = mean_prev + np.matmul(mean_weights, observation_vectors)
+
+    # Each update is forgotten by all the gamma2s that come after it in the batch
+    gamma2_cumprod = np.cumprod(gamma2s[::-1])[::-1]
+    a_forget = np.append(gamma2_cumprod[1:], 1)
+
+    A = get_A_current(
+        eigen_vector_matrix=eigen_vectors,
+        eigen_values=eigen_values,
+        gamma2=gamma2_cumprod[0],
+    )
+
+    a_next = (a_scales * np.sqrt(a_forget))[:, None] * observation_vectors
+
+    A_new = np.append(A, a_next.T, axis=1)
+
+    # singular_values_B are the eigenvalues since B is a square array
+    eigen_vectors_B, singular_values_B = do_SVD_of_AtA(A_new=A_new)
+
+    eigen_vectors_new, eigen_values_new = update_eigen_system(
+        eigen_vectors_B=eigen_vectors_B,
+        singular_values_B=singular_values_B,
+        A_new=A_new,
+        No_of_vectors=len(eigen_values),
+    )
+
+    eigen_vectors_new_normed = normalise_eigen_vectors(
+        eigen_vectors=eigen_vectors_new, eigen_values=eigen_values_new
+    )
+
+    eigen_system_dict["U"] = eigen_vectors_new_normed
+    eigen_system_dict["W"] = eigen_values_new
+
+    return eigen_system_dict
+
+
 def main():
     pass
 
@@ -306,8 +306,8 @@ def get_ammended_weigthed_correlation_matrix(
 
     """
     M1 = mean_dot_data[:, None, None] * weighted_eigen_transpose_by_eigen
-    # vectorised
-    M2 = np.tensordot(weighted_scores, mean_scores, axes=0)[0, :, 0]
+    # vectorised, with the outer product taken separately for each data vector
+    M2 = np.einsum("ni,nj->nij", weighted_scores, mean_scores)
 
     new_correlation_matrix = M1 - M2
 
@@ -437,10 +437,12 @@ def get_normalisation(mean_dot_data, mean_dot_mean, principle_comp_scores, mean_
     normalisation : array_like
         The normalisation for the non-filled data to correct the scaling
         after adding data to the gapped data
+        Dimensions : [number of data vectors, 1]
 
     """
     normalisation = mean_dot_data[:, None] / (
-        mean_dot_mean[:, None] + np.sum(principle_comp_scores * mean_scores, axis=1)
+        mean_dot_mean[:, None]
+        + np.sum(principle_comp_scores * mean_scores, axis=1)[:, None]
     )
 
     return normalisation
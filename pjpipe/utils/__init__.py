@@ -4,6 +4,7 @@ from .utils import (
     get_band_type,
     get_band_ext,
     get_obs_table,
+    get_obs_headers,
     load_toml,
     get_kws,
     attribute_setter,
@@ -19,9 +20,16 @@ from .utils import (
     level_data,
     save_file,
     make_stacked_image,
+    get_bounding_box,
+    get_overlapping_pairs,
+    get_sip_header,
 )
+from .manifest import BuildManifest
+from .staging import archive_directory, prune_fits_file, stage_file, stage_files
+from .stats import fast_sigma_clipped_stats, sigma_clipped_stats
 
 __all__ = [
+    "BuildManifest",
     "attribute_setter",
     "do_jwst_convolution",
     "get_pixscale",
@@ -29,6 +37,7 @@ __all__ = [
     "get_band_ext",
     "get_kws",
     "get_obs_table",
+    "get_obs_headers",
     "load_toml",
     "parse_fits_to_table",
     "get_dq_bit_mask",
@@ -42,4 +51,13 @@ __all__ = [
     "level_data",
     "save_file",
     "make_stacked_image",
+    "get_bounding_box",
+    "get_overlapping_pairs",
+    "get_sip_header",
+    "fast_sigma_clipped_stats",
+    "sigma_clipped_stats",
+    "archive_directory",
+    "prune_fits_file",
+    "stage_file",
+    "stage_files",
 ]
@@ -0,0 +1,217 @@
+import hashlib
+import json
+import logging
+import os
+
+import jwst
+
+from .. import __version__
+
+log = logging.getLogger("stpipe")
+log.addHandler(logging.NullHandler())
+
+# Bump this if the manifest layout changes, so old manifests trigger a full rebuild
+MANIFEST_VERSION = 2
+
+# Step attributes that don't change the outputs, so shouldn't trigger rebuilds
+MANIFEST_IGNORED_PARAMETERS = [
+    "in_dir",
+    "out_dir",
+    "plot_dir",
+    "procs",
+    "overwrite",
+    "incremental",
+    "are_rate_files",
+    "files_changed",
+]
+
+
+class BuildManifest:
+    def __init__(
+        self,
+        out_dir,
+        step_name,
+        parameters,
+    ):
+        """Record what went into a step's outputs, so only changed inputs are rebuilt
+
+        The manifest stores the size and modification time of each input file and the
+        outputs built from it, a hash of the step parameters, and the pjpipe/jwst versions.
+        If the parameters or versions change, everything is rebuilt, otherwise only new or
+        modified inputs, or inputs with missing outputs, are
+
+        Args:
+            out_dir: Step output directory, where the manifest will be saved
+            step_name: Name of the step
+            parameters: Dictionary of resolved step parameters. Anything in
+                MANIFEST_IGNORED_PARAMETERS will be ignored
+        """
+
+        self.out_dir = out_dir
+        self.manifest_file = os.path.join(
+            out_dir,
+            f"{step_name}_manifest.json",
+        )
+
+        parameters = {
+            k: v for k, v in parameters.items()
+            if k not in MANIFEST_IGNORED_PARAMETERS
+        }
+
+        self.build_info = {
+            "manifest_version": MANIFEST_VERSION,
+            "pjpipe_version": __version__,
+            "jwst_version": jwst.__version__,
+            "parameters": get_parameters_hash(parameters),
+        }
+
+        self.files = {}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, "r") as f:
+                manifest = json.load(f)
+
+            # If anything about the build has changed, start from scratch
+            if manifest.get("build_info", None) == self.build_info:
+                self.files = manifest["files"]
+            else:
+                log.info("Step parameters or versions have changed, will rebuild all files")
+
+                # Keep hold of the old outputs, so they can be cleaned up if their inputs have gone
+                self.files = {
+                    file: {
+                        "signature": None,
+                        "outputs": file_info.get("outputs", []),
+                    }
+                    for file, file_info in manifest.get("files", {}).items()
+                }
+
+    def get_stale_files(
+        self,
+        files,
+    ):
+        """Get the files that are new, have changed, or are missing outputs since the last build
+
+        Args:
+            files: List of input files
+        """
+
+        stale_files = []
+
+        for file in files:
+            file_info = self.files.get(os.path.split(file)[-1], None)
+
+            if file_info is None or file_info["signature"] != get_file_signature(file):
+                stale_files.append(file)
+                continue
+
+            # If any of the outputs have gone missing, we need to rebuild
+            outputs_exist = [
+                os.path.exists(os.path.join(self.out_dir, output))
+                for output in file_info["outputs"]
+            ]
+            if not all(outputs_exist):
+                stale_files.append(file)
+
+        return stale_files
+
+    def remove_missing_files(
+        self,
+        files,
+    ):
+        """Remove outputs for any inputs that are no longer present, and drop them from the manifest
+
+        Args:
+            files: List of current input files
+
+        Returns:
+            List of output files that were removed
+        """
+
+        short_files = [os.path.split(file)[-1] for file in files]
+        missing_files = [file for file in self.files if file not in short_files]
+
+        removed_outputs = []
+
+        for missing_file in missing_files:
+            for output in self.files[missing_file]["outputs"]:
+                output = os.path.join(self.out_dir, output)
+                if os.path.exists(output):
+                    os.remove(output)
+                    removed_outputs.append(output)
+
+            log.info(f"{missing_file} no longer present, removed outputs")
+            del self.files[missing_file]
+
+        if len(missing_files) > 0:
+            self.save()
+
+        return removed_outputs
+
+    def update(
+        self,
+        files,
+        outputs=None,
+    ):
+        """Record files as successfully built, and save the manifest
+
+        Args:
+            files: List of input files
+            outputs: Dictionary of the output files built from each input file. Only outputs
+                that exist will be recorded. Defaults to None, which assumes each input is
+                written to the output directory with the same filename
+        """
+
+        for file in files:
+            short_file = os.path.split(file)[-1]
+
+            if outputs is None:
+                file_outputs = [short_file]
+            else:
+                file_outputs = [os.path.split(output)[-1] for output in outputs[file]]
+
+            self.files[short_file] = {
+                "signature": get_file_signature(file),
+                "outputs": [
+                    output for output in file_outputs
+                    if os.path.exists(os.path.join(self.out_dir, output))
+                ],
+            }
+
+        self.save()
+
+    def save(self):
+        """Write out the manifest"""
+
+        manifest = {
+            "build_info": self.build_info,
+            "files": self.files,
+        }
+
+        # Write to a temporary file then move, so we never leave a half-written manifest
+        tmp_file = f"{self.manifest_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(tmp_file, self.manifest_file)
+
+
+def get_file_signature(file):
+    """Get a cheap signature (size and modification time) for a file"""
+
+    stat = os.stat(file)
+
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+    }
+
+
+def get_parameters_hash(parameters):
+    """Get a hash of a dictionary of parameters"""
+
+    parameters_str = json.dumps(
+        parameters,
+        sort_keys=True,
+        default=repr,
+    )
+
+    return hashlib.sha1(parameters_str.encode()).hexdigest()
@@ -0,0 +1,364 @@
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import tarfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from astropy.io import fits
+from tqdm import tqdm
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger("stpipe")
+log.addHandler(logging.NullHandler())
+
+ALLOWED_STAGE_STRATEGIES = [
+    "copy",
+    "hardlink",
+    "reflink",
+]
+
+ALLOWED_PRUNE_COMPRESSIONS = [
+    None,
+    "gzip",
+    "rice",
+]
+
+# Size of blocks to stream when copying FITS HDUs. Should be a multiple of the FITS
+# block size (2880 bytes)
+PRUNE_CHUNK_SIZE = 2880 * 4096
+
+# pax header used to record the contents of an archived directory
+ARCHIVE_HASH_KEY = "PJPIPE.content_hash"
+
+# ioctl request to clone a file as a copy-on-write reflink (Linux, on e.g. btrfs/XFS)
+FICLONE = 0x40049409
+
+
+def stage_file(
+        file,
+        out_name,
+        strategy="copy",
+):
+    """Stage a file into a new location, without going through python where possible
+
+    If the requested strategy isn't possible (e.g. hardlinking across filesystems,
+    or reflinking on a filesystem that doesn't support it), will fall back to a copy
+
+    Args:
+        file: File to stage
+        out_name: Output filename. If this is a directory, will keep the original filename
+        strategy: How to stage the file. Options are given by ALLOWED_STAGE_STRATEGIES:
+            - 'copy', which copies the file contents (using kernel-side copies where available)
+            - 'hardlink', which links to the original file. Note that this means the staged
+              file shares data with the original, so any edits in place will affect both
+            - 'reflink', which makes a copy-on-write clone of the file
+            Defaults to 'copy'
+
+    Returns:
+        The output filename
+    """
+
+    if strategy not in ALLOWED_STAGE_STRATEGIES:
+        raise ValueError(
+            f"strategy should be one of {ALLOWED_STAGE_STRATEGIES}, not {strategy}"
+        )
+
+    if os.path.isdir(out_name):
+        out_name = os.path.join(
+            out_name,
+            os.path.split(file)[-1],
+        )
+
+    # Links and clones can't overwrite, and we don't want to write through an
+    # existing link back into the original, so clear out anything already there
+    if os.path.lexists(out_name):
+        os.remove(out_name)
+
+    if strategy == "hardlink":
+        try:
+            os.link(file, out_name)
+            return out_name
+        except OSError:
+            log.debug(f"Could not hardlink {file}, falling back to copy")
+
+    elif strategy == "reflink":
+        if reflink_file(file, out_name):
+            return out_name
+        log.debug(f"Could not reflink {file}, falling back to copy")
+
+    shutil.copyfile(file, out_name)
+
+    return out_name
+
+
+def reflink_file(
+        file,
+        out_name,
+):
+    """Attempt to make a copy-on-write clone of a file
+
+    Args:
+        file: File to clone
+        out_name: Output filename
+
+    Returns:
+        True if the clone succeeded, False otherwise
+    """
+
+    if fcntl is None:
+        return False
+
+    try:
+        with open(file, "rb") as f_in, open(out_name, "wb") as f_out:
+            fcntl.ioctl(f_out.fileno(), FICLONE, f_in.fileno())
+    except OSError:
+        if os.path.exists(out_name):
+            os.remove(out_name)
+        return False
+
+    return True
+
+
+def stage_files(
+        files,
+        out_names,
+        strategy="copy",
+        procs=1,
+        desc="Staging files",
+        leave=True,
+):
+    """Stage a number of files in parallel
+
+    Since this is all I/O, this uses threads rather than processes
+
+    Args:
+        files: List of files to stage
+        out_names: List of output filenames (or directories)
+        strategy: How to stage the files. See stage_file. Defaults to 'copy'
+        procs: Number of threads to use. Defaults to 1
+        desc: Description for the progress bar. Defaults to 'Staging files'
+        leave: Whether to leave the progress bar once done. Defaults to True
+
+    Returns:
+        List of output filenames
+    """
+
+    if len(files) != len(out_names):
+        raise ValueError("files and out_names should be the same length")
+
+    if len(files) == 0:
+        return []
+
+    # Ensure we're not wasting threads
+    procs = max(min(procs, len(files)), 1)
+
+    staged_files = []
+
+    with ThreadPoolExecutor(max_workers=procs) as executor:
+        futures = [
+            executor.submit(
+                stage_file,
+                file,
+                out_name,
+                strategy=strategy,
+            )
+            for file, out_name in zip(files, out_names)
+        ]
+
+        for future in tqdm(
+                as_completed(futures),
+                ascii=True,
+                desc=desc,
+                total=len(futures),
+                leave=leave,
+        ):
+            staged_files.append(future.result())
+
+    return staged_files
+
+
+def prune_fits_file(
+        file,
+        out_name,
+        hdu_ext_to_delete=None,
+        compression=None,
+        chunk_size=PRUNE_CHUNK_SIZE,
+):
+    """Write a copy of a FITS file without some extensions, streaming from disk
+
+    Rather than loading every HDU into memory, this only parses the headers to find
+    where each HDU lives in the file, and then copies the raw header and data blocks
+    of the HDUs to keep in chunks. The data are never decoded
+
+    Args:
+        file: Input FITS file
+        out_name: Output filename. If compression is 'gzip', '.gz' will be appended
+        hdu_ext_to_delete: List of extension names to remove. Defaults to None, which
+            will keep everything
+        compression: Optional compression for the output file. Options are given by
+            ALLOWED_PRUNE_COMPRESSIONS:
+            - None, which writes an uncompressed FITS file
+            - 'gzip', which gzips the whole file as it streams
+            - 'rice', which Rice tile-compresses image extensions. Note that this
+              decodes each image, and that floating point data will be quantized
+            Defaults to None
+        chunk_size: Size of the blocks to copy, in bytes. Defaults to PRUNE_CHUNK_SIZE
+
+    Returns:
+        The output filename
+    """
+
+    if hdu_ext_to_delete is None:
+        hdu_ext_to_delete = []
+    if compression not in ALLOWED_PRUNE_COMPRESSIONS:
+        raise ValueError(
+            f"compression should be one of {ALLOWED_PRUNE_COMPRESSIONS}, not {compression}"
+        )
+
+    if compression == "gzip":
+        out_name = f"{out_name}.gz"
+
+    # Write to a temporary file then move, so we never leave a half-written file
+    tmp_name = f"{out_name}.{os.getpid()}.tmp"
+
+    with fits.open(file, memmap=True, lazy_load_hdus=True) as hdu:
+        # Iterating here only reads in the headers
+        hdu_idxs = [
+            i for i, hdu_ext in enumerate(hdu)
+            if i == 0 or hdu_ext.name not in hdu_ext_to_delete
+        ]
+
+        if compression == "rice":
+            hdu_out = fits.HDUList()
+            for i in hdu_idxs:
+                hdu_ext = hdu[i]
+                if i > 0 and isinstance(hdu_ext, fits.ImageHDU) and hdu_ext.data is not None:
+                    hdu_ext = fits.CompImageHDU(
+                        data=hdu_ext.data,
+                        header=hdu_ext.header,
+                        compression_type="RICE_1",
+                    )
+                hdu_out.append(hdu_ext)
+
+            hdu_out.writeto(tmp_name, overwrite=True)
+            del hdu_out
+
+        else:
+            byte_ranges = []
+            for i in hdu_idxs:
+                info = hdu.fileinfo(i)
+                byte_ranges.append((info["hdrLoc"], info["datLoc"] + info["datSpan"]))
+
+            if compression == "gzip":
+                open_func = gzip.open
+            else:
+                open_func = open
+
+            with open(file, "rb") as f_in, open_func(tmp_name, "wb") as f_out:
+                for start, end in byte_ranges:
+                    f_in.seek(start)
+                    remaining = end - start
+
+                    while remaining > 0:
+                        chunk = f_in.read(min(chunk_size, remaining))
+                        if not chunk:
+                            raise OSError(f"Unexpected end of file in {file}")
+                        f_out.write(chunk)
+                        remaining -= len(chunk)
+
+    os.replace(tmp_name, out_name)
+
+    return out_name
+
+
+def archive_directory(
+        directory,
+        out_name=None,
+        compresslevel=6,
+):
+    """Write a directory to a .tar.gz archive, skipping if the contents haven't changed
+
+    A hash of the directory contents is stored in the archive's pax header, so if
+    an archive already exists with the same contents it will be left alone
+
+    Args:
+        directory: Directory to archive
+        out_name: Output archive name. Defaults to None, which will use the
+            directory name with '.tar.gz' appended
+        compresslevel: gzip compression level. Defaults to 6, the same as tar -z
+
+    Returns:
+        True if the archive was written, False if it was already up to date
+    """
+
+    directory = os.path.normpath(directory)
+
+    if out_name is None:
+        out_name = f"{directory}.tar.gz"
+
+    content_hash = get_directory_hash(directory)
+
+    if os.path.exists(out_name):
+        try:
+            with tarfile.open(out_name, "r:gz") as tf:
+                if tf.pax_headers.get(ARCHIVE_HASH_KEY, None) == content_hash:
+                    return False
+        except (OSError, tarfile.TarError):
+            log.debug(f"Could not read {out_name}, will rewrite")
+
+    # Write to a temporary file then move, so we never leave a half-written archive
+    tmp_name = f"{out_name}.{os.getpid()}.tmp"
+
+    with tarfile.open(
+            tmp_name,
+            "w:gz",
+            compresslevel=compresslevel,
+            format=tarfile.PAX_FORMAT,
+            pax_headers={ARCHIVE_HASH_KEY: content_hash},
+    ) as tf:
+        tf.add(
+            directory,
+            arcname=os.path.split(directory)[-1],
+        )
+
+    os.replace(tmp_name, out_name)
+
+    return True
+
+
+def get_directory_hash(
+        directory,
+        chunk_size=PRUNE_CHUNK_SIZE,
+):
+    """Get a hash of the contents (relative paths and file data) of a directory
+
+    Args:
+        directory: Directory to hash
+        chunk_size: Size of the blocks to read, in bytes. Defaults to PRUNE_CHUNK_SIZE
+    """
+
+    dir_hash = hashlib.sha1()
+
+    for root, dirs, files in os.walk(directory):
+        # Walk in a fixed order, so the hash is reproducible
+        dirs.sort()
+
+        for file in sorted(files):
+            full_file = os.path.join(root, file)
+
+            dir_hash.update(os.path.relpath(full_file, directory).encode())
+            dir_hash.update(b"\0")
+
+            with open(full_file, "rb") as f:
+                for chunk in iter(lambda: f.read(chunk_size), b""):
+                    dir_hash.update(chunk)
+
+            dir_hash.update(b"\0")
+
+    return dir_hash.hexdigest()
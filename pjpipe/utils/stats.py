@@ -0,0 +1,242 @@
+import numpy as np
+from astropy.stats import sigma_clipped_stats as astropy_sigma_clipped_stats
+
+# Longest axis to loop over when calculating prefix sums
+MAX_PREFIX_SUM_LOOP = 8192
+
+
+def fast_sigma_clipped_stats(
+        data,
+        mask=None,
+        sigma=3.0,
+        sigma_lower=None,
+        sigma_upper=None,
+        maxiters=5,
+        axis=None,
+):
+    """Fast iterative sigma-clipped mean, median and standard deviation
+
+    This is a drop-in for astropy's sigma_clipped_stats (with median centring
+    and standard deviation as the clipping width), but avoids masked arrays and
+    repeated sorts. The data are sorted once along the reduction axis, after which
+    each clipping iteration is just counting how many values fall below/above the
+    bounds, and the median can be read straight off the sorted array. Non-finite
+    values are ignored, as in astropy
+
+    Args:
+        data: Input data
+        mask: Boolean mask, where True values are ignored. Defaults to None
+        sigma: Number of standard deviations to clip at. Defaults to 3
+        sigma_lower: Lower clipping sigma. Defaults to None, which
+            will use sigma
+        sigma_upper: Upper clipping sigma. Defaults to None, which
+            will use sigma
+        maxiters: Maximum number of clipping iterations. If None, will
+            iterate until convergence. Defaults to 5
+        axis: Axis or axes to reduce over. Defaults to None, which will
+            use the whole array
+
+    Returns:
+        mean, median, std. These are floats if axis is None, else arrays
+    """
+
+    if sigma_lower is None:
+        sigma_lower = sigma
+    if sigma_upper is None:
+        sigma_upper = sigma
+    if maxiters is None:
+        maxiters = np.inf
+
+    data = np.asanyarray(data, dtype=float)
+
+    # Put the values to reduce over along the last axis, and flatten everything else
+    if axis is None:
+        axis = tuple(range(data.ndim))
+    elif np.isscalar(axis):
+        axis = (axis,)
+    axis = tuple(sorted(a % data.ndim for a in axis))
+
+    out_shape = tuple(n for i, n in enumerate(data.shape) if i not in axis)
+    other_axes = [i for i in range(data.ndim) if i not in axis]
+
+    if mask is not None:
+        mask = np.broadcast_to(np.asanyarray(mask, dtype=bool), data.shape)
+        mask = np.transpose(mask, other_axes + list(axis)).reshape(int(np.prod(out_shape)), -1)
+
+    data = np.transpose(data, other_axes + list(axis)).reshape(int(np.prod(out_shape)), -1)
+
+    bad = ~np.isfinite(data)
+    if mask is not None:
+        bad |= mask
+
+    # Sort once. Bad values are set to NaN, so they end up at the end. We then put the sorted
+    # axis first, so everything after is vectorised over the (usually many more) slices
+    data = np.where(bad, np.nan, data)
+    data.sort(axis=-1)
+    data = np.ascontiguousarray(data.T)
+
+    n_slice = data.shape[1]
+    lo = np.zeros(n_slice, dtype=int)
+    hi = np.sum(~bad, axis=-1)
+
+    range_sums = RangeSums(data, lo, hi)
+
+    iteration = 0
+    while iteration < maxiters:
+        iteration += 1
+
+        median = get_sorted_median(data, lo, hi)
+        _, std = range_sums.get_mean_std(lo, hi)
+
+        min_value = median - sigma_lower * std
+        max_value = median + sigma_upper * std
+
+        # Once clipped, values stay clipped
+        with np.errstate(invalid="ignore"):
+            new_lo = np.maximum(np.sum(data < min_value, axis=0), lo)
+            new_hi = np.minimum(np.sum(data <= max_value, axis=0), hi)
+
+        # Slices with nothing left in them shouldn't change
+        empty = hi <= lo
+        new_lo[empty] = lo[empty]
+        new_hi[empty] = hi[empty]
+
+        if np.all(new_lo == lo) and np.all(new_hi == hi):
+            break
+
+        lo = new_lo
+        hi = new_hi
+
+    median = get_sorted_median(data, lo, hi)
+    mean, std = range_sums.get_mean_std(lo, hi)
+
+    if len(out_shape) == 0:
+        return float(mean[0]), float(median[0]), float(std[0])
+
+    return mean.reshape(out_shape), median.reshape(out_shape), std.reshape(out_shape)
+
+
+def get_prefix_sum(data):
+    """Cumulative sum along the first axis, with a leading row of zeros
+
+    numpy's cumsum along the first axis is slow for wide arrays, so for all but very
+    long axes we loop over rows, which keeps everything vectorised over the slices
+    """
+
+    prefix_sum = np.zeros((data.shape[0] + 1, data.shape[1]))
+
+    if data.shape[0] > MAX_PREFIX_SUM_LOOP:
+        prefix_sum[1:] = np.cumsum(data, axis=0)
+    else:
+        for i in range(data.shape[0]):
+            np.add(prefix_sum[i], data[i], out=prefix_sum[i + 1])
+
+    return prefix_sum
+
+
+def take_sorted(data, idx):
+    """Pull out data[idx[k], k] for each slice k"""
+
+    return data.ravel()[idx * data.shape[1] + np.arange(data.shape[1])]
+
+
+def get_sorted_median(data, lo, hi):
+    """Median of the [lo, hi) range of each slice of a sorted array (sorted along the first axis)"""
+
+    n = hi - lo
+    empty = n <= 0
+
+    mid_lo = np.clip(lo + (n - 1) // 2, 0, data.shape[0] - 1)
+    mid_hi = np.clip(lo + n // 2, 0, data.shape[0] - 1)
+
+    median = (take_sorted(data, mid_lo) + take_sorted(data, mid_hi)) / 2
+    median[empty] = np.nan
+
+    return median
+
+
+class RangeSums:
+    def __init__(self, data, lo, hi):
+        """Prefix sums to get the mean and standard deviation of any [lo, hi) range of a sorted array
+
+        Values are taken relative to the initial median, and summed outwards from it in both
+        directions. That way, sums over a range never include (and so never have to cancel out)
+        the outliers beyond it
+
+        Args:
+            data: Data, sorted along the first axis
+            lo: Initial start of the valid range for each slice
+            hi: Initial end of the valid range for each slice
+        """
+
+        idx = np.arange(data.shape[0])[:, None]
+        mid = lo + (hi - lo) // 2
+        self.ref = get_sorted_median(data, lo, hi)
+        self.ref[~np.isfinite(self.ref)] = 0
+
+        # Anything outside the valid range is NaN, so zero these
+        diff = data - self.ref
+        diff[np.isnan(diff)] = 0
+        right = idx >= mid
+
+        self.left_sums = []
+        self.right_sums = []
+        for power in [1, 2]:
+            diff_power = diff if power == 1 else diff * diff
+            diff_right = np.where(right, diff_power, 0)
+            diff_left = diff_power - diff_right
+
+            # Sum from the mid-point up to (but not including) each index
+            right_sum = get_prefix_sum(diff_right)
+
+            # Sum from each index up to (but not including) the mid-point
+            left_sum = np.ascontiguousarray(get_prefix_sum(diff_left[::-1])[::-1])
+
+            self.right_sums.append(right_sum)
+            self.left_sums.append(left_sum)
+
+    def get_sum(self, lo, hi, power=1):
+        """Sum of (data - ref) ** power over the [lo, hi) range of each slice"""
+
+        left_sum = self.left_sums[power - 1]
+        right_sum = self.right_sums[power - 1]
+
+        return (take_sorted(left_sum, lo) - take_sorted(left_sum, hi)) + \
+            (take_sorted(right_sum, hi) - take_sorted(right_sum, lo))
+
+    def get_mean_std(self, lo, hi):
+        """Mean and standard deviation over the [lo, hi) range of each slice"""
+
+        n = hi - lo
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean_diff = self.get_sum(lo, hi, power=1) / n
+            var = self.get_sum(lo, hi, power=2) / n - mean_diff ** 2
+
+        mean = self.ref + mean_diff
+        std = np.sqrt(np.maximum(var, 0))
+
+        mean[n <= 0] = np.nan
+        std[n <= 0] = np.nan
+
+        return mean, std
+
+
+def sigma_clipped_stats(
+        data,
+        use_fast_stats=False,
+        **kwargs,
+):
+    """Dispatch sigma-clipped statistics to either astropy or the fast implementation
+
+    Args:
+        data: Input data
+        use_fast_stats: If True, use fast_sigma_clipped_stats. Otherwise, use
+            astropy's sigma_clipped_stats. Defaults to False
+        **kwargs: Other arguments to pass to the sigma-clipping function
+    """
+
+    if use_fast_stats:
+        return fast_sigma_clipped_stats(data, **kwargs)
+
+    return astropy_sigma_clipped_stats(data, **kwargs)
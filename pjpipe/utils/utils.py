@@ -1,16 +1,20 @@
 import copy
 import functools
 import gc
+import hashlib
 import inspect
+import json
 import logging
+import multiprocessing as mp
 import os
 import warnings
+from collections import OrderedDict
 
 import numpy as np
 from astropy.convolution import convolve_fft
 from astropy.io import fits
 from astropy.nddata.bitmask import interpret_bit_flags, bitfield_to_boolean_mask
-from astropy.stats import sigma_clipped_stats, SigmaClip
+from astropy.stats import SigmaClip
 from astropy.table import Table
 from astropy.wcs import WCS
 from photutils.segmentation import detect_threshold, detect_sources
@@ -21,8 +25,11 @@ from scipy.interpolate import RegularGridInterpolator
 from stdatamodels.jwst import datamodels
 from stdatamodels.jwst.datamodels.dqflags import pixel
 from stdatamodels import util
+from tqdm import tqdm
 
 from .. import __version__
+from .manifest import get_file_signature
+from .stats import sigma_clipped_stats
 
 try:
     import tomllib
@@ -35,6 +42,58 @@ ALLOWED_REPROJECT_FUNCS = [
     "exact",
 ]
 
+# Number of interpolated kernels to keep around for convolutions
+KERNEL_CACHE_SIZE = 16
+
+# Extension for cached, bit-packed source masks
+MASK_CACHE_EXT = ".mask.npz"
+
+# Number of FITS SIP headers to keep around in memory, and extension for
+# header sidecar files
+SIP_HEADER_CACHE_SIZE = 64
+SIP_HEADER_CACHE = OrderedDict()
+SIP_HEADER_EXT = ".sip.hdr"
+
+# Per-directory index of primary header values used to build observation tables
+OBS_INDEX_FILE = "obs_index.json"
+
+# Primary header keywords needed to build observation tables
+OBS_HEADER_KEYWORDS = [
+    "OBSERVTN",
+    "FILTER",
+    "DATE-BEG",
+    "DURATION",
+    "OBSLABEL",
+    "PROGRAM",
+    "SUBARRAY",
+    "TARGPROP",
+    "FILENAME",
+]
+
+# Observation table columns and types
+OBS_TABLE_NAMES = [
+    "File",
+    "Type",
+    "Obs_ID",
+    "Filter",
+    "Start",
+    "Exptime",
+    "Objname",
+    "Program",
+    "Array",
+]
+OBS_TABLE_DTYPES = [
+    str,
+    str,
+    str,
+    str,
+    str,
+    float,
+    str,
+    str,
+    str,
+]
+
 # Useful values
 
 PIXEL_SCALE_NAMES = ["XPIXSIZE", "CDELT1", "CD1_1", "PIXELSCL"]
@@ -458,47 +517,239 @@ def get_obs_table(
         check_bgr=False,
         check_type="parallel_off",
         background_name="off",
+        use_header_index=False,
+        procs=1,
 ):
-    """Pull necessary info out of fits headers"""
+    """Pull necessary info out of fits headers
 
-    tab = Table(
-        names=[
-            "File",
-            "Type",
-            "Obs_ID",
-            "Filter",
-            "Start",
-            "Exptime",
-            "Objname",
-            "Program",
-            "Array",
-        ],
-        dtype=[
-            str,
-            str,
-            str,
-            str,
-            str,
-            float,
-            str,
-            str,
-            str,
-        ],
-    )
+    Args:
+        files: List of files to get info for
+        check_bgr: Whether to check if these are science or background observations
+        check_type: How to check if background observation. See parse_fits_to_table.
+            Defaults to 'parallel_off'
+        background_name: Name to indicate background observation. Defaults to 'off'
+        use_header_index: If True, will read values straight from the primary
+            headers (in parallel), and cache them in a per-directory index that
+            is only refreshed for new or modified files. Otherwise, will open each
+            file as a datamodel. Defaults to False
+        procs: Number of processes to use when reading headers. Defaults to 1
+    """
 
-    for f in files:
-        tab.add_row(
+    if use_header_index:
+        obs_headers = get_obs_headers(
+            files,
+            procs=procs,
+        )
+        rows = [
+            parse_header_to_table(
+                f,
+                obs_headers[f],
+                check_bgr=check_bgr,
+                check_type=check_type,
+                background_name=background_name,
+            )
+            for f in files
+        ]
+    else:
+        rows = [
             parse_fits_to_table(
                 f,
                 check_bgr=check_bgr,
                 check_type=check_type,
                 background_name=background_name,
             )
-        )
+            for f in files
+        ]
+
+    # Build the table in one go, rather than row-by-row
+    tab = Table(
+        [list(col) for col in zip(*rows)] if len(rows) > 0 else [[] for _ in OBS_TABLE_NAMES],
+        names=OBS_TABLE_NAMES,
+        dtype=OBS_TABLE_DTYPES,
+    )
 
     return tab
 
 
+def get_obs_headers(
+        files,
+        procs=1,
+):
+    """Get the primary header values needed for observation tables
+
+    Values are cached in an index file in each directory, keyed by filename
+    and invalidated by file size and modification time, so only new or
+    modified files have their headers read
+
+    Args:
+        files: List of files to get header values for
+        procs: Number of processes to use when reading headers. Defaults to 1
+
+    Returns:
+        Dictionary of header values for each file
+    """
+
+    dir_files = {}
+    for f in files:
+        dir_files.setdefault(os.path.dirname(os.path.abspath(f)), []).append(f)
+
+    obs_headers = {}
+
+    for index_dir in dir_files:
+        index_file = os.path.join(
+            index_dir,
+            OBS_INDEX_FILE,
+        )
+
+        index = {}
+        if os.path.exists(index_file):
+            try:
+                with open(index_file, "r") as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                log.warning(f"Could not read {index_file}, will rebuild")
+                index = {}
+
+        stale_files = []
+        for f in dir_files[index_dir]:
+            short_file = os.path.split(f)[-1]
+            if short_file not in index or \
+                    index[short_file]["signature"] != get_file_signature(f) or \
+                    set(index[short_file]["header"]) != set(OBS_HEADER_KEYWORDS):
+                stale_files.append(f)
+
+        if len(stale_files) > 0:
+            # Ensure we're not wasting processes
+            dir_procs = np.nanmin([procs, len(stale_files)])
+
+            with mp.get_context("fork").Pool(dir_procs) as pool:
+                for f, header in tqdm(
+                        pool.imap_unordered(
+                            get_obs_header,
+                            stale_files,
+                        ),
+                        ascii=True,
+                        desc="Reading headers",
+                        total=len(stale_files),
+                ):
+                    index[os.path.split(f)[-1]] = {
+                        "signature": get_file_signature(f),
+                        "header": header,
+                    }
+
+                pool.close()
+                pool.join()
+                gc.collect()
+
+            # Write to a temporary file then move, so we never leave a half-written index
+            tmp_file = f"{index_file}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_file, "w") as f:
+                    json.dump(index, f, indent=4)
+                os.replace(tmp_file, index_file)
+            except OSError:
+                log.warning(f"Could not write {index_file}")
+
+        for f in dir_files[index_dir]:
+            obs_headers[f] = index[os.path.split(f)[-1]]["header"]
+
+    return obs_headers
+
+
+def get_obs_header(file):
+    """Read the values needed for observation tables from the primary header
+
+    This only parses the primary header, so is much quicker than opening
+    the file as a datamodel
+
+    Args:
+        file: File to read
+
+    Returns:
+        file, and dictionary of header values
+    """
+
+    header = fits.getheader(file, ext=0)
+
+    obs_header = {}
+    for keyword in OBS_HEADER_KEYWORDS:
+        value = header.get(keyword, None)
+
+        # Catch any undefined values
+        if isinstance(value, fits.card.Undefined):
+            value = None
+
+        obs_header[keyword] = value
+
+    return file, obs_header
+
+
+def parse_header_to_table(
+        file,
+        header,
+        check_bgr=False,
+        check_type="parallel_off",
+        background_name="off",
+):
+    """Get an observation table row from primary header values
+
+    Args:
+        file (str): File to get info for
+        header (dict): Dictionary of header values, from get_obs_header
+        check_bgr (bool): Whether to check if this is a science or background observation
+        check_type (str): How to check if background observation. See parse_fits_to_table.
+            Defaults to 'parallel_off'
+        background_name (str): Name to indicate background observation. Defaults to 'off'.
+    """
+
+    # Figure out if we're a background observation or not
+    f_type = "sci"
+    if check_bgr:
+
+        # If it's a parallel observation (PHANGS-style)
+        if check_type == "parallel_off":
+            file_split = os.path.split(file)[-1]
+            if file_split.split("_")[1][2] == "2":
+                f_type = "bgr"
+
+        # If the backgrounds are labelled differently in the target name
+        elif check_type == "check_in_name":
+            if background_name in header["TARGPROP"].lower():
+                f_type = "bgr"
+
+        # If we want to use some specific files within the science as observations
+        elif check_type == "filename":
+
+            if isinstance(background_name, str):
+                background_name = [background_name]
+
+            for bg_name in background_name:
+                if bg_name in header["FILENAME"].lower():
+                    f_type = "bgr"
+
+        else:
+            raise Warning(f"check_type {check_type} not known")
+
+    # Sometimes the observation label is not defined, so have a fallback here
+    obs_label = header["OBSLABEL"]
+    if obs_label is not None:
+        obs_label = obs_label.lower()
+    else:
+        obs_label = ""
+
+    return (
+        file,
+        f_type,
+        header["OBSERVTN"],
+        header["FILTER"],
+        header["DATE-BEG"],
+        header["DURATION"],
+        obs_label,
+        header["PROGRAM"],
+        header["SUBARRAY"].lower().strip(),
+    )
+
+
 def parse_fits_to_table(
         file,
         check_bgr=False,
@@ -606,8 +857,37 @@ def make_source_mask(
         npixels=3,
         dilate_size=11,
         sigclip_iters=5,
+        cache_dir=None,
 ):
-    """Make a source mask from segmentation image"""
+    """Make a source mask from segmentation image
+
+    Args:
+        data: Input data
+        mask: Mask of pixels to ignore when calculating the threshold. Defaults to None
+        nsigma: Sigma for the detection threshold. Defaults to 3
+        npixels: Minimum number of connected pixels for a source. Defaults to 3
+        dilate_size: Size to dilate the source mask by. Defaults to 11
+        sigclip_iters: Sigma-clipping iterations for the threshold. Defaults to 5
+        cache_dir: If set, will look for a previously calculated mask for this data and parameters
+            in this directory before making one, and save any new mask there. Defaults to None,
+            which will always calculate the mask
+    """
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_key = get_mask_cache_key(
+            data,
+            mask=mask,
+            nsigma=nsigma,
+            npixels=npixels,
+            dilate_size=dilate_size,
+            sigclip_iters=sigclip_iters,
+        )
+        cache_file = os.path.join(cache_dir, f"{cache_key}{MASK_CACHE_EXT}")
+
+        cached_mask = load_cached_mask(cache_file, shape=data.shape)
+        if cached_mask is not None:
+            return cached_mask
 
     sc = SigmaClip(
         sigma=nsigma,
@@ -632,9 +912,94 @@ def make_source_mask(
     except AttributeError:
         mask = np.zeros(data.shape, dtype=bool)
 
+    if cache_file is not None:
+        save_cached_mask(mask, cache_file)
+
     return mask
 
 
+def get_mask_cache_key(
+        data,
+        mask=None,
+        **kwargs,
+):
+    """Get a key for a mask from the data checksum and the masking parameters
+
+    Args:
+        data: Input data
+        mask: Input mask. Defaults to None
+        **kwargs: Parameters used to make the mask
+    """
+
+    h = hashlib.sha1()
+
+    data = np.ascontiguousarray(data)
+    h.update(f"{data.shape}{data.dtype}".encode())
+    h.update(data.view(np.uint8).ravel())
+
+    if mask is not None:
+        h.update(np.packbits(np.asarray(mask, dtype=bool)).tobytes())
+
+    h.update(repr(sorted(kwargs.items())).encode())
+
+    return h.hexdigest()
+
+
+def load_cached_mask(
+        cache_file,
+        shape,
+):
+    """Load a bit-packed mask sidecar. Returns None if there is no valid mask
+
+    Args:
+        cache_file: Mask sidecar file
+        shape: Expected shape of the mask
+    """
+
+    if not os.path.exists(cache_file):
+        return None
+
+    try:
+        with np.load(cache_file) as f:
+            cached_shape = tuple(f["shape"])
+            packed_mask = f["mask"]
+    except (OSError, KeyError, ValueError):
+        log.warning(f"Could not read cached mask {cache_file}, will recalculate")
+        return None
+
+    if cached_shape != tuple(shape):
+        return None
+
+    mask = np.unpackbits(packed_mask, count=int(np.prod(shape))).astype(bool)
+
+    return mask.reshape(shape)
+
+
+def save_cached_mask(
+        mask,
+        cache_file,
+):
+    """Save a mask as a compressed, bit-packed sidecar
+
+    Args:
+        mask: Boolean mask
+        cache_file: Mask sidecar file
+    """
+
+    cache_dir = os.path.dirname(cache_file)
+    if cache_dir and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # Write to a temporary file then move, so parallel processes never see half a file
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp.npz"
+    np.savez_compressed(
+        tmp_file,
+        mask=np.packbits(np.asarray(mask, dtype=bool)),
+        shape=np.array(mask.shape),
+    )
+    os.replace(tmp_file, cache_file)
+
+
 def sigma_clip(
         data,
         dq_mask=None,
@@ -656,6 +1021,91 @@ def sigma_clip(
     return mean, median, std_dev
 
 
+def get_sip_header(
+        im,
+        file=None,
+        persist=False,
+):
+    """Get the FITS SIP approximation to a datamodel's WCS
+
+    Fitting the SIP polynomials to the gwcs is slow, so these are cached in memory, keyed on the file
+    and its WCS info, and optionally saved as a .sip.hdr sidecar next to the file
+
+    Args:
+        im: Input datamodel
+        file: File the datamodel was opened from. Defaults to None, which will
+            not use the cache
+        persist: Whether to also save and look for the header in a sidecar file.
+            Defaults to False
+    """
+
+    if file is None:
+        return im.meta.wcs.to_fits_sip()
+
+    cache_key = get_sip_cache_key(im, file)
+
+    if cache_key in SIP_HEADER_CACHE:
+        SIP_HEADER_CACHE.move_to_end(cache_key)
+        return fits.Header.fromstring(SIP_HEADER_CACHE[cache_key])
+
+    sidecar_file = f"{os.path.splitext(file)[0]}{SIP_HEADER_EXT}"
+
+    header = None
+    if persist and os.path.exists(sidecar_file):
+        with open(sidecar_file, "r") as f:
+            header = fits.Header.fromstring(f.read(), sep="\n")
+
+        # Make sure this is for the right version of the file
+        if header.get("SIPCACHE", None) == cache_key:
+            del header["SIPCACHE"]
+        else:
+            header = None
+
+    if header is None:
+        header = im.meta.wcs.to_fits_sip()
+
+        if persist:
+            sidecar_header = header.copy()
+            sidecar_header["SIPCACHE"] = cache_key
+
+            # Write to a temporary file then move, so parallel processes never see half a file
+            tmp_file = f"{sidecar_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                f.write(sidecar_header.tostring(sep="\n"))
+            os.replace(tmp_file, sidecar_file)
+
+    SIP_HEADER_CACHE[cache_key] = header.tostring()
+    while len(SIP_HEADER_CACHE) > SIP_HEADER_CACHE_SIZE:
+        SIP_HEADER_CACHE.popitem(last=False)
+
+    return header
+
+
+def get_sip_cache_key(
+        im,
+        file,
+):
+    """Get a key for a SIP header from the file and its WCS info
+
+    Args:
+        im: Input datamodel
+        file: File the datamodel was opened from
+    """
+
+    stat = os.stat(file)
+    wcsinfo = json.dumps(
+        im.meta.wcsinfo.instance,
+        sort_keys=True,
+        default=repr,
+    )
+
+    h = hashlib.sha1()
+    h.update(f"{os.path.abspath(file)}{stat.st_size}{stat.st_mtime_ns}".encode())
+    h.update(wcsinfo.encode())
+
+    return h.hexdigest()
+
+
 def reproject_image(
         file,
         optimal_wcs,
@@ -665,6 +1115,8 @@ def reproject_image(
         stacked_image=False,
         do_level_data=False,
         reproject_func="interp",
+        mask_cache_dir=None,
+        persist_sip_headers=False,
 ):
     """Reproject an image to an optimal WCS
 
@@ -680,6 +1132,10 @@ def reproject_image(
             Defaults to False
         reproject_func: Which reproject function to use. Defaults to 'interp',
             but can also be 'exact' or 'adaptive'
+        mask_cache_dir: Directory for cached source masks, used if do_sigma_clip
+            is True. Defaults to None, which will not cache masks
+        persist_sip_headers: Whether to save FITS SIP headers as sidecar files, to
+            be reused between processes. Defaults to False
     """
 
     if reproject_func == "interp":
@@ -696,7 +1152,11 @@ def reproject_image(
 
             dq_bit_mask = get_dq_bit_mask(hdu.dq)
 
-            wcs = hdu.meta.wcs.to_fits_sip()
+            wcs = get_sip_header(
+                hdu,
+                file=file,
+                persist=persist_sip_headers,
+            )
             w_in = WCS(wcs)
 
             # Level data (but not in subarray mode)
@@ -723,6 +1183,7 @@ def reproject_image(
             data,
             mask=dq_bit_mask,
             dilate_size=7,
+            cache_dir=mask_cache_dir,
         )
         sig_mask = sig_mask.astype(int)
 
@@ -796,6 +1257,136 @@ def reproject_image(
     return data_array
 
 
+def get_bounding_box(file_reproj):
+    """Get the bounding box of a reprojected image, or list of reprojected images
+
+    Args:
+        file_reproj: Reprojected image, or list of reprojected images
+
+    Returns:
+        (imin, imax, jmin, jmax) tuple, or None if there is no valid data
+    """
+
+    if not isinstance(file_reproj, list):
+        file_reproj = [file_reproj]
+
+    file_reproj = [f for f in file_reproj if f is not None]
+    if len(file_reproj) == 0:
+        return None
+
+    imin = min(f.imin for f in file_reproj)
+    imax = max(f.imax for f in file_reproj)
+    jmin = min(f.jmin for f in file_reproj)
+    jmax = max(f.jmax for f in file_reproj)
+
+    return imin, imax, jmin, jmax
+
+
+def get_overlapping_pairs(file_reproj):
+    """Find the (i, j) pairs of reprojected images with overlapping bounding boxes
+
+    This sweeps along the i-axis of the bounding boxes, so that only pairs that
+    actually touch are returned, rather than testing every combination
+
+    Args:
+        file_reproj: List of reprojected images (or lists of reprojected images)
+    """
+
+    bboxes = [get_bounding_box(f) for f in file_reproj]
+
+    order = [idx for idx, bbox in enumerate(bboxes) if bbox is not None]
+    order.sort(key=lambda idx: bboxes[idx][0])
+
+    pairs = []
+    active = []
+
+    for idx in order:
+        imin, imax, jmin, jmax = bboxes[idx]
+
+        # Drop anything that finishes before this box starts
+        active = [a for a in active if bboxes[a][1] > imin]
+
+        for a in active:
+            if bboxes[a][0] < imax and bboxes[a][2] < jmax and bboxes[a][3] > jmin:
+                pairs.append((min(a, idx), max(a, idx)))
+
+        active.append(idx)
+
+    pairs.sort()
+
+    return pairs
+
+
+@functools.lru_cache(maxsize=KERNEL_CACHE_SIZE)
+def get_convolution_kernel(
+        file_kernel,
+        image_pix_scale,
+):
+    """Get a convolution kernel, interpolated to the pixel scale of the image
+
+    This is cached, since all the files in a band will share the same kernel
+    and pixel scale. The returned kernel is read-only
+
+    Args:
+        file_kernel: Path to kernel for convolution
+        image_pix_scale: Pixel scale of the image to be convolved
+    """
+
+    with fits.open(file_kernel) as kernel_hdu:
+        kernel_pix_scale = get_pixscale(kernel_hdu[0])
+        # Note the shape and grid of the kernel as input
+        kernel_data = kernel_hdu[0].data
+        kernel_hdu_length = kernel_hdu[0].data.shape[0]
+        original_central_pixel = (kernel_hdu_length - 1) / 2
+        original_grid = (
+                                np.arange(kernel_hdu_length) - original_central_pixel
+                        ) * kernel_pix_scale
+
+    # Calculate kernel size after interpolating to the image pixel
+    # scale. Because sometimes there's a little pixel scale rounding
+    # error, subtract a little bit off the optimum size (Tom
+    # Williams).
+
+    interpolate_kernel_size = (
+            np.floor(kernel_hdu_length * kernel_pix_scale / image_pix_scale) - 2
+    )
+
+    # Ensure the kernel has a central pixel
+
+    if interpolate_kernel_size % 2 == 0:
+        interpolate_kernel_size -= 1
+
+    # Define a new coordinate grid onto which to project the kernel
+    # but using the pixel scale of the image
+
+    new_central_pixel = (interpolate_kernel_size - 1) / 2
+    new_grid = (
+        np.arange(interpolate_kernel_size) - new_central_pixel
+               ) * image_pix_scale
+    x_coords_new, y_coords_new = np.meshgrid(new_grid, new_grid)
+
+    # Do the reprojection from the original kernel grid onto the new
+    # grid with pixel scale matched to the image
+
+    grid_interpolated = RegularGridInterpolator(
+        (original_grid, original_grid),
+        kernel_data,
+        bounds_error=False,
+        fill_value=0.0,
+    )
+    kernel_interp = grid_interpolated(
+        (x_coords_new.flatten(), y_coords_new.flatten())
+    )
+    kernel_interp = kernel_interp.reshape(x_coords_new.shape)
+
+    # Ensure the interpolated kernel is normalized to 1
+    kernel_interp = kernel_interp / np.nansum(kernel_interp)
+
+    kernel_interp.flags.writeable = False
+
+    return kernel_interp
+
+
 def do_jwst_convolution(
         file_in,
         file_out,
@@ -829,16 +1420,6 @@ def do_jwst_convolution(
     else:
         raise ValueError(f"reproject_func should be one of {ALLOWED_REPROJECT_FUNCS}")
 
-    with fits.open(file_kernel) as kernel_hdu:
-        kernel_pix_scale = get_pixscale(kernel_hdu[0])
-        # Note the shape and grid of the kernel as input
-        kernel_data = kernel_hdu[0].data
-        kernel_hdu_length = kernel_hdu[0].data.shape[0]
-        original_central_pixel = (kernel_hdu_length - 1) / 2
-        original_grid = (
-                                np.arange(kernel_hdu_length) - original_central_pixel
-                        ) * kernel_pix_scale
-
     with fits.open(file_in) as image_hdu:
         if blank_zeros:
             # make sure that all zero values were set to NaNs, which
@@ -848,45 +1429,11 @@ def do_jwst_convolution(
 
         image_pix_scale = get_pixscale(image_hdu["SCI"])
 
-        # Calculate kernel size after interpolating to the image pixel
-        # scale. Because sometimes there's a little pixel scale rounding
-        # error, subtract a little bit off the optimum size (Tom
-        # Williams).
-
-        interpolate_kernel_size = (
-                np.floor(kernel_hdu_length * kernel_pix_scale / image_pix_scale) - 2
-        )
-
-        # Ensure the kernel has a central pixel
-
-        if interpolate_kernel_size % 2 == 0:
-            interpolate_kernel_size -= 1
-
-        # Define a new coordinate grid onto which to project the kernel
-        # but using the pixel scale of the image
-
-        new_central_pixel = (interpolate_kernel_size - 1) / 2
-        new_grid = (
-            np.arange(interpolate_kernel_size) - new_central_pixel
-                   ) * image_pix_scale
-        x_coords_new, y_coords_new = np.meshgrid(new_grid, new_grid)
-
-        # Do the reprojection from the original kernel grid onto the new
-        # grid with pixel scale matched to the image
-
-        grid_interpolated = RegularGridInterpolator(
-            (original_grid, original_grid),
-            kernel_data,
-            bounds_error=False,
-            fill_value=0.0,
+        # Get the kernel, with pixel scale matched to the image
+        kernel_interp = get_convolution_kernel(
+            file_kernel,
+            image_pix_scale,
         )
-        kernel_interp = grid_interpolated(
-            (x_coords_new.flatten(), y_coords_new.flatten())
-        )
-        kernel_interp = kernel_interp.reshape(x_coords_new.shape)
-
-        # Ensure the interpolated kernel is normalized to 1
-        kernel_interp = kernel_interp / np.nansum(kernel_interp)
 
         # Now with the kernel centered and matched in pixel scale to the
         # input image use the FFT convolution routine from astropy to
@@ -949,11 +1496,13 @@ def do_jwst_convolution(
 
 def level_data(
         im,
+        use_fast_stats=False,
 ):
     """Level overlaps in NIRCAM amplifiers
 
     Args:
         im: Input datamodel
+        use_fast_stats: Whether to use the fast sigma-clipped statistics. Defaults to False
     """
 
     data = copy.deepcopy(im.data)
@@ -987,7 +1536,7 @@ def level_data(
                 axis=1,
             )
             diff = med_1 - med_2
-            delta = sigma_clipped_stats(diff, maxiters=None)[1]
+            delta = sigma_clipped_stats(diff, maxiters=None, use_fast_stats=use_fast_stats)[1]
 
         data[:, (i + 1) * quadrant_size: (i + 2) * quadrant_size] += delta
 
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+import pjpipe.astrometric_catalog.constrained_diffusion as cd
+from pjpipe.astrometric_catalog.constrained_diffusion import (
+    constrained_diffusion,
+    constrained_diffusion_fast,
+)
+
+
+def make_image(
+    shape=(128, 128),
+    nan_fraction=0.0,
+    seed=42,
+):
+    """Make an image with point sources, extended emission, noise, and optionally NaN gaps"""
+
+    rng = np.random.default_rng(seed)
+
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+
+    data = rng.normal(scale=0.1, size=shape)
+    data += 2 * np.exp(-((xx - 40) ** 2 + (yy - 70) ** 2) / (2 * 20 ** 2))
+    for x, y in rng.uniform(0, shape[0], size=(20, 2)):
+        data += 5 * np.exp(-((xx - x) ** 2 + (yy - y) ** 2) / (2 * 1.5 ** 2))
+
+    if nan_fraction > 0:
+        # Scattered bad pixels, plus a chunk missing like a detector gap
+        data[rng.random(size=shape) < nan_fraction] = np.nan
+        data[:, 100:106] = np.nan
+
+    return data
+
+
+@pytest.mark.parametrize("nan_fraction", [0.0, 0.01])
+def test_fast_matches_original(nan_fraction, monkeypatch):
+    """Check the fast path agrees with the original, with and without NaNs"""
+
+    data = make_image(nan_fraction=nan_fraction)
+
+    scalecube, residual = constrained_diffusion(data.copy())
+
+    # Make sure we're not just falling back to the original
+    def no_fallback(*args, **kwargs):
+        raise AssertionError("constrained_diffusion_fast fell back to constrained_diffusion")
+
+    monkeypatch.setattr(cd, "constrained_diffusion", no_fallback)
+
+    scalecube_fast, residual_fast = constrained_diffusion_fast(data)
+
+    # The fast path should leave the input alone
+    np.testing.assert_array_equal(np.isnan(data), np.isnan(make_image(nan_fraction=nan_fraction)))
+
+    assert scalecube_fast.shape == scalecube.shape
+    np.testing.assert_allclose(scalecube_fast, scalecube, rtol=1e-6, atol=1e-8)
+    np.testing.assert_allclose(residual_fast, residual, rtol=1e-6, atol=1e-8)
+    np.testing.assert_array_equal(np.isnan(residual_fast), np.isnan(residual))
@@ -0,0 +1,107 @@
+import os
+
+from pjpipe.utils import BuildManifest
+
+
+def make_files(
+    directory,
+    names,
+    contents="data",
+):
+    """Write out some small files"""
+
+    files = []
+    for name in names:
+        file = os.path.join(directory, name)
+        with open(file, "w") as f:
+            f.write(contents)
+        files.append(file)
+
+    return files
+
+
+def build(
+    manifest,
+    files,
+    out_dir,
+):
+    """Pretend to run a step, writing an output with the same name as each input"""
+
+    make_files(out_dir, [os.path.split(file)[-1] for file in files])
+    manifest.update(files)
+
+
+def test_stale_files(tmp_path):
+    """Check only new or changed files are rebuilt"""
+
+    in_dir = tmp_path / "in"
+    out_dir = tmp_path / "out"
+    in_dir.mkdir()
+    out_dir.mkdir()
+
+    files = make_files(in_dir, ["a_cal.fits", "b_cal.fits"])
+
+    manifest = BuildManifest(out_dir=out_dir, step_name="test", parameters={"a": 1})
+    assert manifest.get_stale_files(files) == files
+    build(manifest, files, out_dir)
+
+    # Nothing has changed, so nothing to do
+    manifest = BuildManifest(out_dir=out_dir, step_name="test", parameters={"a": 1})
+    assert manifest.get_stale_files(files) == []
+
+    # Change a file and add a new one
+    make_files(in_dir, ["a_cal.fits"], contents="new data")
+    files += make_files(in_dir, ["c_cal.fits"])
+    assert manifest.get_stale_files(files) == [files[0], files[2]]
+
+    # Changing the parameters rebuilds everything
+    manifest = BuildManifest(out_dir=out_dir, step_name="test", parameters={"a": 2})
+    assert manifest.get_stale_files(files) == files
+
+
+def test_missing_outputs(tmp_path):
+    """Check files are rebuilt if their outputs have gone missing"""
+
+    in_dir = tmp_path / "in"
+    out_dir = tmp_path / "out"
+    in_dir.mkdir()
+    out_dir.mkdir()
+
+    files = make_files(in_dir, ["a_cal.fits", "b_cal.fits"])
+
+    manifest = BuildManifest(out_dir=out_dir, step_name="test", parameters={})
+    build(manifest, files, out_dir)
+
+    os.remove(os.path.join(out_dir, "b_cal.fits"))
+
+    manifest = BuildManifest(out_dir=out_dir, step_name="test", parameters={})
+    assert manifest.get_stale_files(files) == [files[1]]
+
+
+def test_removed_inputs(tmp_path):
+    """Check outputs are removed for inputs that have gone"""
+
+    in_dir = tmp_path / "in"
+    out_dir = tmp_path / "out"
+    in_dir.mkdir()
+    out_dir.mkdir()
+
+    files = make_files(in_dir, ["a_cal.fits", "b_cal.fits"])
+
+    manifest = BuildManifest(out_dir=out_dir, step_name="test", parameters={})
+    build(manifest, files, out_dir)
+
+    os.remove(files[1])
+    files = files[:1]
+
+    manifest = BuildManifest(out_dir=out_dir, step_name="test", parameters={})
+    removed_files = manifest.remove_missing_files(files)
+
+    assert removed_files == [os.path.join(out_dir, "b_cal.fits")]
+    assert not os.path.exists(os.path.join(out_dir, "b_cal.fits"))
+    assert os.path.exists(os.path.join(out_dir, "a_cal.fits"))
+    assert manifest.get_stale_files(files) == []
+
+    # The removal should be saved
+    manifest = BuildManifest(out_dir=out_dir, step_name="test", parameters={})
+    assert manifest.remove_missing_files(files) == []
@@ -0,0 +1,126 @@
+import os
+
+from pjpipe.pipeline import PJPipeline
+
+
+class IncrementalStep:
+    """Minimal stand-in for an incremental per-file step"""
+
+    def __init__(
+        self,
+        files_changed,
+    ):
+        self.incremental = True
+        self.files_changed = files_changed
+
+    def do_step(self):
+        return True
+
+
+def make_pipeline(tmp_path, monkeypatch):
+    """Make a pipeline with a chain of steps after an incremental one"""
+
+    monkeypatch.setenv("CRDS_SERVER_URL", "https://jwst-crds.stsci.edu")
+    monkeypatch.setenv("CRDS_PATH", str(tmp_path / "crds"))
+
+    config = {
+        "targets": ["ngc0628"],
+        "bands": ["F770W"],
+        "steps": [
+            "lv2",
+            "single_tile_destripe",
+            "get_wcs_adjust",
+            "apply_wcs_adjust",
+            "level_match",
+            "lv3",
+            "astrometric_align",
+            "anchoring",
+            "release",
+        ],
+        "version": "v1p0",
+        "parameters": {},
+    }
+    local = {
+        "raw_dir": str(tmp_path / "raw"),
+        "reprocess_dir": str(tmp_path / "reprocess"),
+        "alignment_dir": str(tmp_path / "alignment"),
+        "processors": 1,
+    }
+
+    return PJPipeline(config_file=config, local_file=local)
+
+
+def write_step_complete_files(target_dir, band_dir):
+    """Write out step complete files for all the steps, as if they'd already been run"""
+
+    step_complete_files = {
+        "lv2": os.path.join(band_dir, "lv2", "lv2_step_complete.txt"),
+        "single_tile_destripe": os.path.join(
+            band_dir, "single_tile_destripe", "single_tile_destripe_step_complete.txt"
+        ),
+        "get_wcs_adjust": os.path.join(target_dir, "get_wcs_adjust_step_complete.txt"),
+        "apply_wcs_adjust": os.path.join(band_dir, "apply_wcs_adjust", "apply_wcs_adjust_step_complete.txt"),
+        "level_match": os.path.join(band_dir, "level_match", "level_match_step_complete.txt"),
+        "lv3": os.path.join(band_dir, "lv3", "lv3_step_complete.txt"),
+        "astrometric_align": os.path.join(band_dir, "lv3", "astrometric_align_step_complete.txt"),
+        "anchoring": os.path.join(target_dir, "anchoring_step_complete.txt"),
+        "release": os.path.join(target_dir, "release_step_complete.txt"),
+    }
+
+    for step_complete_file in step_complete_files.values():
+        os.makedirs(os.path.dirname(step_complete_file), exist_ok=True)
+        with open(step_complete_file, "w+") as f:
+            f.close()
+
+    return step_complete_files
+
+
+def test_incremental_rerun_invalidates_later_steps(tmp_path, monkeypatch):
+    """Check rebuilding files in an incremental step forces every later step to rerun"""
+
+    pipeline = make_pipeline(tmp_path, monkeypatch)
+
+    target_dir = os.path.join(pipeline.reprocess_dir, "ngc0628")
+    band_dir = os.path.join(target_dir, "F770W")
+    step_complete_files = write_step_complete_files(target_dir, band_dir)
+
+    band_progress_dict = {"success": True, "fused_steps": []}
+
+    step_result = pipeline.run_or_fuse_step(
+        step_instance=IncrementalStep(files_changed=True),
+        step="single_tile_destripe",
+        band_progress_dict=band_progress_dict,
+        band_dir=band_dir,
+        procs=1,
+    )
+    assert step_result
+
+    # Earlier steps should be untouched, everything after should be rerun
+    for step in ["lv2", "single_tile_destripe"]:
+        assert os.path.exists(step_complete_files[step])
+    for step in ["get_wcs_adjust", "apply_wcs_adjust", "level_match", "lv3", "astrometric_align", "anchoring",
+                 "release"]:
+        assert not os.path.exists(step_complete_files[step])
+
+
+def test_incremental_no_changes_keeps_later_steps(tmp_path, monkeypatch):
+    """Check an incremental step with nothing to rebuild leaves later steps alone"""
+
+    pipeline = make_pipeline(tmp_path, monkeypatch)
+
+    target_dir = os.path.join(pipeline.reprocess_dir, "ngc0628")
+    band_dir = os.path.join(target_dir, "F770W")
+    step_complete_files = write_step_complete_files(target_dir, band_dir)
+
+    band_progress_dict = {"success": True, "fused_steps": []}
+
+    pipeline.run_or_fuse_step(
+        step_instance=IncrementalStep(files_changed=False),
+        step="apply_wcs_adjust",
+        band_progress_dict=band_progress_dict,
+        band_dir=band_dir,
+        procs=1,
+    )
+
+    for step_complete_file in step_complete_files.values():
+        assert os.path.exists(step_complete_file)
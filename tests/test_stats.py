@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+from astropy.stats import sigma_clipped_stats as astropy_sigma_clipped_stats
+
+from pjpipe.utils.stats import fast_sigma_clipped_stats, sigma_clipped_stats
+
+
+def make_data(
+    shape=(200, 300),
+    nan_fraction=0.0,
+    seed=42,
+):
+    """Make some Gaussian data with outliers, and optionally NaNs"""
+
+    rng = np.random.default_rng(seed)
+
+    data = rng.normal(loc=1.0, scale=0.5, size=shape)
+
+    # Add some bright outliers, skewed positive like sources
+    outliers = rng.random(size=shape) < 0.05
+    data[outliers] += rng.exponential(scale=10, size=np.sum(outliers))
+
+    if nan_fraction > 0:
+        data[rng.random(size=shape) < nan_fraction] = np.nan
+
+    return data
+
+
+def assert_stats_close(fast_stats, astropy_stats):
+    """Check mean, median and std agree"""
+
+    for fast_stat, astropy_stat in zip(fast_stats, astropy_stats):
+        np.testing.assert_allclose(fast_stat, np.asarray(astropy_stat), rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize("nan_fraction", [0.0, 0.1])
+def test_matches_astropy(nan_fraction):
+    """Check the default clipping agrees with astropy, with and without NaNs"""
+
+    data = make_data(nan_fraction=nan_fraction)
+
+    assert_stats_close(
+        fast_sigma_clipped_stats(data),
+        astropy_sigma_clipped_stats(data),
+    )
+
+
+def test_matches_astropy_mask():
+    """Check masked values are ignored in the same way as astropy"""
+
+    data = make_data(nan_fraction=0.05)
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[:50, :] = True
+    mask[:, ::7] = True
+
+    assert_stats_close(
+        fast_sigma_clipped_stats(data, mask=mask),
+        astropy_sigma_clipped_stats(data, mask=mask),
+    )
+
+
+@pytest.mark.parametrize("maxiters", [1, 2, 10, None])
+def test_matches_astropy_maxiters(maxiters):
+    """Check the number of clipping iterations is respected"""
+
+    data = make_data(nan_fraction=0.05)
+
+    assert_stats_close(
+        fast_sigma_clipped_stats(data, maxiters=maxiters),
+        astropy_sigma_clipped_stats(data, maxiters=maxiters),
+    )
+
+
+@pytest.mark.parametrize(
+    "sigma_lower, sigma_upper",
+    [(2.0, 4.0), (5.0, 1.5), (3.0, None)],
+)
+def test_matches_astropy_asymmetric(sigma_lower, sigma_upper):
+    """Check asymmetric clipping agrees with astropy"""
+
+    data = make_data(nan_fraction=0.05)
+
+    assert_stats_close(
+        fast_sigma_clipped_stats(data, sigma=2.5, sigma_lower=sigma_lower, sigma_upper=sigma_upper),
+        astropy_sigma_clipped_stats(data, sigma=2.5, sigma_lower=sigma_lower, sigma_upper=sigma_upper),
+    )
+
+
+@pytest.mark.parametrize("axis", [0, 1, (0, 1)])
+def test_matches_astropy_axis(axis):
+    """Check clipping along an axis agrees with astropy"""
+
+    data = make_data(nan_fraction=0.05)
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[:, :10] = True
+
+    assert_stats_close(
+        fast_sigma_clipped_stats(data, mask=mask, sigma_lower=2.0, sigma_upper=3.0, axis=axis),
+        astropy_sigma_clipped_stats(data, mask=mask, sigma_lower=2.0, sigma_upper=3.0, axis=axis),
+    )
+
+
+def test_dispatch():
+    """Check the dispatcher picks the right implementation"""
+
+    data = make_data(nan_fraction=0.05)
+
+    assert_stats_close(
+        sigma_clipped_stats(data, use_fast_stats=True, maxiters=3),
+        fast_sigma_clipped_stats(data, maxiters=3),
+    )
+    assert_stats_close(
+        sigma_clipped_stats(data, maxiters=3),
+        astropy_sigma_clipped_stats(data, maxiters=3),
+    )
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from pjpipe.single_tile_destripe import vwpca
+from pjpipe.single_tile_destripe import vwpca_normgappy as gappy
+
+
+def make_gappy_data(
+    n_spectra=64,
+    n_pixels=128,
+    n_components=4,
+    gap_fraction=0.05,
+    seed=42,
+):
+    """Make some synthetic data with a few gaps"""
+
+    rng = np.random.default_rng(seed)
+
+    components = rng.normal(size=[n_components, n_pixels])
+    scores = rng.normal(size=[n_spectra, n_components]) * np.arange(n_components, 0, -1)
+    data = np.matmul(scores, components) + 0.1 * rng.normal(size=[n_spectra, n_pixels])
+
+    errors = np.ones_like(data)
+    errors[rng.random(size=data.shape) < gap_fraction] = 0
+    data[errors == 0] = 0
+
+    return data, errors
+
+
+def test_normgappy_batch_matches_single():
+    """Check running normgappy on a batch gives the same results as one spectrum at a time"""
+
+    data, errors = make_gappy_data()
+
+    mean_array = np.mean(data, axis=0)
+    eigen_vectors = np.linalg.svd(data - mean_array, full_matrices=False)[2][:4].T
+
+    scores_batch, norm_batch = gappy.run_normgappy(
+        error_array=errors,
+        data=data,
+        mean_array=mean_array,
+        eigen_vectors=eigen_vectors,
+    )
+
+    assert scores_batch.shape == (data.shape[0], eigen_vectors.shape[1])
+    assert norm_batch.shape == (data.shape[0], 1)
+
+    for i in range(data.shape[0]):
+        scores_single, norm_single = gappy.run_normgappy(
+            error_array=errors[i][None],
+            data=data[i][None],
+            mean_array=mean_array,
+            eigen_vectors=eigen_vectors,
+        )
+
+        np.testing.assert_allclose(scores_batch[i], scores_single[0], rtol=1e-8, atol=1e-10)
+        np.testing.assert_allclose(norm_batch[i], norm_single[0], rtol=1e-8, atol=1e-10)
+
+
+@pytest.mark.parametrize("batch_size", [8, 32])
+def test_batch_robust_pca_matches_single(batch_size):
+    """Check the batch robust PCA recovers the same eigenbasis as the per-spectrum version"""
+
+    data, errors = make_gappy_data(n_spectra=512)
+    n_components = 4
+
+    eigen_vectors = {}
+    for name, size in zip(["single", "batch"], [None, batch_size]):
+        eigen_system = vwpca.run_robust_pca(
+            data,
+            errors=errors,
+            amount_of_eigen=n_components,
+            batch_size=size,
+        )
+        eigen_vectors[name] = eigen_system["U"]
+
+    # Cosines of the principal angles between the two eigenbases
+    cos_angles = np.linalg.svd(
+        np.matmul(eigen_vectors["single"].T, eigen_vectors["batch"]),
+        compute_uv=False,
+    )
+
+    assert np.all(cos_angles > 0.99)